@@ -1,15 +1,39 @@
 # name: Maxli Store
-# version: 1.4.1
+# version: 1.20.0
 # developer: Kerdik
 # id: maxli_store
 # dependencies: aiohttp
 # min-maxli: 26
 
 import aiohttp
+import asyncio
+import json
 import re
 import os
+import bisect
+import contextlib
+import errno
+import hashlib
+import heapq
+import importlib.metadata
+import importlib.util
+import shutil
+import tempfile
+import zipfile
+import time
+from collections import Counter, OrderedDict, deque
+from urllib.parse import quote
 
-# Только один репозиторий
+DEFAULT_BRANCH = "main"
+
+# Адреса GitHub (бенчмарк подменяет их на локальный сервер)
+GITHUB_API_URL = "https://api.github.com"
+GITHUB_RAW_URL = "https://raw.githubusercontent.com"
+
+# Папки репозитория, в которых лежат не модули (бенчмарки, тесты, CI)
+CATALOG_IGNORED_DIRS = {"benchmarks", "tests", ".github"}
+
+# Репозитории в порядке приоритета: при совпадении имен модуль берется из первого
 REPOSITORY_URLS = [
     "https://github.com/zyphralex/MaxliStore"
 ]
@@ -25,7 +49,8 @@ def extract_repo_info(url):
         return {
             "name": f"{owner}/{repo_name}",
             "path": f"{owner}/{repo_name}",
-            "url": url
+            "url": url,
+            "branch": DEFAULT_BRANCH
         }
     return None
 
@@ -34,6 +59,7 @@ REPOSITORIES = []
 for url in REPOSITORY_URLS:
     repo_info = extract_repo_info(url)
     if repo_info:
+        repo_info["priority"] = len(REPOSITORIES)
         REPOSITORIES.append(repo_info)
 
 # Если не удалось распарсить, используем fallback
@@ -41,11 +67,135 @@ if not REPOSITORIES:
     REPOSITORIES = [{
         "name": "zyphralex/MaxliStore",
         "path": "zyphralex/MaxliStore", 
-        "url": "https://github.com/zyphralex/MaxliStore"
+        "url": "https://github.com/zyphralex/MaxliStore",
+        "branch": DEFAULT_BRANCH,
+        "priority": 0
     }]
 
 current_repo_index = 0
 
+# --- Несколько репозиториев ---
+FEDERATION_TIMEOUT = 5  # Сколько секунд ждем медленные репозитории при поиске
+
+# repo_path -> {"requests": ..., "errors": ..., "latency": ...}
+REPO_STATS = {}
+# Объединенный каталог, пересобирается только когда меняется каталог одного из репозиториев
+FEDERATED_CATALOG = {"sources": (), "modules": []}
+
+# --- Общий HTTP клиент ---
+HTTP_TIMEOUT = 30  # Таймаут запроса по умолчанию (сек)
+HTTP_LIMIT = 20  # Всего соединений в пуле
+HTTP_LIMIT_PER_HOST = 6  # Соединений на один хост
+DNS_CACHE_TTL = 300  # Сколько секунд помнить DNS ответы
+
+HTTP_SESSION = None
+HTTP_SESSION_LOOP = None
+HTTP_STATS = {"requests": 0, "new_connections": 0, "reused_connections": 0, "dns_lookups": 0}
+
+# --- Кэш каталога ---
+CACHE_FILE = "maxli_store_cache.json"  # Файл для хранения каталога между запусками
+CATALOG_TTL = 300  # Сколько секунд каталог считается свежим
+
+# "owner/repo@branch" -> {"etag": ..., "head_sha": ..., "fetched_at": ..., "modules": [...]}
+CATALOG_CACHE = {}
+CACHE_STATS = {"hits": 0, "stale": 0, "misses": 0, "mirror": 0, "not_modified": 0, "head_unchanged": 0, "refreshes": 0}
+CACHE_LOADED = False
+
+# --- Доступ к GitHub API ---
+RATE_LIMIT_RESERVE = 3  # Столько запросов оставляем про запас, не доводя лимит до нуля
+
+# Последние известные X-RateLimit-Remaining / X-RateLimit-Reset
+RATE_LIMIT = {"remaining": None, "reset": 0}
+# Одинаковые запросы, которые выполняются прямо сейчас: ключ -> задача
+INFLIGHT_REQUESTS = {}
+GITHUB_STATS = {"started": 0, "coalesced": 0, "rate_limited": 0}
+# repo_path -> причина последней неудачной загрузки каталога
+CATALOG_ERRORS = {}
+
+# --- Заголовки модулей ---
+HEADERS_FILE = "maxli_store_headers.json"  # Заголовки модулей по SHA файла
+HEADER_FETCH_BYTES = 2048  # Сколько байт от начала файла читаем ради заголовка
+HEADER_CONCURRENCY = 8  # Сколько заголовков качаем одновременно
+
+# blob SHA -> {"name": ..., "version": ..., "developer": ..., ...}
+HEADER_CACHE = {}
+HEADER_STATS = {"fetched": 0, "failed": 0}
+HEADERS_LOADED = False
+# Счетчик обновлений заголовков, чтобы поисковый индекс знал, когда перестроиться
+HEADER_REVISION = 0
+# "owner/repo@branch" -> (список модулей, задача сбора заголовков)
+HEADER_TASKS = {}
+
+# --- Кэш файлов модулей ---
+BLOB_DIR = "maxli_store_blobs"  # Файлы модулей, названные по git blob SHA
+BLOB_CACHE_LIMIT = 20 * 1024 * 1024  # Максимальный размер кэша в байтах
+BLOB_STATS = {"hits": 0, "mirror": 0, "misses": 0, "evicted": 0, "corrupted": 0}
+
+# --- Сессии поиска ---
+SESSION_TTL = 600  # Сколько секунд номера из последнего поиска остаются в силе
+SESSION_LIMIT = 200  # Сколько чатов помним одновременно
+
+# chat_id -> {"repo": ..., "modules": [...], "query": ..., "created_at": ...}
+SEARCH_SESSIONS = OrderedDict()
+
+# --- Обновления ---
+MODULES_DIR = None  # Папка установленных модулей; None - папка, где лежит сам Maxli Store
+
+# --- Совместимость ---
+# Версия Maxli для проверки '# min-maxli:'. Если None - берется из api.maxli_version /
+# api.version, а если api ее не сообщает, проверка не выполняется (об этом пишется в подписи)
+MAXLI_VERSION = None
+
+# --- Пакетная загрузка ---
+BULK_CONCURRENCY = 4  # Сколько модулей качаем одновременно
+BULK_LIMIT = 50  # Больше модулей за раз в архив не собираем
+
+# --- Локальное зеркало ---
+MIRROR_DIR = "maxli_store_mirror"  # Распакованные копии репозиториев
+MIRROR_MANIFEST_FILE = os.path.join(MIRROR_DIR, "manifest.json")
+MIRROR_ARCHIVE_URL = "https://codeload.github.com/{path}/zip/{ref}"
+MIRROR_ARCHIVE_LIMIT = 50 * 1024 * 1024  # Больше этого архив репозитория не качаем
+MIRROR_INCREMENTAL_LIMIT = 20  # Если изменилось больше файлов, выгоднее скачать архив целиком
+
+# "owner/repo@branch" -> {"head_sha": ..., "synced_at": ..., "modules": [...]}
+MIRROR_MANIFEST = {}
+MIRROR_LOADED = False
+
+# --- Очередь загрузок ---
+JOB_GLOBAL_LIMIT = 2  # Сколько загрузок выполняется одновременно
+JOB_CHAT_LIMIT = 1  # Из них - из одного чата
+JOB_LIST_COMMAND = "maxlistore_jobs"
+JOB_CANCEL_COMMAND = "maxlistore_cancel"
+
+JOBS = {}  # номер -> задача
+JOB_QUEUES = OrderedDict()  # chat_id -> номера ждущих задач; порядок - очередь обхода чатов
+JOB_RUNNING = Counter()  # chat_id -> сколько задач выполняется
+JOB_COUNTER = 0
+JOB_STATS = {"started": 0, "finished": 0, "cancelled": 0}
+
+# --- Прогресс ---
+PROGRESS_INTERVAL = 2.0  # Не чаще одной правки сообщения за столько секунд
+
+PROGRESS_STATS = {"edits": 0, "saved": 0}
+
+# --- Временные файлы ---
+SCRATCH_DIR_NAME = "maxli_store"  # Подпапка в /dev/shm или системной временной папке
+SCRATCH_QUOTA = 64 * 1024 * 1024  # Сколько байт могут занимать файлы, ожидающие отправки
+
+SCRATCH_ROOT = None
+SCRATCH_STATS = {"reserved": 0, "rejected": 0}
+
+# --- Поисковый индекс ---
+SEARCH_LIMIT = 20  # Сколько результатов показывает .maxlistore_s
+LIST_PAGE_SIZE = 15  # Сколько модулей показывает .maxlistore_list
+SEARCH_MIN_SCORE = 0.45  # Ниже этого порога нечеткие совпадения отбрасываются
+SEARCH_RERANK = 20  # Сколько кандидатов по триграммам перепроверяем расстоянием Левенштейна
+# Вес поля в итоговой оценке: имя файла важнее имени из заголовка, автор - меньше всего
+SEARCH_FIELD_WEIGHTS = {"file": 1.0, "name": 0.9, "developer": 0.6}
+
+# "owner/repo@branch" -> индекс, построенный для конкретного списка модулей
+SEARCH_INDEXES = {}
+
 def get_current_repo():
     return REPOSITORIES[current_repo_index]
 
@@ -59,19 +209,14 @@ async def maxlistore_command(api, message, args):
     await api.edit(message, "🔍 Ищу модули в репозитории...")
     
     try:
-        current_repo = get_current_repo()
-        all_modules = await get_repo_modules(current_repo["path"])
+        current_repo, all_modules = await get_all_modules()
         
         if not all_modules:
-            await api.edit(message, f"❌ Не удалось загрузить модули из репозитория\n📂 {current_repo['name']}")
+            await api.edit(message, f"❌ Не удалось загрузить модули из репозитория\n📂 {current_repo['name']}{format_catalog_error()}")
             return
         
-        # Фильтруем модули по поисковому запросу
-        matched_modules = []
-        for module in all_modules:
-            module_name = module['name'].lower().replace('.py', '')
-            if search_query in module_name:
-                matched_modules.append(module)
+        # Ищем по индексу, самые подходящие модули первыми
+        matched_modules = search_modules(current_repo, all_modules, search_query, limit=None)
         
         if not matched_modules:
             available_modules = "\n".join([f"• {m['name'].replace('.py', '')}" for m in all_modules[:10]])
@@ -84,7 +229,8 @@ async def maxlistore_command(api, message, args):
             # Если найден только один модуль - сразу скачиваем
             await download_module(api, message, matched_modules[0], current_repo)
         else:
-            # Показываем список
+            # Запоминаем список, чтобы .maxlistore_download взял модуль по номеру из него
+            await save_search_session(api, message, current_repo, matched_modules, search_query)
             await show_modules_list(api, message, matched_modules, search_query, current_repo)
             
     except Exception as e:
@@ -100,104 +246,176 @@ async def maxlistore_s_command(api, message, args):
     await api.edit(message, f"🔍 Ищу модули по запросу '{search_query}'...")
     
     try:
-        current_repo = get_current_repo()
-        all_modules = await get_repo_modules(current_repo["path"])
+        current_repo, all_modules = await get_all_modules()
         
         if not all_modules:
-            await api.edit(message, f"❌ Не удалось загрузить модули из репозитория\n📂 {current_repo['name']}")
+            await api.edit(message, f"❌ Не удалось загрузить модули из репозитория\n📂 {current_repo['name']}{format_catalog_error()}")
             return
         
-        # Фильтруем модули по части названия
-        matched_modules = []
-        for module in all_modules:
-            module_name = module['name'].lower().replace('.py', '')
-            if search_query in module_name:
-                matched_modules.append(module)
-        
-        # Ограничиваем 20 результатами
-        matched_modules = matched_modules[:20]
+        # Ищем по индексу, ограничиваем 20 результатами
+        matched_modules = search_modules(current_repo, all_modules, search_query, limit=SEARCH_LIMIT)
         
         if not matched_modules:
             await api.edit(message, f"❌ Не найдено модулей по запросу: '{search_query}'\n\n💡 Попробуйте другой запрос или используйте .maxlistore_list для просмотра всех модулей")
             return
         
-        # Показываем результаты поиска
+        # Показываем результаты поиска и запоминаем их номера
+        await save_search_session(api, message, current_repo, matched_modules, search_query)
         await show_search_results(api, message, matched_modules, search_query, current_repo)
             
     except Exception as e:
         await api.edit(message, f"❌ Ошибка поиска: {str(e)}")
 
 async def maxlistore_download_command(api, message, args):
-    """Скачивает модуль по номеру из предыдущего поиска."""
-    if not args or not args[0].isdigit():
-        await api.edit(message, "❌ Укажите номер модуля: .maxlistore_download 1")
+    """Скачивает модуль (или несколько) по номеру из предыдущего поиска."""
+    module_numbers, search_query = parse_module_numbers(args)
+    if not module_numbers:
+        await api.edit(message, "❌ Укажите номер модуля: .maxlistore_download 1\n📦 Несколько сразу: .maxlistore_download 1 3 5")
         return
     
-    module_number = int(args[0])
-    search_query = " ".join(args[1:]) if len(args) > 1 else ""
-    
     await api.edit(message, "🔄 Получаю информацию о модуле...")
     
     try:
-        # Используем текущий выбранный репозиторий
-        current_repo = get_current_repo()
-        all_modules = await get_repo_modules(current_repo["path"])
-        
-        if not all_modules:
-            await api.edit(message, f"❌ Не удалось загрузить модули из репозитория: {current_repo['name']}")
+        modules, repo = await resolve_numbered_modules(api, message, search_query)
+        if modules is None:
             return
+        await download_selected_modules(api, message, modules, repo, module_numbers)
         
-        if search_query:
-            # Фильтруем по новому запросу
-            matched_modules = []
-            for module in all_modules:
-                module_name = module['name'].lower().replace('.py', '')
-                if search_query in module_name:
-                    matched_modules.append(module)
+    except Exception as e:
+        await api.edit(message, f"❌ Ошибка загрузки: {str(e)}")
+
+async def maxlistore_bundle_command(api, message, args):
+    """Скачивает модули из последнего поиска одним архивом."""
+    module_numbers, search_query = parse_module_numbers(args)
+    
+    await api.edit(message, "🔄 Собираю список модулей...")
+    
+    try:
+        if not module_numbers and not search_query:
+            # Без номеров и запроса берем ровно то, что чат видел в последнем поиске, -
+            # а не первые модули всего каталога
+            session = await get_search_session(api, message)
+            if not session:
+                await api.edit(message, "❌ Сначала найдите модули: `.maxlistore_s <часть_названия>`\n📦 Или укажите номера: `.maxlistore_bundle 1 3 5`")
+                return
+            modules, repo = session["modules"][:session["shown"]], session["repo"]
+            module_numbers = list(range(1, len(modules) + 1))
         else:
-            matched_modules = all_modules
-        
-        if not matched_modules or module_number < 1 or module_number > len(matched_modules):
-            await api.edit(message, f"❌ Неверный номер модуля. Доступно: 1-{len(matched_modules) if matched_modules else 0}")
-            return
-        
-        module = matched_modules[module_number - 1]
-        await download_module(api, message, module, current_repo)
+            modules, repo = await resolve_numbered_modules(api, message, search_query)
+            if modules is None:
+                return
+            if not module_numbers:
+                # Без номеров берем весь найденный список
+                module_numbers = list(range(1, len(modules) + 1))
+        await download_selected_modules(api, message, modules, repo, module_numbers, force_bundle=True)
         
     except Exception as e:
         await api.edit(message, f"❌ Ошибка загрузки: {str(e)}")
 
+def parse_module_numbers(args):
+    """Отделяет номера модулей (1 3 5, 2-4, 1,2) от поискового запроса."""
+    # Повторы убираем, порядок сохраняем. Больше BULK_LIMIT + 1 номеров не собираем:
+    # этого хватает для отказа, а диапазон 1-30000000 не разворачивается в память
+    numbers = {}
+    rest = list(args)
+    while rest and re.fullmatch(r"\d+(-\d+)?(,\d+(-\d+)?)*", rest[0]):
+        for part in rest.pop(0).split(","):
+            if len(numbers) > BULK_LIMIT:
+                break
+            if "-" in part:
+                first, last = (int(x) for x in part.split("-"))
+                last = min(last, first + BULK_LIMIT)
+                for number in range(first, last + 1):
+                    numbers[number] = None
+                    if len(numbers) > BULK_LIMIT:
+                        break
+            else:
+                numbers[int(part)] = None
+    return list(numbers), " ".join(rest).lower()
+
+async def resolve_numbered_modules(api, message, search_query):
+    """Возвращает список, к которому относятся номера, и его репозиторий."""
+    if not search_query:
+        # Номер относится к тому, что пользователь видел в последнем поиске этого чата
+        session = await get_search_session(api, message)
+        if session:
+            return session["modules"], session["repo"]
+    
+    # Каталог всех подключенных репозиториев
+    current_repo, all_modules = await get_all_modules()
+    
+    if not all_modules:
+        await api.edit(message, f"❌ Не удалось загрузить модули из репозитория: {current_repo['name']}{format_catalog_error()}")
+        return None, current_repo
+    
+    if search_query:
+        # Ищем по новому запросу так же, как .maxlistore_s
+        return search_modules(current_repo, all_modules, search_query, limit=SEARCH_LIMIT), current_repo
+    return all_modules, current_repo
+
+async def download_selected_modules(api, message, modules, repo, module_numbers, force_bundle=False):
+    """Проверяет номера и скачивает один модуль или архив из нескольких."""
+    invalid = [n for n in module_numbers if n < 1 or n > len(modules)]
+    if not modules or invalid:
+        await api.edit(message, f"❌ Неверный номер модуля. Доступно: 1-{len(modules) if modules else 0}")
+        return
+    if len(module_numbers) > BULK_LIMIT:
+        await api.edit(message, f"❌ За один раз можно скачать не больше {BULK_LIMIT} модулей")
+        return
+    
+    selected = [modules[n - 1] for n in module_numbers]
+    if len(selected) == 1 and not force_bundle:
+        await download_module(api, message, selected[0], repo)
+    else:
+        await download_modules_bundle(api, message, selected, repo)
+
 async def maxlistore_list_command(api, message, args):
     """Показывает все доступные модули в репозитории."""
     await api.edit(message, "📋 Загружаю список модулей...")
     
     try:
-        current_repo = get_current_repo()
-        all_modules = await get_repo_modules(current_repo["path"])
+        current_repo, all_modules = await get_all_modules()
         
         if not all_modules:
-            await api.edit(message, f"❌ Не удалось загрузить модули из репозитория: {current_repo['name']}")
+            await api.edit(message, f"❌ Не удалось загрузить модули из репозитория: {current_repo['name']}{format_catalog_error()}")
             return
         
+        # По номеру можно скачать любой модуль каталога, но .maxlistore_bundle берет только показанные
+        await save_search_session(api, message, current_repo, all_modules, "", shown=LIST_PAGE_SIZE)
         await show_all_modules(api, message, all_modules, current_repo)
         
     except Exception as e:
         await api.edit(message, f"❌ Ошибка: {str(e)}")
 
 async def maxlistore_repo_command(api, message, args):
-    """Показывает информацию о репозитории."""
-    current_repo = get_current_repo()
+    """Показывает информацию о репозиториях."""
+    repo_lines = []
+    for repo in sorted(REPOSITORIES, key=lambda r: r["priority"]):
+        stats = REPO_STATS.get(repo["path"])
+        if stats and stats["requests"]:
+            error_rate = stats["errors"] / stats["requests"] * 100
+            health = f"⏱ {stats['latency'] * 1000:.0f} мс, ошибок {error_rate:.0f}%"
+        else:
+            health = "⏱ еще не запрашивался"
+        repo_lines.append(
+            f"{repo['priority'] + 1}. {repo['name']}\n"
+            f"🔗 Ссылка: {repo['url']}\n"
+            f"🌿 Ветка: {repo['branch']}\n"
+            f"{health}"
+        )
+    repos_text = "\n\n".join(repo_lines)
     
-    repo_info = f"""📂 Информация о репозитории
+    repo_info = f"""📂 Информация о репозиториях
 
-🔗 Ссылка: {current_repo['url']}
-📁 Путь: {current_repo['path']}
+{repos_text}
 
 ⚡ Команды:
 `.maxlistore <название>` - поиск модулей
 `.maxlistore_s <часть_названия>` - поиск по части названия (до 20)
 `.maxlistore_list` - все модули
 `.maxlistore_download <номер>` - скачать модуль
+`.maxlistore_download 1 3 5` - скачать несколько модулей архивом
+`.maxlistore_bundle` - скачать весь последний поиск архивом
 
 💡 Пример:
 `.maxlistore_s weat` - найти модули с "weat" в названии
@@ -205,9 +423,405 @@ async def maxlistore_repo_command(api, message, args):
     
     await api.edit(message, repo_info)
 
+async def maxlistore_sync_command(api, message, args):
+    """Скачивает репозитории целиком в локальное зеркало для работы без сети."""
+    if args and args[0].lower() == "off":
+        for repo in REPOSITORIES:
+            remove_repo_mirror(repo)
+        await api.edit(message, "✅ Зеркало удалено, Maxli Store снова работает через GitHub")
+        return
+    
+    archive_path = " ".join(args) if args else None
+    if archive_path and not os.path.isfile(archive_path):
+        await api.edit(message, f"❌ Архив не найден: {archive_path}")
+        return
+    
+    await api.edit(message, "🔄 Синхронизирую зеркало репозитория...")
+    
+    methods = {
+        "archive": "архивом целиком",
+        "files": "только измененные файлы",
+        "none": "изменений нет",
+    }
+    # Локальный архив относится к основному репозиторию
+    repos = [get_current_repo()] if archive_path else REPOSITORIES
+    lines = ["✅ Зеркало синхронизировано\n"]
+    for repo in repos:
+        try:
+            summary = await sync_repo_mirror(repo, archive_path)
+            lines.append(f"📂 {repo['name']}: {summary['modules']} модулей, {methods[summary['method']]}")
+            if summary["changed"] or summary["removed"]:
+                lines.append(f"   ✏️ Изменено: {summary['changed']}, удалено: {summary['removed']}")
+        except Exception as e:
+            lines.append(f"❌ {repo['name']}: {str(e)}")
+    
+    lines.append("\n💡 Поиск, список и скачивание теперь работают без сети")
+    lines.append("🔄 Обновить: `.maxlistore_sync`, отключить: `.maxlistore_sync off`")
+    await api.edit(message, "\n".join(lines))
+
+async def maxlistore_stats_command(api, message, args):
+    """Показывает статистику кэша каталога."""
+    stats = get_cache_stats()
+    http_stats = get_http_stats()
+    
+    stats_text = f"""📊 Статистика Maxli Store
+
+🗂 Кэш каталога:
+• Попадания: {stats['hits']}
+• Из зеркала: {stats['mirror']}
+• Устаревшие (обновлены в фоне): {stats['stale']}
+• Промахи: {stats['misses']}
+• Ответов 304 (без изменений): {stats['not_modified']}
+• Коммит не изменился: {stats['head_unchanged']}
+• Запросов к GitHub: {stats['refreshes']}
+• Доля попаданий: {stats['hit_ratio'] * 100:.1f}%
+
+🐙 GitHub API:
+• Запросов запущено: {GITHUB_STATS['started']}
+• Объединено с уже идущими: {GITHUB_STATS['coalesced']}
+• Отложено из-за лимита: {GITHUB_STATS['rate_limited']}
+• Остаток лимита: {RATE_LIMIT['remaining'] if RATE_LIMIT['remaining'] is not None else 'неизвестно'}
+
+📦 Кэш файлов модулей:
+• Из кэша: {BLOB_STATS['hits']}
+• Из зеркала: {BLOB_STATS['mirror']}
+• Скачано: {BLOB_STATS['misses']}
+• Вытеснено: {BLOB_STATS['evicted']}
+• Поврежденных: {BLOB_STATS['corrupted']}
+
+🏷 Заголовки модулей:
+• В кэше: {len(HEADER_CACHE)}
+• Загружено: {HEADER_STATS['fetched']}
+• Ошибок: {HEADER_STATS['failed']}
+
+🌐 HTTP пул:
+• Запросов: {http_stats['requests']}
+• Новых соединений: {http_stats['new_connections']}
+• Переиспользовано: {http_stats['reused_connections']} ({http_stats['reuse_ratio'] * 100:.1f}%)
+• Открыто сейчас: {http_stats['open_connections']}
+• DNS запросов: {http_stats['dns_lookups']}
+
+🗑 Временные файлы:
+• Зарезервировано: {SCRATCH_STATS['reserved'] / 1024 / 1024:.1f} / {SCRATCH_QUOTA / 1024 / 1024:.0f} МБ
+• Отказов по квоте: {SCRATCH_STATS['rejected']}
+
+✏️ Прогресс:
+• Правок сообщений: {PROGRESS_STATS['edits']}
+• Сэкономлено правок: {PROGRESS_STATS['saved']}
+
+📋 Очередь: выполняется {sum(JOB_RUNNING.values())}/{JOB_GLOBAL_LIMIT} • ждут {sum(len(q) for q in JOB_QUEUES.values())} • отменено {JOB_STATS['cancelled']}"""
+    
+    await api.edit(message, stats_text)
+
+async def maxlistore_updates_command(api, message, args):
+    """Проверяет обновления установленных модулей по SHA файлов, ничего не скачивая."""
+    await api.edit(message, "🔄 Проверяю обновления модулей...")
+    
+    try:
+        installed = scan_installed_modules()
+        if not installed:
+            await api.edit(message, f"❌ Не нашел установленных модулей в {get_modules_dir()}")
+            return
+        
+        # Один запрос каталога (обычно из кэша) вместо скачивания каждого модуля
+        current_repo, all_modules = await get_all_modules()
+        if not all_modules:
+            await api.edit(message, f"❌ Не удалось загрузить модули из репозитория: {current_repo['name']}{format_catalog_error()}")
+            return
+        
+        updates, unchanged, unknown = find_module_updates(installed, all_modules)
+        summary = f"📦 Проверено: {len(installed)} • актуальны: {unchanged} • нет в каталоге: {unknown}"
+        if not updates:
+            await api.edit(message, f"✅ Все модули актуальны\n\n{summary}")
+            return
+        
+        # Новые версии берем из заголовков: только для изменившихся и только первые байты
+        await harvest_module_headers([module for _, module in updates])
+        
+        lines = [f"🆕 Есть обновления ({len(updates)}):\n"]
+        for i, (local, module) in enumerate(updates, 1):
+            old_version = local["header"].get("version", "?")
+            new_version = get_module_header(module).get("version", "?")
+            note = " (файл отличается)" if old_version == new_version else ""
+            lines.append(f"{i}. {local['name'].replace('.py', '')}: v{old_version} → v{new_version}{note}")
+        lines.append(f"\n{summary}")
+        lines.append("💡 Обновить: `.maxlistore_download <номер>` или `.maxlistore_bundle` - все сразу")
+        
+        # Номера из списка обновлений работают в .maxlistore_download / _bundle
+        await save_search_session(api, message, current_repo, [module for _, module in updates], "updates")
+        await api.edit(message, "\n".join(lines))
+        
+    except Exception as e:
+        await api.edit(message, f"❌ Ошибка проверки обновлений: {str(e)}")
+
+def get_modules_dir():
+    return MODULES_DIR or os.path.dirname(os.path.abspath(__file__))
+
+def scan_installed_modules():
+    """SHA и заголовки .py файлов в папке установленных модулей."""
+    installed = []
+    modules_dir = get_modules_dir()
+    try:
+        filenames = sorted(os.listdir(modules_dir))
+    except OSError:
+        return installed
+    for filename in filenames:
+        if not filename.endswith(".py"):
+            continue
+        try:
+            with open(os.path.join(modules_dir, filename), 'rb') as f:
+                content = f.read()
+        except OSError:
+            continue
+        installed.append({
+            "name": filename,
+            "sha": git_blob_sha(content),
+            "header": parse_module_header(content[:HEADER_FETCH_BYTES].decode("utf-8", errors="replace")),
+        })
+    return installed
+
+def find_module_updates(installed, modules):
+    """Сопоставляет установленные модули с каталогом по '# id:' или имени файла."""
+    by_id = {}
+    by_name = {}
+    for module in modules:
+        module_id = get_module_header(module).get("id")
+        if module_id:
+            by_id.setdefault(module_id, module)
+        by_name.setdefault(module["name"], module)
+    
+    updates = []
+    unchanged = unknown = 0
+    for local in installed:
+        module = by_id.get(local["header"].get("id")) or by_name.get(local["name"])
+        if module is None:
+            unknown += 1
+        elif module.get("sha") == local["sha"]:
+            unchanged += 1
+        else:
+            updates.append((local, module))
+    return updates, unchanged, unknown
+
+async def download_modules_bundle(api, message, modules, repo):
+    """Скачивает несколько модулей параллельно и отправляет одним zip архивом."""
+    await run_job(api, message, f"Архив: {len(modules)} модулей", lambda: _download_modules_bundle(api, message, modules, repo))
+
+async def _download_modules_bundle(api, message, modules, repo):
+    progress = new_progress(api, message)
+    await report_progress(progress, f"⬇️ Скачиваю модули: 0/{len(modules)}")
+    
+    async def on_progress(done, total):
+        await report_progress(progress, f"⬇️ Скачиваю модули: {done}/{total}")
+    
+    try:
+        plan = await build_install_plan(api, modules, repo, on_progress)
+    finally:
+        # Отложенный счетчик не должен перезаписать итог или уже удаленное сообщение
+        await finish_progress(progress)
+    
+    if not plan["modules"]:
+        notes = "\n".join(format_plan_notes(plan))
+        await api.edit(message, f"❌ Не удалось скачать ни одного модуля\n{notes}".rstrip())
+        return
+    
+    await send_modules_archive(api, message, plan, repo)
+
+async def send_modules_archive(api, message, plan, repo):
+    """Отправляет модули из плана одним zip архивом."""
+    downloaded = plan["modules"]
+    caption = [f"📦 Модули ({len(downloaded)}): " + ", ".join(m['name'].replace('.py', '') for m, _ in downloaded)]
+    caption.extend(format_plan_notes(plan))
+    caption.append(f"📂 Репозиторий: {repo['name']}")
+    caption.append("⚡ Скачано через Maxli Store")
+    
+    chat_id = await get_chat_id(api, message)
+    total_size = sum(len(content) for _, content in downloaded)
+    
+    async with scratch_file("maxli_modules.zip", total_size) as archive_path:
+        with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for module, content in downloaded:
+                # Путь в репозитории сохраняет папки и не дает одинаковым именам затереть друг друга
+                archive.writestr(module['path'], content)
+        
+        result = await api.send_file(
+            chat_id=chat_id,
+            file_path=archive_path,
+            text="\n".join(caption)
+        )
+    
+    if result:
+        await api.delete(message)
+    else:
+        await api.edit(message, "✅ Модули скачаны, но не удалось отправить архив")
+
+def get_maxli_version(api):
+    """Версия Maxli (целое число) или None, если ее не удалось узнать."""
+    version = MAXLI_VERSION or getattr(api, "maxli_version", None) or getattr(api, "version", None)
+    match = re.match(r"\s*(\d+)", str(version)) if version is not None else None
+    return int(match.group(1)) if match else None
+
+def parse_dependencies(value):
+    """Разбирает '# dependencies: aiohttp, speedtest-cli>=2' в список имен."""
+    names = []
+    for item in re.split(r"[,\s]+", value or ""):
+        name = re.split(r"[<>=!~\[;]", item, 1)[0].strip()
+        if name:
+            names.append(name)
+    return names
+
+def is_package_installed(name):
+    """Проверяет, установлен ли pip пакет (по имени дистрибутива или модуля)."""
+    try:
+        importlib.metadata.version(name)
+        return True
+    except importlib.metadata.PackageNotFoundError:
+        pass
+    try:
+        return importlib.util.find_spec(name.replace("-", "_")) is not None
+    except (ImportError, ValueError):
+        return False
+
+async def build_install_plan(api, modules, repo, on_progress=None):
+    """Составляет план установки выбранных модулей по их заголовкам.
+    
+    Модули скачиваются параллельно; их зависимости из этого же каталога
+    (по '# id:' или имени файла) докачиваются следующими слоями, модули с
+    '# min-maxli:' новее текущего Maxli пропускаются, а недостающие pip
+    пакеты собираются в один список.
+    """
+    _, catalog = await get_all_modules()
+    by_id = {}
+    by_stem = {}
+    for candidate in catalog:
+        module_id = get_module_header(candidate).get("id")
+        if module_id:
+            by_id.setdefault(module_id.lower(), candidate)
+        by_stem.setdefault(candidate["name"][:-3].lower(), candidate)
+    
+    maxli_version = get_maxli_version(api)
+    plan = {"modules": [], "added": [], "skipped": [], "failed": [], "packages": [], "unchecked": []}
+    requested = {module["path"] for module in modules}
+    seen = set(requested)
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+    done = 0
+    total = len(modules)
+    
+    async def fetch(module):
+        nonlocal done
+        async with semaphore:
+            download_url = module.get('download_url')
+            if not download_url:
+                module_repo = get_module_repo(module, repo)
+                download_url = await get_raw_download_url(module, module_repo["path"], module_repo["branch"])
+            content = await get_module_content(module, download_url)
+        done += 1
+        if on_progress:
+            await on_progress(done, total)
+        return content
+    
+    layer = list(modules)
+    while layer:
+        results = await asyncio.gather(*(fetch(module) for module in layer), return_exceptions=True)
+        next_layer = []
+        for module, content in zip(layer, results):
+            if isinstance(content, Exception) or not content:
+                plan["failed"].append(module)
+                continue
+            
+            # Заголовок берем из самого файла - он точно той же версии
+            header = parse_module_header(content[:HEADER_FETCH_BYTES].decode("utf-8", errors="replace"))
+            required = re.match(r"\s*(\d+)", header.get("min-maxli", ""))
+            if required and maxli_version is None:
+                plan["unchecked"].append((module, int(required.group(1))))
+            elif required and int(required.group(1)) > maxli_version:
+                plan["skipped"].append((module, int(required.group(1))))
+                continue
+            
+            plan["modules"].append((module, content))
+            if module["path"] not in requested:
+                plan["added"].append(module)
+            
+            for dependency in parse_dependencies(header.get("dependencies")):
+                key = dependency.lower()
+                dep_module = by_id.get(key)
+                if dep_module is None and not is_package_installed(dependency):
+                    dep_module = by_stem.get(key)
+                    if dep_module is None:
+                        if dependency not in plan["packages"]:
+                            plan["packages"].append(dependency)
+                        continue
+                if dep_module is not None and dep_module["path"] not in seen:
+                    seen.add(dep_module["path"])
+                    next_layer.append(dep_module)
+        total += len(next_layer)
+        layer = next_layer
+    
+    return plan
+
+def format_plan_notes(plan):
+    """Строки о зависимостях и пропущенных модулях для подписи."""
+    notes = []
+    if plan["added"]:
+        notes.append("➕ Зависимости из репозитория: " + ", ".join(m['name'].replace('.py', '') for m in plan["added"]))
+    if plan["skipped"]:
+        skipped = ", ".join(f"{m['name'].replace('.py', '')} (Maxli {need}+)" for m, need in plan["skipped"])
+        notes.append(f"⏭ Пропущены, нужен Maxli новее: {skipped}")
+    if plan["failed"]:
+        notes.append("⚠️ Не скачались: " + ", ".join(m['name'].replace('.py', '') for m in plan["failed"]))
+    if plan["packages"]:
+        notes.append(f"📥 Не хватает пакетов: `pip install {' '.join(plan['packages'])}`")
+    if plan["unchecked"]:
+        unchecked = ", ".join(f"{m['name'].replace('.py', '')} (Maxli {need}+)" for m, need in plan["unchecked"])
+        notes.append(f"❔ Версия Maxli неизвестна, совместимость не проверена: {unchecked}\n   Задайте MAXLI_VERSION в MaxliStore.py, чтобы включить проверку")
+    return notes
+
+async def get_chat_id(api, message):
+    """Возвращает chat_id сообщения."""
+    chat_id = getattr(message, 'chat_id', None)
+    if not chat_id:
+        chat_id = await api.await_chat_id(message)
+    return chat_id
+
+async def save_search_session(api, message, repo, modules, search_query, shown=None):
+    """Запоминает показанный пользователю список модулей для этого чата.
+    
+    shown - сколько первых модулей списка пользователь действительно видел
+    (по умолчанию все); .maxlistore_bundle без номеров берет только их.
+    """
+    chat_id = await get_chat_id(api, message)
+    if not chat_id:
+        return
+    SEARCH_SESSIONS.pop(chat_id, None)
+    SEARCH_SESSIONS[chat_id] = {
+        "repo": repo,
+        "modules": modules,
+        "query": search_query,
+        "shown": len(modules) if shown is None else min(shown, len(modules)),
+        "created_at": time.time(),
+    }
+    while len(SEARCH_SESSIONS) > SESSION_LIMIT:
+        SEARCH_SESSIONS.popitem(last=False)
+
+async def get_search_session(api, message):
+    """Возвращает последний список модулей этого чата, если он еще не устарел."""
+    chat_id = await get_chat_id(api, message)
+    session = SEARCH_SESSIONS.get(chat_id)
+    if not session:
+        return None
+    if time.time() - session["created_at"] > SESSION_TTL:
+        del SEARCH_SESSIONS[chat_id]
+        return None
+    SEARCH_SESSIONS.move_to_end(chat_id)
+    return session
+
 async def show_help(api, message):
     """Показывает справку по командам."""
-    current_repo = get_current_repo()
+    current_repo = get_catalog_view()
+    maxli_version = get_maxli_version(api)
+    if maxli_version is None:
+        compatibility = "выключена: версия Maxli неизвестна, задайте MAXLI_VERSION в MaxliStore.py"
+    else:
+        compatibility = f"Maxli {maxli_version}"
     
     help_text = f"""📦 Maxli Store - Менеджер модулей
 
@@ -218,7 +832,16 @@ async def show_help(api, message):
 `.maxlistore_s <часть_названия>` - поиск по части названия (до 20)
 `.maxlistore_list` - все модули
 `.maxlistore_download <номер>` - скачать модуль
+`.maxlistore_download 1 3 5` - скачать несколько модулей архивом
+`.maxlistore_bundle` - скачать весь последний поиск архивом
 `.maxlistore_repo` - информация о репозитории
+`.maxlistore_sync` - скачать репозиторий для работы без сети
+`.maxlistore_updates` - проверить обновления установленных модулей
+`.maxlistore_stats` - статистика кэша и HTTP пула
+`.maxlistore_jobs` - очередь загрузок
+`.maxlistore_cancel <номер>` - отменить загрузку
+
+⚙️ Проверка `# min-maxli:` - {compatibility}
 
 Примеры:
 `.maxlistore weather` - поиск модуля "weather"
@@ -239,7 +862,11 @@ async def show_modules_list(api, message, modules, search_query, repo):
         name = module['name'].replace('.py', '')
         size_kb = module.get('size', 0) / 1024
         
+        meta = format_module_meta(module)
+        
         response.append(f"{i}. {name}")
+        if meta:
+            response.append(f"   🏷 {meta}")
         response.append(f"   📏 {size_kb:.1f} KB")
         response.append(f"   💾 `.maxlistore_download {i}`")
         response.append("")
@@ -268,32 +895,35 @@ async def show_search_results(api, message, modules, search_query, repo):
             )
         
         response.append(f"{i}. {highlighted_name}")
+        meta = format_module_meta(module)
+        if meta:
+            response.append(f"   🏷 {meta}")
         response.append(f"   📏 {size_kb:.1f} KB")
         response.append(f"   💾 `.maxlistore_download {i}`")
         response.append("")
     
-    if len(modules) == 20:
-        response.append("💡 Показано первые 20 результатов")
+    if len(modules) == SEARCH_LIMIT:
+        response.append(f"💡 Показано первые {SEARCH_LIMIT} результатов")
         response.append("🔍 Для более точного поиска уточните запрос")
     
     await api.edit(message, "\n".join(response))
 
 async def show_all_modules(api, message, modules, repo):
     """Показывает все модули в репозитории."""
-    modules_per_page = 15
-    
     response = [f"📦 Все модули в репозитории:\n"]
     response.append(f"📂 Репозиторий: {repo['name']}")
     response.append(f"🔗 Ссылка: {repo['url']}")
     response.append(f"📊 Всего модулей: {len(modules)}\n")
     
-    for i, module in enumerate(modules[:modules_per_page], 1):
+    for i, module in enumerate(modules[:LIST_PAGE_SIZE], 1):
         name = module['name'].replace('.py', '')
         size_kb = module.get('size', 0) / 1024
-        response.append(f"{i}. {name} ({size_kb:.1f} KB)")
+        version = get_module_header(module).get("version")
+        version_text = f" v{version}" if version else ""
+        response.append(f"{i}. {name}{version_text} ({size_kb:.1f} KB)")
     
-    if len(modules) > modules_per_page:
-        response.append(f"\n... и еще {len(modules) - modules_per_page} модулей")
+    if len(modules) > LIST_PAGE_SIZE:
+        response.append(f"\n... и еще {len(modules) - LIST_PAGE_SIZE} модулей")
     
     response.append(f"\n💡 Для скачивания: `.maxlistore_download <номер>`")
     response.append(f"🔍 Для поиска: `.maxlistore_s <часть_названия>`")
@@ -301,94 +931,1317 @@ async def show_all_modules(api, message, modules, repo):
     await api.edit(message, "\n".join(response))
 
 async def download_module(api, message, module, repo):
-    """Скачивает и отправляет модуль."""
+    """Скачивает и отправляет модуль (вместе с зависимостями из репозитория)."""
+    module_name = module['name'].replace('.py', '')
+    await run_job(api, message, f"Модуль {module_name}", lambda: _download_module(api, message, module, repo))
+
+async def _download_module(api, message, module, repo):
+    repo = get_module_repo(module, repo)
     module_name = module['name'].replace('.py', '')
-    await api.edit(message, f"⬇️ Скачиваю модуль '{module_name}'...")
+    progress = new_progress(api, message)
+    await report_progress(progress, f"⬇️ Скачиваю модуль '{module_name}'...")
     
     try:
-        # Получаем raw ссылку на файл
-        download_url = module.get('download_url')
-        if not download_url:
-            download_url = await get_raw_download_url(module, repo["path"])
+        # Скачиваем модуль (из кэша по SHA, если есть) и проверяем его заголовок
+        plan = await build_install_plan(api, [module], repo)
         
-        if not download_url:
-            await api.edit(message, "❌ Не удалось получить ссылку для скачивания")
-            return
+        # Отказываем, только если новее нужен сам модуль; пропущенные зависимости - в подписи
+        for skipped, required in plan["skipped"]:
+            if skipped.get("path", skipped["name"]) == module.get("path", module["name"]):
+                await finish_progress(progress, f"❌ Модуль '{module_name}' требует Maxli {required}+, у вас {get_maxli_version(api)}")
+                return
         
-        # Скачиваем файл
-        file_content = await download_file(download_url)
+        if not plan["modules"]:
+            await finish_progress(progress, "❌ Не удалось скачать файл модуля")
+            return
         
-        if not file_content:
-            await api.edit(message, "❌ Не удалось скачать файл модуля")
+        if len(plan["modules"]) > 1:
+            # Вместе с зависимостями из репозитория отправляем одним архивом
+            await finish_progress(progress)
+            await send_modules_archive(api, message, plan, repo)
             return
         
-        # Сохраняем временно
-        temp_filename = f"{module['name']}"
-        with open(temp_filename, 'w', encoding='utf-8') as f:
-            f.write(file_content)
+        _, file_content = plan["modules"][0]
+        caption = [f"📦 Модуль: {module_name}"]
+        caption.extend(format_plan_notes(plan))
+        caption.append(f"📂 Репозиторий: {repo['name']}")
+        caption.append("⚡ Скачан через Maxli Store")
+        
+        await report_progress(progress, f"📤 Отправляю модуль '{module_name}'...")
         
         # Получаем chat_id из исходного сообщения (исправлено!)
         chat_id = message.chat_id
         
-        # Отправляем файл в ТОТ ЖЕ чат
-        result = await api.send_file(
-            chat_id=chat_id,
-            file_path=temp_filename,
-            text=f"📦 Модуль: {module_name}\n📂 Репозиторий: {repo['name']}\n⚡ Скачан через Maxli Store"
-        )
-        
-        # Очистка
-        os.remove(temp_filename)
+        # Временный файл с именем модуля в отдельной папке - удаляется даже при ошибке
+        async with scratch_file(module['name'], len(file_content)) as temp_filename:
+            with open(temp_filename, 'wb') as f:
+                f.write(file_content)
+            
+            # Отправляем файл в ТОТ ЖЕ чат
+            result = await api.send_file(
+                chat_id=chat_id,
+                file_path=temp_filename,
+                text="\n".join(caption)
+            )
         
         if result:
+            await finish_progress(progress)
             await api.delete(message)
         else:
-            await api.edit(message, "✅ Модуль скачан, но не удалось отправить файл")
+            await finish_progress(progress, "✅ Модуль скачан, но не удалось отправить файл")
             
+    except asyncio.CancelledError:
+        # Отмена через очередь: отложенная правка не должна перекрыть сообщение об отмене
+        await finish_progress(progress)
+        raise
     except Exception as e:
-        await api.edit(message, f"❌ Ошибка загрузки модуля: {str(e)}")
+        await finish_progress(progress, f"❌ Ошибка загрузки модуля: {str(e)}")
 
-async def get_repo_modules(repo_path):
-    """Получает все .py файлы из репозитория."""
+def get_job_position(job):
+    """Место задачи в очереди (1 - следующая) при обходе чатов по кругу."""
+    position = 0
+    queues = [list(queue) for queue in JOB_QUEUES.values()]
+    for round_index in range(max((len(queue) for queue in queues), default=0)):
+        for queue in queues:
+            if round_index < len(queue):
+                position += 1
+                if queue[round_index] == job["id"]:
+                    return position
+    return position
+
+def pump_jobs():
+    """Запускает ждущие задачи, пока есть свободные места; чаты берутся по кругу."""
+    while sum(JOB_RUNNING.values()) < JOB_GLOBAL_LIMIT:
+        for chat_id in list(JOB_QUEUES):
+            if JOB_RUNNING[chat_id] >= JOB_CHAT_LIMIT:
+                continue
+            queue = JOB_QUEUES[chat_id]
+            job = JOBS.get(queue.popleft())
+            # Чат, из которого только что взяли задачу, уходит в конец круга
+            if queue:
+                JOB_QUEUES.move_to_end(chat_id)
+            else:
+                del JOB_QUEUES[chat_id]
+            if job is None or job["state"] != "queued" or job["ready"].done():
+                # Отмененная задача: место достается следующей
+                break
+            JOB_RUNNING[chat_id] += 1
+            job["state"] = "running"
+            job["started_at"] = time.time()
+            job["ready"].set_result(True)
+            break
+        else:
+            break
+    
+    for job in JOBS.values():
+        if job["state"] == "queued" and not job["ready"].done():
+            position = get_job_position(job)
+            if position != job["position"]:
+                job["position"] = position
+                asyncio.create_task(report_queue_position(job))
+
+async def report_queue_position(job):
+    # Задачу могли запустить или отменить, пока правка ждала своей очереди
+    if job["state"] == "queued" and not job["ready"].done():
+        await report_progress(job["progress"], format_queue_position(job))
+
+def format_queue_position(job):
+    return f"⏳ В очереди: {job['position']}-я, выполняется: {sum(JOB_RUNNING.values())}/{JOB_GLOBAL_LIMIT}\n❌ Отменить: `.{JOB_CANCEL_COMMAND} {job['id']}`"
+
+async def run_job(api, message, title, factory):
+    """Выполняет factory() как задачу очереди загрузок.
+    
+    Одновременно выполняется не больше JOB_GLOBAL_LIMIT задач и не больше
+    JOB_CHAT_LIMIT из одного чата; пока места нет, сообщение показывает
+    место в очереди. Отмененная задача прерывается, а ее временные файлы
+    удаляются их контекстными менеджерами.
+    """
+    global JOB_COUNTER
+    JOB_COUNTER += 1
+    chat_id = await get_chat_id(api, message)
+    job = {
+        "id": JOB_COUNTER,
+        "chat_id": chat_id,
+        "title": title,
+        "state": "queued",
+        "position": 0,
+        "created_at": time.time(),
+        "started_at": None,
+        "cancelled": False,
+        "task": None,
+        "ready": asyncio.get_running_loop().create_future(),
+        "progress": new_progress(api, message),
+    }
+    JOBS[job["id"]] = job
+    JOB_QUEUES.setdefault(chat_id, deque()).append(job["id"])
+    pump_jobs()
+    
     try:
-        api_url = f"https://api.github.com/repos/{repo_path}/contents/"
+        await job["ready"]
+        await finish_progress(job["progress"])
+        if job["cancelled"]:
+            raise asyncio.CancelledError()
+        JOB_STATS["started"] += 1
+        # Отдельная задача: .cancel прерывает только эту загрузку, а не обработчик команд
+        job["task"] = asyncio.create_task(factory())
+        return await job["task"]
+    except asyncio.CancelledError:
+        if not job["cancelled"]:
+            raise
+        await finish_progress(job["progress"], "🛑 Загрузка отменена")
+    finally:
+        JOBS.pop(job["id"], None)
+        if job["state"] == "running":
+            JOB_RUNNING[chat_id] -= 1
+            if JOB_RUNNING[chat_id] <= 0:
+                del JOB_RUNNING[chat_id]
+        elif chat_id in JOB_QUEUES:
+            with contextlib.suppress(ValueError):
+                JOB_QUEUES[chat_id].remove(job["id"])
+            if not JOB_QUEUES[chat_id]:
+                del JOB_QUEUES[chat_id]
+        JOB_STATS["finished"] += 1
+        pump_jobs()
+
+def cancel_job(job):
+    job["cancelled"] = True
+    JOB_STATS["cancelled"] += 1
+    if job["state"] == "queued":
+        # Из очереди убираем сразу, а не в finally run_job: иначе pump_jobs
+        # успеет запустить отмененную задачу
+        job["state"] = "cancelled"
+        queue = JOB_QUEUES.get(job["chat_id"])
+        if queue is not None:
+            with contextlib.suppress(ValueError):
+                queue.remove(job["id"])
+            if not queue:
+                del JOB_QUEUES[job["chat_id"]]
+        job["ready"].cancel()
+        pump_jobs()
+    elif job["task"] is not None:
+        job["task"].cancel()
+
+async def maxlistore_jobs_command(api, message, args):
+    """Показывает выполняющиеся и ждущие загрузки."""
+    jobs = [job for job in JOBS.values() if job["state"] != "cancelled"]
+    if not jobs:
+        await api.edit(message, "📭 Загрузок нет")
+        return
+    
+    now = time.time()
+    lines = [f"📋 Загрузки (выполняется {sum(JOB_RUNNING.values())}/{JOB_GLOBAL_LIMIT}):\n"]
+    for job in sorted(jobs, key=lambda j: (j["state"] != "running", j["position"], j["id"])):
+        if job["state"] == "running":
+            state = f"▶️ {now - job['started_at']:.0f} с"
+        else:
+            state = f"⏳ {job['position']}-я в очереди"
+        lines.append(f"#{job['id']} {state} • {job['title']}")
+    lines.append(f"\n❌ Отменить: `.{JOB_CANCEL_COMMAND} <номер>` или `.{JOB_CANCEL_COMMAND} all` - все в этом чате")
+    await api.edit(message, "\n".join(lines))
+
+async def maxlistore_cancel_command(api, message, args):
+    """Отменяет загрузку по номеру (или все загрузки этого чата)."""
+    if not args:
+        await api.edit(message, f"❌ Укажите номер загрузки: .{JOB_CANCEL_COMMAND} 3\n📋 Список: .{JOB_LIST_COMMAND}")
+        return
+    
+    if args[0].lower() == "all":
+        chat_id = await get_chat_id(api, message)
+        jobs = [job for job in JOBS.values() if job["chat_id"] == chat_id and not job["cancelled"]]
+    else:
+        job = JOBS.get(int(args[0])) if args[0].isdigit() else None
+        jobs = [job] if job and not job["cancelled"] else []
+    
+    if not jobs:
+        await api.edit(message, "❌ Нет такой загрузки")
+        return
+    for job in jobs:
+        cancel_job(job)
+    await api.edit(message, f"🛑 Отменено загрузок: {len(jobs)}")
+
+def new_progress(api, message, interval=None):
+    """Состояние сообщения с прогрессом: правки чаще interval склеиваются."""
+    return {
+        "api": api,
+        "message": message,
+        "interval": PROGRESS_INTERVAL if interval is None else interval,
+        "last_at": 0.0,
+        "last_text": None,
+        "pending": None,
+        "timer": None,
+        "lock": asyncio.Lock(),
+    }
+
+async def _send_progress(progress, text):
+    async with progress["lock"]:
+        if text == progress["last_text"]:
+            PROGRESS_STATS["saved"] += 1
+            return
+        progress["last_at"] = time.monotonic()
+        progress["last_text"] = text
+        PROGRESS_STATS["edits"] += 1
+        await progress["api"].edit(progress["message"], text)
+
+async def _flush_progress(progress, delay):
+    await asyncio.sleep(delay)
+    progress["timer"] = None
+    text, progress["pending"] = progress["pending"], None
+    if text is not None:
+        await _send_progress(progress, text)
+
+async def report_progress(progress, text):
+    """Показывает промежуточное состояние.
+    
+    Если с прошлой правки не прошло interval секунд, текст откладывается до
+    конца интервала; более новое состояние заменяет отложенное, а не встает
+    за ним в очередь.
+    """
+    wait = progress["last_at"] + progress["interval"] - time.monotonic()
+    if wait <= 0 and progress["timer"] is None:
+        await _send_progress(progress, text)
+        return
+    if progress["pending"] is not None:
+        PROGRESS_STATS["saved"] += 1
+    progress["pending"] = text
+    if progress["timer"] is None:
+        progress["timer"] = asyncio.create_task(_flush_progress(progress, max(wait, 0)))
+
+async def finish_progress(progress, text=None):
+    """Отменяет отложенную правку и сразу показывает итог, если он передан."""
+    timer, progress["timer"] = progress["timer"], None
+    if timer is not None:
+        timer.cancel()
+    if progress["pending"] is not None:
+        PROGRESS_STATS["saved"] += 1
+        progress["pending"] = None
+    if text is not None:
+        await _send_progress(progress, text)
+
+def get_scratch_root():
+    """Папка для временных файлов модуля (в tmpfs, если он доступен)."""
+    global SCRATCH_ROOT
+    if SCRATCH_ROOT is None:
+        base = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+        SCRATCH_ROOT = os.path.join(base, SCRATCH_DIR_NAME)
+        os.makedirs(SCRATCH_ROOT, exist_ok=True)
+    return SCRATCH_ROOT
+
+def sweep_scratch_dir():
+    """Удаляет временные файлы, оставшиеся после прошлого запуска."""
+    root = get_scratch_root()
+    removed = 0
+    for entry in os.scandir(root):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+@contextlib.asynccontextmanager
+async def scratch_file(filename, size_hint=0):
+    """Выдает уникальный путь для временного файла и гарантированно удаляет его.
+    
+    size_hint резервируется в квоте на время жизни файла; если квота
+    исчерпана, выбрасывается OSError(ENOSPC).
+    """
+    if SCRATCH_STATS["reserved"] + size_hint > SCRATCH_QUOTA:
+        SCRATCH_STATS["rejected"] += 1
+        raise OSError(errno.ENOSPC, "Недостаточно места для временных файлов, попробуйте позже")
+    
+    SCRATCH_STATS["reserved"] += size_hint
+    # Отдельная папка на каждый файл: имя сохраняется, а одновременные загрузки не пересекаются
+    directory = tempfile.mkdtemp(dir=get_scratch_root())
+    try:
+        yield os.path.join(directory, filename)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        SCRATCH_STATS["reserved"] -= size_hint
+
+def load_mirror_manifest():
+    """Загружает описание локального зеркала (один раз за запуск)."""
+    global MIRROR_LOADED
+    if MIRROR_LOADED:
+        return
+    MIRROR_LOADED = True
+    if os.path.exists(MIRROR_MANIFEST_FILE):
+        try:
+            with open(MIRROR_MANIFEST_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                MIRROR_MANIFEST.update(data)
+        except (json.JSONDecodeError, IOError):
+            pass
+
+def save_mirror_manifest():
+    """Сохраняет описание локального зеркала."""
+    try:
+        os.makedirs(MIRROR_DIR, exist_ok=True)
+        temp_path = f"{MIRROR_MANIFEST_FILE}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(MIRROR_MANIFEST, f, ensure_ascii=False)
+        os.replace(temp_path, MIRROR_MANIFEST_FILE)
+    except Exception:
+        pass
+
+def get_mirror_root(repo_path):
+    """Папка зеркала конкретного репозитория."""
+    return os.path.join(MIRROR_DIR, repo_path.replace("/", "__"))
+
+def read_mirror_file(module):
+    """Читает модуль из зеркала, если файл на месте и совпадает с SHA."""
+    try:
+        with open(module["local_path"], 'rb') as f:
+            content = f.read()
+    except OSError:
+        return None
+    if module.get("sha") and git_blob_sha(content) != module["sha"]:
+        return None
+    return content
+
+def scan_mirror_modules(repo_path, root, head_sha):
+    """Строит каталог по файлам зеркала и сразу заполняет кэш заголовков."""
+    modules = []
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            local_path = os.path.join(directory, filename)
+            path = os.path.relpath(local_path, root).replace(os.sep, "/")
+            if not is_catalog_module(path):
+                continue
+            with open(local_path, 'rb') as f:
+                content = f.read()
+            sha = git_blob_sha(content)
+            if sha not in HEADER_CACHE:
+                HEADER_CACHE[sha] = parse_module_header(content[:HEADER_FETCH_BYTES].decode("utf-8", errors="replace"))
+            modules.append({
+                "name": filename,
+                "path": path,
+                "sha": sha,
+                "size": len(content),
+                "download_url": f"{GITHUB_RAW_URL}/{repo_path}/{head_sha}/{quote(path)}" if head_sha else None,
+                "local_path": local_path,
+            })
+    modules.sort(key=lambda m: m["path"])
+    return modules
+
+def extract_archive_to_mirror(archive_path, root):
+    """Распаковывает .py файлы архива в папку зеркала (заменяет ее целиком)."""
+    new_root = f"{root}.new"
+    shutil.rmtree(new_root, ignore_errors=True)
+    with zipfile.ZipFile(archive_path) as archive:
+        names = [name for name in archive.namelist() if not name.endswith("/")]
+        # Архивы GitHub кладут все в папку "<repo>-<ref>/" - ее отрезаем
+        prefix = ""
+        if names and all("/" in name for name in names):
+            first = names[0].split("/", 1)[0] + "/"
+            if all(name.startswith(first) for name in names):
+                prefix = first
+        for name in names:
+            relative = name[len(prefix):]
+            if not relative.endswith(".py"):
+                continue
+            parts = relative.split("/")
+            if relative.startswith("/") or ".." in parts:
+                continue
+            target = os.path.join(new_root, *parts)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with archive.open(name) as source, open(target, 'wb') as destination:
+                shutil.copyfileobj(source, destination)
+    
+    # Подменяем зеркало только после успешной распаковки
+    old_root = f"{root}.old"
+    shutil.rmtree(old_root, ignore_errors=True)
+    if os.path.exists(root):
+        os.replace(root, old_root)
+    os.makedirs(new_root, exist_ok=True)
+    os.replace(new_root, root)
+    shutil.rmtree(old_root, ignore_errors=True)
+
+async def download_repo_archive(repo, ref, archive_path):
+    """Скачивает архив репозитория одним запросом."""
+    session = get_http_session()
+    url = MIRROR_ARCHIVE_URL.format(path=repo["path"], ref=ref)
+    # Архив большого репозитория может качаться дольше обычного таймаута
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    async with session.get(url, timeout=timeout) as response:
+        if response.status != 200:
+            raise Exception(f"HTTP {response.status} при скачивании архива")
+        size = 0
+        with open(archive_path, 'wb') as f:
+            async for chunk in response.content.iter_chunked(256 * 1024):
+                size += len(chunk)
+                if size > MIRROR_ARCHIVE_LIMIT:
+                    raise Exception("Архив репозитория слишком большой")
+                f.write(chunk)
+
+async def sync_repo_mirror(repo, archive_path=None):
+    """Синхронизирует зеркало репозитория.
+    
+    Если передан archive_path, зеркало собирается из локального архива без
+    сети. Иначе сверяется дерево репозитория: несколько измененных файлов
+    качаются по отдельности, а при больших изменениях - один архив.
+    """
+    load_mirror_manifest()
+    load_header_cache()
+    cache_key = f"{repo['path']}@{repo['branch']}"
+    root = get_mirror_root(repo["path"])
+    mirror = MIRROR_MANIFEST.get(cache_key)
+    summary = {"method": "archive", "changed": 0, "removed": 0}
+    
+    if archive_path:
+        await asyncio.to_thread(extract_archive_to_mirror, archive_path, root)
+        head_sha = None
+    else:
+        fresh = await single_flight(
+            f"catalog:{cache_key}",
+            lambda: refresh_repo_modules(repo["path"], repo["branch"])
+        )
+        entry = CATALOG_CACHE.get(cache_key)
+        if repo["path"] in CATALOG_ERRORS or not fresh or not entry:
+            raise Exception(CATALOG_ERRORS.get(repo["path"], "не удалось получить дерево репозитория"))
+        head_sha = entry["head_sha"]
         
-        async with aiohttp.ClientSession() as session:
-            headers = {
-                "User-Agent": "Maxli-Bot/1.0",
-                "Accept": "application/vnd.github.v3+json"
-            }
-            
-            async with session.get(api_url, headers=headers) as response:
-                if response.status == 200:
-                    contents = await response.json()
-                    # Фильтруем только .py файлы
-                    py_files = [item for item in contents if item['type'] == 'file' and item['name'].endswith('.py')]
-                    return py_files
-                else:
-                    return []
-                    
+        old_by_path = {m["path"]: m for m in mirror["modules"]} if mirror else {}
+        changed = [m for m in fresh if old_by_path.get(m["path"], {}).get("sha") != m["sha"]]
+        fresh_paths = {m["path"] for m in fresh}
+        removed = [path for path in old_by_path if path not in fresh_paths]
+        summary["changed"] = len(changed)
+        summary["removed"] = len(removed)
+        
+        if mirror and not changed and not removed:
+            summary["method"] = "none"
+        elif mirror and len(changed) <= MIRROR_INCREMENTAL_LIMIT:
+            # Мало изменений - докачиваем только их (через кэш файлов по SHA)
+            summary["method"] = "files"
+            contents = await asyncio.gather(*(get_module_content(m, m["download_url"]) for m in changed))
+            for module, content in zip(changed, contents):
+                if content is None:
+                    raise Exception(f"не удалось скачать {module['path']}")
+                target = os.path.join(root, *module["path"].split("/"))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, 'wb') as f:
+                    f.write(content)
+            for path in removed:
+                try:
+                    os.remove(os.path.join(root, *path.split("/")))
+                except OSError:
+                    pass
+        else:
+            async with scratch_file("mirror.zip", MIRROR_ARCHIVE_LIMIT) as temp_archive:
+                await download_repo_archive(repo, head_sha, temp_archive)
+                await asyncio.to_thread(extract_archive_to_mirror, temp_archive, root)
+    
+    modules = await asyncio.to_thread(scan_mirror_modules, repo["path"], root, head_sha)
+    MIRROR_MANIFEST[cache_key] = {
+        "head_sha": head_sha,
+        "synced_at": time.time(),
+        "modules": modules,
+    }
+    save_mirror_manifest()
+    save_header_cache()
+    summary["modules"] = len(modules)
+    return summary
+
+def remove_repo_mirror(repo):
+    """Удаляет зеркало и возвращает репозиторий в онлайн режим."""
+    load_mirror_manifest()
+    MIRROR_MANIFEST.pop(f"{repo['path']}@{repo['branch']}", None)
+    save_mirror_manifest()
+    shutil.rmtree(get_mirror_root(repo["path"]), ignore_errors=True)
+
+async def _on_request_start(session, ctx, params):
+    HTTP_STATS["requests"] += 1
+
+async def _on_connection_create_end(session, ctx, params):
+    HTTP_STATS["new_connections"] += 1
+
+async def _on_connection_reuseconn(session, ctx, params):
+    HTTP_STATS["reused_connections"] += 1
+
+async def _on_dns_resolvehost_end(session, ctx, params):
+    HTTP_STATS["dns_lookups"] += 1
+
+def get_http_session():
+    """Возвращает общую HTTP сессию с пулом соединений (создается лениво)."""
+    global HTTP_SESSION, HTTP_SESSION_LOOP
+    loop = asyncio.get_running_loop()
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed and HTTP_SESSION_LOOP is loop:
+        return HTTP_SESSION
+    
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+    trace_config.on_dns_resolvehost_end.append(_on_dns_resolvehost_end)
+    
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_LIMIT,
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=60
+    )
+    HTTP_SESSION = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+        headers={"User-Agent": "Maxli-Bot/1.0"},
+        trace_configs=[trace_config]
+    )
+    HTTP_SESSION_LOOP = loop
+    return HTTP_SESSION
+
+async def close_http_session():
+    """Закрывает общую HTTP сессию и все соединения пула.
+    
+    Хука выгрузки у загрузчика Maxli нет, поэтому сессия закрывается только
+    при повторной регистрации этого же модуля (см. register).
+    """
+    global HTTP_SESSION
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed:
+        await HTTP_SESSION.close()
+    HTTP_SESSION = None
+
+def get_http_stats():
+    """Возвращает статистику пула соединений."""
+    stats = dict(HTTP_STATS)
+    connections = stats["new_connections"] + stats["reused_connections"]
+    stats["reuse_ratio"] = stats["reused_connections"] / connections if connections else 0.0
+    
+    open_connections = 0
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed:
+        connector = HTTP_SESSION.connector
+        # Простаивающие keep-alive соединения + занятые в данный момент
+        open_connections = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+        open_connections += len(getattr(connector, "_acquired", ()))
+    stats["open_connections"] = open_connections
+    return stats
+
+def load_catalog_cache():
+    """Загружает кэш каталога из JSON файла (один раз за запуск)."""
+    global CACHE_LOADED
+    if CACHE_LOADED:
+        return
+    CACHE_LOADED = True
+    if os.path.exists(CACHE_FILE):
+        try:
+            with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                CATALOG_CACHE.update(data)
+        except (json.JSONDecodeError, IOError):
+            # Поврежденный кэш просто игнорируем - каталог скачается заново
+            pass
+
+def save_catalog_cache():
+    """Сохраняет кэш каталога в JSON файл."""
+    try:
+        temp_path = f"{CACHE_FILE}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(CATALOG_CACHE, f, ensure_ascii=False)
+        os.replace(temp_path, CACHE_FILE)
+    except Exception:
+        # Кэш - не критичная вещь, ошибки записи не должны ломать команды
+        pass
+
+def get_cache_stats():
+    """Возвращает счетчики попаданий/промахов кэша каталога."""
+    stats = dict(CACHE_STATS)
+    total = stats["hits"] + stats["stale"] + stats["misses"]
+    stats["hit_ratio"] = (stats["hits"] + stats["stale"]) / total if total else 0.0
+    return stats
+
+def load_header_cache():
+    """Загружает кэш заголовков модулей из JSON файла (один раз за запуск)."""
+    global HEADERS_LOADED
+    if HEADERS_LOADED:
+        return
+    HEADERS_LOADED = True
+    if os.path.exists(HEADERS_FILE):
+        try:
+            with open(HEADERS_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                HEADER_CACHE.update(data)
+        except (json.JSONDecodeError, IOError):
+            pass
+
+def save_header_cache():
+    """Сохраняет кэш заголовков модулей в JSON файл."""
+    try:
+        temp_path = f"{HEADERS_FILE}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(HEADER_CACHE, f, ensure_ascii=False)
+        os.replace(temp_path, HEADERS_FILE)
     except Exception:
+        pass
+
+def get_module_header(module):
+    """Возвращает заголовок модуля, если он уже собран."""
+    return HEADER_CACHE.get(module.get("sha")) or {}
+
+def parse_module_header(text):
+    """Разбирает блок комментариев '# ключ: значение' в начале модуля."""
+    header = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith("#"):
+            break
+        match = re.match(r"#\s*([\w-]+)\s*:\s*(.*)", line)
+        if match:
+            header[match.group(1).lower()] = match.group(2).strip()
+    return header
+
+async def fetch_module_header(module, semaphore):
+    """Читает только начало файла (Range запрос) и разбирает заголовок."""
+    async with semaphore:
+        session = get_http_session()
+        headers = {"Range": f"bytes=0-{HEADER_FETCH_BYTES - 1}"}
+        async with session.get(module["download_url"], headers=headers) as response:
+            if response.status not in (200, 206):
+                raise Exception(f"HTTP {response.status}")
+            # Если сервер проигнорировал Range, все равно читаем только начало
+            data = b""
+            while len(data) < HEADER_FETCH_BYTES:
+                chunk = await response.content.read(HEADER_FETCH_BYTES - len(data))
+                if not chunk:
+                    break
+                data += chunk
+    
+    text = data[:HEADER_FETCH_BYTES].decode("utf-8", errors="replace")
+    if len(data) >= HEADER_FETCH_BYTES and "\n" in text:
+        # Последняя строка могла обрезаться на середине
+        text = text.rsplit("\n", 1)[0]
+    return parse_module_header(text)
+
+async def harvest_module_headers(modules):
+    """Собирает заголовки всех модулей, которых еще нет в кэше."""
+    global HEADER_REVISION
+    semaphore = asyncio.Semaphore(HEADER_CONCURRENCY)
+    pending = [
+        module for module in modules
+        if module.get("sha") and module.get("download_url") and module["sha"] not in HEADER_CACHE
+    ]
+    if not pending:
+        return
+    
+    results = await asyncio.gather(
+        *(fetch_module_header(module, semaphore) for module in pending),
+        return_exceptions=True
+    )
+    for module, header in zip(pending, results):
+        if isinstance(header, Exception):
+            HEADER_STATS["failed"] += 1
+            continue
+        HEADER_STATS["fetched"] += 1
+        HEADER_CACHE[module["sha"]] = header
+    
+    HEADER_REVISION += 1
+    save_header_cache()
+
+def schedule_header_harvest(cache_key, modules):
+    """Запускает фоновый сбор заголовков для нового списка модулей."""
+    current = HEADER_TASKS.get(cache_key)
+    if current and current[0] is modules:
+        return
+    HEADER_TASKS[cache_key] = (modules, asyncio.create_task(harvest_module_headers(modules)))
+
+def format_module_meta(module):
+    """Строка с версией, автором и минимальной версией Maxli из заголовка."""
+    header = get_module_header(module)
+    parts = []
+    if header.get("version"):
+        parts.append(f"v{header['version']}")
+    if header.get("developer"):
+        parts.append(f"👤 {header['developer']}")
+    if header.get("min-maxli"):
+        parts.append(f"⚙️ Maxli {header['min-maxli']}+")
+    if module.get("repo"):
+        parts.append(f"📂 {module['repo']}")
+    return " • ".join(parts)
+
+def normalize_search_text(text):
+    """Приводит строку к виду для поиска: нижний регистр, без .py и разделителей."""
+    text = text.lower()
+    if text.endswith(".py"):
+        text = text[:-3]
+    return re.sub(r"[\s_\-./]+", " ", text).strip()
+
+def get_trigrams(text):
+    """Возвращает множество триграмм строки."""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def levenshtein(a, b, max_distance=None):
+    """Расстояние Левенштейна между двумя строками.
+    
+    Если задан max_distance, считает только пока ответ может в него уложиться,
+    иначе сразу возвращает max_distance + 1.
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if max_distance is not None and len(a) - len(b) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ca != cb)
+            ))
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+def get_module_search_fields(module):
+    """Собирает поля модуля, по которым идет поиск."""
+    header = get_module_header(module)
+    fields = {"file": normalize_search_text(module["name"])}
+    if header.get("name"):
+        fields["name"] = normalize_search_text(header["name"])
+    if header.get("developer"):
+        fields["developer"] = normalize_search_text(header["developer"])
+    return fields
+
+def build_search_index(modules):
+    """Строит индекс по списку модулей.
+    
+    Поля склеиваются в одну строку, чтобы подстроки искались одним проходом
+    регулярного выражения, а триграммы нужны для поиска с опечатками.
+    """
+    docs = []
+    postings = {}
+    gram_counts = []
+    spaced = {"parts": [], "entries": [], "starts": [], "offset": 0}
+    # Слитное написание: "speedtest" должен находить "speed_test"
+    compact = {"parts": [], "entries": [], "starts": [], "offset": 0}
+    for doc_id, module in enumerate(modules):
+        fields = get_module_search_fields(module)
+        docs.append(fields)
+        grams = set()
+        for field, text in fields.items():
+            grams |= get_trigrams(text)
+            variants = [(spaced, text)]
+            if " " in text:
+                variants.append((compact, text.replace(" ", "")))
+            for blob, variant in variants:
+                blob["entries"].append((doc_id, field, variant))
+                blob["starts"].append(blob["offset"])
+                blob["parts"].append(variant)
+                blob["offset"] += len(variant) + 1
+        gram_counts.append(len(grams))
+        for gram in grams:
+            postings.setdefault(gram, []).append(doc_id)
+    for blob in (spaced, compact):
+        blob["text"] = "\n".join(blob.pop("parts"))
+        del blob["offset"]
+    return {
+        "modules": modules,
+        "revision": HEADER_REVISION,
+        "docs": docs,
+        "postings": postings,
+        "gram_counts": gram_counts,
+        "spaced": spaced,
+        "compact": compact,
+        "results": {},
+    }
+
+def get_search_index(repo, modules):
+    """Возвращает индекс для текущей версии каталога (строит один раз)."""
+    key = f"{repo['path']}@{repo['branch']}"
+    index = SEARCH_INDEXES.get(key)
+    if index is None or index["modules"] is not modules or index["revision"] != HEADER_REVISION:
+        index = build_search_index(modules)
+        SEARCH_INDEXES[key] = index
+    return index
+
+def score_substring(query, text, pos):
+    """Оценивает найденную подстроку: полное совпадение > начало > начало слова > середина."""
+    if pos == 0:
+        score = 1.0 if len(query) == len(text) else 0.95
+    elif text[pos - 1] == " ":
+        score = 0.9
+    else:
+        score = 0.85
+    # Из двух модулей с совпадением короткое имя точнее
+    return score * (0.9 + 0.1 * len(query) / len(text))
+
+def score_fuzzy(query, text, min_score):
+    """Оценивает похожесть строки на запрос с учетом опечаток (0, если ниже min_score)."""
+    best = 0.0
+    # Сравниваем с целым полем и с каждым словом; слово чуть менее точное совпадение
+    words = [(text, 0.8)] + [(word, 0.76) for word in text.split() if word != text]
+    for word, factor in words:
+        longest = max(len(query), len(word))
+        max_distance = int(longest * (1 - min_score / factor))
+        if max_distance < 0:
+            continue
+        distance = levenshtein(query, word, max_distance)
+        if distance <= max_distance:
+            best = max(best, factor * (1 - distance / longest))
+    return best
+
+def collect_substring_scores(blob, query, scores):
+    """Находит все вхождения запроса одним проходом по склеенной строке."""
+    entries = blob["entries"]
+    starts = blob["starts"]
+    for match in re.finditer(re.escape(query), blob["text"]):
+        entry_id = bisect.bisect_right(starts, match.start()) - 1
+        doc_id, field, text = entries[entry_id]
+        score = score_substring(query, text, match.start() - starts[entry_id]) * SEARCH_FIELD_WEIGHTS[field]
+        if score > scores.get(doc_id, 0):
+            scores[doc_id] = score
+
+def search_modules(repo, modules, query, limit=SEARCH_LIMIT):
+    """Ищет модули по имени файла и полям заголовка, лучшие результаты первыми."""
+    query = normalize_search_text(query)
+    if not query:
         return []
+    index = get_search_index(repo, modules)
+    cache_key = (query, limit)
+    if cache_key in index["results"]:
+        return index["results"][cache_key]
+    
+    scores = {}
+    
+    collect_substring_scores(index["spaced"], query, scores)
+    if " " not in query and (limit is None or len(scores) < limit):
+        collect_substring_scores(index["compact"], query, scores)
+    
+    # Опечатки: если точных совпадений мало, берем модули с наибольшей долей общих триграмм
+    query_grams = get_trigrams(query)
+    if query_grams and (limit is None or len(scores) < limit):
+        overlap = Counter()
+        for gram in query_grams:
+            overlap.update(index["postings"].get(gram, ()))
+        gram_counts = index["gram_counts"]
+        
+        def similarity(doc_id):
+            common = overlap[doc_id]
+            return common / (len(query_grams) + gram_counts[doc_id] - common)
+        
+        # Модуль с одной случайной общей триграммой на опечатку не похож
+        min_common = max(1, -(-len(query_grams) // 3))
+        candidates = heapq.nlargest(
+            SEARCH_RERANK,
+            (doc_id for doc_id, common in overlap.items() if common >= min_common and doc_id not in scores),
+            key=similarity
+        )
+        for doc_id in candidates:
+            for field, text in index["docs"][doc_id].items():
+                weight = SEARCH_FIELD_WEIGHTS[field]
+                score = score_fuzzy(query, text, SEARCH_MIN_SCORE / weight) * weight
+                if score >= SEARCH_MIN_SCORE and score > scores.get(doc_id, 0):
+                    scores[doc_id] = score
+    
+    # При равной оценке сохраняем порядок каталога
+    ranked = ((score, -doc_id) for doc_id, score in scores.items())
+    if limit is None:
+        best = sorted(ranked, reverse=True)
+    else:
+        best = heapq.nlargest(limit, ranked)
+    result = [modules[-neg_id] for _, neg_id in best]
+    
+    if len(index["results"]) >= 256:
+        index["results"].clear()
+    index["results"][cache_key] = result
+    return result
+
+async def get_repo_modules(repo_path, branch=DEFAULT_BRANCH):
+    """Получает все .py файлы из репозитория (через кэш каталога)."""
+    load_catalog_cache()
+    load_header_cache()
+    load_mirror_manifest()
+    cache_key = f"{repo_path}@{branch}"
+    
+    # Синхронизированное зеркало отвечает без обращения к сети
+    mirror = MIRROR_MANIFEST.get(cache_key)
+    if mirror:
+        CACHE_STATS["mirror"] += 1
+        return mirror["modules"]
+    
+    entry = CATALOG_CACHE.get(cache_key)
+    if entry:
+        age = time.time() - entry.get("fetched_at", 0)
+        if age < CATALOG_TTL:
+            CACHE_STATS["hits"] += 1
+        else:
+            # Отдаем устаревший каталог сразу, а свежий подтягиваем в фоне
+            CACHE_STATS["stale"] += 1
+            schedule_catalog_refresh(repo_path, branch)
+        modules = entry["modules"]
+    else:
+        CACHE_STATS["misses"] += 1
+        # Если каталог уже запрашивает другой чат - ждем тот же запрос
+        modules = await single_flight(
+            f"catalog:{cache_key}",
+            lambda: refresh_repo_modules(repo_path, branch)
+        )
+    
+    # Заголовки подтягиваются в фоне и не задерживают ответ команды
+    if modules:
+        schedule_header_harvest(cache_key, modules)
+    return modules
+
+def record_repo_result(repo_path, ok, latency):
+    """Обновляет задержку (EWMA) и число ошибок репозитория."""
+    stats = REPO_STATS.setdefault(repo_path, {"requests": 0, "errors": 0, "latency": 0.0})
+    stats["requests"] += 1
+    if not ok:
+        stats["errors"] += 1
+        return
+    if stats["latency"]:
+        stats["latency"] = stats["latency"] * 0.8 + latency * 0.2
+    else:
+        stats["latency"] = latency
+
+def get_module_repo(module, default=None):
+    """Возвращает репозиторий, из которого пришел модуль."""
+    repo_path = module.get("repo")
+    for repo in REPOSITORIES:
+        if repo["path"] == repo_path:
+            return repo
+    return default or get_current_repo()
+
+def get_catalog_view():
+    """Описание каталога для вывода: один репозиторий или все сразу."""
+    if len(REPOSITORIES) == 1:
+        return REPOSITORIES[0]
+    return {
+        "name": f"все репозитории ({len(REPOSITORIES)})",
+        "path": "*",
+        "branch": "*",
+        "url": ", ".join(repo["url"] for repo in REPOSITORIES),
+    }
+
+def _consume_task_result(task):
+    # Опоздавшие запросы дорабатывают в фоне, их ошибки уже учтены в статистике
+    if not task.cancelled():
+        task.exception()
+
+async def get_all_modules():
+    """Опрашивает все репозитории параллельно и объединяет их каталоги.
+    
+    Медленные репозитории не задерживают ответ дольше FEDERATION_TIMEOUT:
+    их запрос продолжается в фоне и попадет в кэш к следующей команде.
+    """
+    repos = sorted(REPOSITORIES, key=lambda r: r["priority"])
+    if len(repos) == 1:
+        return repos[0], await get_repo_modules(repos[0]["path"], repos[0]["branch"])
+    
+    tasks = [asyncio.ensure_future(get_repo_modules(repo["path"], repo["branch"])) for repo in repos]
+    done, pending = await asyncio.wait(tasks, timeout=FEDERATION_TIMEOUT)
+    for task in pending:
+        task.add_done_callback(_consume_task_result)
+    
+    sources = []
+    for repo, task in zip(repos, tasks):
+        if task in done and not task.exception():
+            sources.append((repo["path"], task.result()))
+    
+    source_lists = tuple(modules for _, modules in sources)
+    cached = FEDERATED_CATALOG["sources"]
+    if len(cached) == len(source_lists) and all(a is b for a, b in zip(cached, source_lists)):
+        return get_catalog_view(), FEDERATED_CATALOG["modules"]
+    
+    # Один и тот же модуль (тот же путь или `# id:`) берем из репозитория с большим
+    # приоритетом; внутри одного репозитория оставляем все, включая одноименные
+    # файлы из разных папок
+    merged = []
+    owners = {}
+    for repo_path, modules in sources:
+        for module in modules:
+            keys = [f"path:{module.get('path', module['name'])}"]
+            module_id = get_module_header(module).get("id")
+            if module_id:
+                keys.append(f"id:{module_id}")
+            if any(owners.get(key, repo_path) != repo_path for key in keys):
+                continue
+            for key in keys:
+                owners.setdefault(key, repo_path)
+            merged.append({**module, "repo": repo_path})
+    
+    FEDERATED_CATALOG["sources"] = source_lists
+    FEDERATED_CATALOG["modules"] = merged
+    return get_catalog_view(), merged
 
-async def get_raw_download_url(module, repo_path):
+def get_inflight_request(key, factory):
+    """Возвращает уже идущий запрос с этим ключом или запускает новый."""
+    task = INFLIGHT_REQUESTS.get(key)
+    if task is not None:
+        GITHUB_STATS["coalesced"] += 1
+        return task
+    GITHUB_STATS["started"] += 1
+    task = asyncio.ensure_future(factory())
+    INFLIGHT_REQUESTS[key] = task
+    task.add_done_callback(lambda _: INFLIGHT_REQUESTS.pop(key, None))
+    return task
+
+async def single_flight(key, factory):
+    """Выполняет запрос один раз для всех, кто попросил его одновременно."""
+    # shield: отмена одной команды не должна отменять запрос для остальных
+    return await asyncio.shield(get_inflight_request(key, factory))
+
+def schedule_catalog_refresh(repo_path, branch=DEFAULT_BRANCH):
+    """Запускает фоновое обновление каталога, если оно еще не идет."""
+    task = get_inflight_request(
+        f"catalog:{repo_path}@{branch}",
+        lambda: refresh_repo_modules(repo_path, branch)
+    )
+    task.add_done_callback(_consume_task_result)
+
+def check_rate_limit():
+    """Не дает отправить запрос, если лимит GitHub почти исчерпан."""
+    remaining = RATE_LIMIT["remaining"]
+    if remaining is None or remaining > RATE_LIMIT_RESERVE:
+        return
+    wait = RATE_LIMIT["reset"] - time.time()
+    if wait <= 0:
+        # Окно лимита уже сбросилось
+        RATE_LIMIT["remaining"] = None
+        return
+    GITHUB_STATS["rate_limited"] += 1
+    raise Exception(f"лимит запросов к GitHub исчерпан, сброс через {int(wait // 60) + 1} мин")
+
+def check_github_response(response):
+    """Запоминает лимиты из заголовков ответа и объясняет неудачный статус."""
+    remaining = response.headers.get("X-RateLimit-Remaining")
+    reset = response.headers.get("X-RateLimit-Reset")
+    if remaining is not None and remaining.isdigit():
+        RATE_LIMIT["remaining"] = int(remaining)
+    if reset is not None and reset.isdigit():
+        RATE_LIMIT["reset"] = int(reset)
+    
+    if response.status in (200, 304):
+        return
+    if response.status in (403, 429) and RATE_LIMIT["remaining"] == 0:
+        check_rate_limit()
+        raise Exception("лимит запросов к GitHub исчерпан")
+    if response.status == 404:
+        raise Exception("репозиторий или ветка не найдены")
+    raise Exception(f"GitHub ответил HTTP {response.status}")
+
+def format_catalog_error():
+    """Причины, по которым не загрузился каталог, для сообщения пользователю."""
+    reasons = [f"{path}: {reason}" for path, reason in CATALOG_ERRORS.items()]
+    if not reasons:
+        return ""
+    return "\n⚠️ Причина: " + "; ".join(reasons)
+
+async def refresh_repo_modules(repo_path, branch=DEFAULT_BRANCH):
+    """Обновляет каталог: сверяет SHA ветки и при изменении читает все дерево одним запросом."""
+    cache_key = f"{repo_path}@{branch}"
+    entry = CATALOG_CACHE.get(cache_key)
+    started = time.monotonic()
+    try:
+        session = get_http_session()
+        headers = {
+            "Accept": "application/vnd.github.v3+json"
+        }
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        
+        # Сначала узнаем SHA головы ветки - это маленький и дешевый запрос
+        check_rate_limit()
+        ref_url = f"{GITHUB_API_URL}/repos/{repo_path}/git/ref/heads/{branch}"
+        async with session.get(ref_url, headers=headers) as response:
+            CACHE_STATS["refreshes"] += 1
+            check_github_response(response)
+            if response.status == 304 and entry:
+                # Ветка не изменилась - JSON не парсим
+                CACHE_STATS["not_modified"] += 1
+                entry["fetched_at"] = time.time()
+                save_catalog_cache()
+                record_repo_result(repo_path, True, time.monotonic() - started)
+                CATALOG_ERRORS.pop(repo_path, None)
+                return entry["modules"]
+            if response.status != 200:
+                raise Exception(f"GitHub ответил HTTP {response.status}")
+            ref = await response.json()
+            etag = response.headers.get("ETag")
+        
+        head_sha = ref["object"]["sha"]
+        if entry and entry.get("head_sha") == head_sha:
+            # Новый ETag, но тот же коммит - дерево перечитывать не нужно
+            CACHE_STATS["head_unchanged"] += 1
+            entry["etag"] = etag
+            entry["fetched_at"] = time.time()
+            save_catalog_cache()
+            record_repo_result(repo_path, True, time.monotonic() - started)
+            CATALOG_ERRORS.pop(repo_path, None)
+            return entry["modules"]
+        
+        # Все дерево репозитория (включая подпапки) за один запрос
+        check_rate_limit()
+        tree_url = f"{GITHUB_API_URL}/repos/{repo_path}/git/trees/{head_sha}?recursive=1"
+        async with session.get(tree_url, headers={"Accept": "application/vnd.github.v3+json"}) as response:
+            CACHE_STATS["refreshes"] += 1
+            check_github_response(response)
+            tree = await response.json()
+        
+        if tree.get("truncated"):
+            print(f"⚠️ Maxli Store: дерево {repo_path} слишком большое, GitHub вернул его не полностью")
+        
+        # Фильтруем только .py файлы
+        py_files = [
+            {
+                "name": item["path"].rsplit("/", 1)[-1],
+                "path": item["path"],
+                "sha": item.get("sha"),
+                "size": item.get("size", 0),
+                # Ссылка привязана к коммиту, чтобы файл совпадал с каталогом
+                "download_url": f"{GITHUB_RAW_URL}/{repo_path}/{head_sha}/{quote(item['path'])}",
+            }
+            for item in tree.get("tree", [])
+            if item.get("type") == "blob" and is_catalog_module(item["path"])
+        ]
+        CATALOG_CACHE[cache_key] = {
+            "etag": etag,
+            "head_sha": head_sha,
+            "fetched_at": time.time(),
+            "modules": py_files,
+        }
+        save_catalog_cache()
+        record_repo_result(repo_path, True, time.monotonic() - started)
+        CATALOG_ERRORS.pop(repo_path, None)
+        return py_files
+    
+    except asyncio.TimeoutError:
+        reason = "GitHub не ответил вовремя"
+    except aiohttp.ClientError as e:
+        reason = f"нет соединения с GitHub ({e.__class__.__name__})"
+    except Exception as e:
+        reason = str(e)
+    
+    record_repo_result(repo_path, False, time.monotonic() - started)
+    CATALOG_ERRORS[repo_path] = reason
+    print(f"Maxli Store: не удалось обновить каталог {repo_path}: {reason}")
+    # При ошибке (в том числе при исчерпанном лимите) лучше показать старый каталог, чем пустой
+    return entry["modules"] if entry else []
+
+def is_catalog_module(path):
+    """Файл попадает в каталог, если это .py вне служебных папок."""
+    return path.endswith(".py") and not CATALOG_IGNORED_DIRS.intersection(path.split("/")[:-1])
+
+async def get_raw_download_url(module, repo_path, branch=DEFAULT_BRANCH):
     """Генерирует raw ссылку для скачивания."""
-    file_path = module['path']
-    return f"https://raw.githubusercontent.com/{repo_path}/main/{file_path}"
+    file_path = quote(module['path'])
+    return f"{GITHUB_RAW_URL}/{repo_path}/{branch}/{file_path}"
 
 async def download_file(url):
     """Скачивает содержимое файла."""
-    async with aiohttp.ClientSession() as session:
-        headers = {"User-Agent": "Maxli-Bot/1.0"}
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                return await response.text()
+    session = get_http_session()
+    async with session.get(url) as response:
+        if response.status == 200:
+            return await response.read()
     return None
 
+def git_blob_sha(content):
+    """Считает SHA файла так же, как git (sha1 от 'blob <размер>\\0' + содержимое)."""
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+def read_cached_blob(sha):
+    """Возвращает файл из кэша, если он есть и совпадает с SHA."""
+    path = os.path.join(BLOB_DIR, sha)
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+    except OSError:
+        return None
+    
+    if git_blob_sha(content) != sha:
+        # Файл поврежден - удаляем и качаем заново
+        BLOB_STATS["corrupted"] += 1
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    
+    # Время изменения файла служит меткой последнего использования для LRU
+    os.utime(path)
+    return content
+
+def write_cached_blob(sha, content):
+    """Кладет файл в кэш и вытесняет давно не использованные."""
+    try:
+        os.makedirs(BLOB_DIR, exist_ok=True)
+        path = os.path.join(BLOB_DIR, sha)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+        evict_blob_cache()
+    except OSError:
+        # Без кэша модуль все равно будет отправлен
+        pass
+
+def evict_blob_cache():
+    """Удаляет самые старые по использованию файлы, пока кэш больше лимита."""
+    entries = []
+    total = 0
+    for entry in os.scandir(BLOB_DIR):
+        if entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+    
+    entries.sort()
+    for _, size, path in entries:
+        if total <= BLOB_CACHE_LIMIT:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            BLOB_STATS["evicted"] += 1
+        except OSError:
+            pass
+
+async def get_module_content(module, download_url):
+    """Возвращает содержимое модуля: из зеркала, из кэша по blob SHA или из сети."""
+    sha = module.get("sha")
+    if module.get("local_path"):
+        content = read_mirror_file(module)
+        if content is not None:
+            BLOB_STATS["mirror"] += 1
+            return content
+    if sha:
+        content = read_cached_blob(sha)
+        if content is not None:
+            BLOB_STATS["hits"] += 1
+            return content
+    
+    BLOB_STATS["misses"] += 1
+    content = await single_flight(f"blob:{sha or download_url}", lambda: download_file(download_url))
+    if content is None:
+        return None
+    
+    if sha:
+        if git_blob_sha(content) == sha:
+            write_cached_blob(sha, content)
+        else:
+            # Файл в ветке мог измениться после загрузки каталога - не кэшируем
+            print(f"⚠️ Maxli Store: SHA файла {module['path']} не совпадает с каталогом")
+    return content
+
 async def register(api):
-    """Регистрирует команды модуля."""
+    """Регистрирует команды модуля и чистит временные файлы прошлого запуска."""
+    # Если модуль регистрируется повторно, соединения прошлой регистрации не нужны
+    await close_http_session()
+    sweep_scratch_dir()
     api.register_command("maxlistore", maxlistore_command)
     api.register_command("maxlistore_s", maxlistore_s_command)
     api.register_command("maxlistore_download", maxlistore_download_command)
+    api.register_command("maxlistore_bundle", maxlistore_bundle_command)
     api.register_command("maxlistore_list", maxlistore_list_command)
-    api.register_command("maxlistore_repo", maxlistore_repo_command)
\ No newline at end of file
+    api.register_command("maxlistore_repo", maxlistore_repo_command)
+    api.register_command("maxlistore_sync", maxlistore_sync_command)
+    api.register_command("maxlistore_stats", maxlistore_stats_command)
+    api.register_command("maxlistore_updates", maxlistore_updates_command)
+    api.register_command(JOB_LIST_COMMAND, maxlistore_jobs_command)
+    api.register_command(JOB_CANCEL_COMMAND, maxlistore_cancel_command)
\ No newline at end of file
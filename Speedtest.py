@@ -1,5 +1,5 @@
 # name: SpeedTest
-# version: 1.0.0
+# version: 1.1.0
 # developer: @gemeguardian
 # dependencies: speedtest-cli
 # min-maxli: 26
@@ -9,6 +9,11 @@ import time
 import asyncio
 import sys
 
+# --- Прогресс ---
+PROGRESS_INTERVAL = 2.0  # Не чаще одной правки сообщения за столько секунд
+
+PROGRESS_STATS = {"edits": 0, "saved": 0}
+
 STRINGS = {
     "ru": {
         "no_speedtest": (
@@ -116,6 +121,64 @@ def get_moscow_time():
     moscow_time = utc_now + moscow_offset
     return moscow_time.strftime("%d.%m.%Y %H:%M:%S")
 
+def new_progress(api, message, interval=None):
+    """Состояние сообщения с прогрессом: правки чаще interval склеиваются."""
+    return {
+        "api": api,
+        "message": message,
+        "interval": PROGRESS_INTERVAL if interval is None else interval,
+        "last_at": 0.0,
+        "last_text": None,
+        "pending": None,
+        "timer": None,
+        "lock": asyncio.Lock(),
+    }
+
+async def _send_progress(progress, text):
+    async with progress["lock"]:
+        if text == progress["last_text"]:
+            PROGRESS_STATS["saved"] += 1
+            return
+        progress["last_at"] = time.monotonic()
+        progress["last_text"] = text
+        PROGRESS_STATS["edits"] += 1
+        await progress["api"].edit(progress["message"], text)
+
+async def _flush_progress(progress, delay):
+    await asyncio.sleep(delay)
+    progress["timer"] = None
+    text, progress["pending"] = progress["pending"], None
+    if text is not None:
+        await _send_progress(progress, text)
+
+async def report_progress(progress, text):
+    """Показывает промежуточное состояние.
+    
+    Если с прошлой правки не прошло interval секунд, текст откладывается до
+    конца интервала; более новое состояние заменяет отложенное, а не встает
+    за ним в очередь.
+    """
+    wait = progress["last_at"] + progress["interval"] - time.monotonic()
+    if wait <= 0 and progress["timer"] is None:
+        await _send_progress(progress, text)
+        return
+    if progress["pending"] is not None:
+        PROGRESS_STATS["saved"] += 1
+    progress["pending"] = text
+    if progress["timer"] is None:
+        progress["timer"] = asyncio.create_task(_flush_progress(progress, max(wait, 0)))
+
+async def finish_progress(progress, text=None):
+    """Отменяет отложенную правку и сразу показывает итог, если он передан."""
+    timer, progress["timer"] = progress["timer"], None
+    if timer is not None:
+        timer.cancel()
+    if progress["pending"] is not None:
+        PROGRESS_STATS["saved"] += 1
+        progress["pending"] = None
+    if text is not None:
+        await _send_progress(progress, text)
+
 async def speedtest_command(api, message, args):
     """Выполняет тест скорости интернета."""
     try:
@@ -132,22 +195,23 @@ async def speedtest_command(api, message, args):
         await api.edit(message, get_string("no_speedtest"))
         return
     
-    await api.edit(message, get_string("starting_test"))
+    progress = new_progress(api, message)
+    await report_progress(progress, get_string("starting_test"))
     start_time = time.monotonic()
     
     try:
         st = await asyncio.to_thread(speedtest.Speedtest)
         
-        await api.edit(message, get_string("selecting_server"))
+        await report_progress(progress, get_string("selecting_server"))
         await asyncio.to_thread(st.get_best_server)
         
-        await api.edit(message, get_string("testing_download"))
+        await report_progress(progress, get_string("testing_download"))
         await asyncio.to_thread(st.download)
         
-        await api.edit(message, get_string("testing_upload"))
+        await report_progress(progress, get_string("testing_upload"))
         await asyncio.to_thread(st.upload)
         
-        await api.edit(message, get_string("finalizing_results"))
+        await report_progress(progress, get_string("finalizing_results"))
         
         end_time = time.monotonic()
         test_duration = end_time - start_time
@@ -185,11 +249,11 @@ async def speedtest_command(api, message, args):
             time_msk=current_time_msk
         )
         
-        await api.edit(message, result_text)
+        await finish_progress(progress, result_text)
         
     except Exception as e:
         error_text = get_string("error").format(str(e))
-        await api.edit(message, error_text)
+        await finish_progress(progress, error_text)
 
 async def register(api):
     """Регистрирует команды модуля."""
@@ -1,5 +1,5 @@
 # name: TikTok Downloader
-# version: 1.2.0
+# version: 1.12.0
 # developer: Kerdik
 # id: tiktok_downloader
 # dependencies: requests, aiofiles
@@ -7,89 +7,989 @@
 
 import aiohttp
 import aiofiles
+import asyncio
+import contextlib
+import errno
+import inspect
 import os
 import re
 import json
+import shutil
+import tempfile
+import time
+from collections import Counter, OrderedDict, deque
 from urllib.parse import urlparse, urljoin
 
+# --- Общий HTTP клиент ---
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+PROVIDER_TIMEOUT = 15  # Таймаут запроса к API провайдера (сек)
+HTTP_LIMIT = 20  # Всего соединений в пуле
+HTTP_LIMIT_PER_HOST = 6  # Соединений на один хост
+DNS_CACHE_TTL = 300  # Сколько секунд помнить DNS ответы
+
+MAX_VIDEO_SIZE = 50 * 1024 * 1024  # Лимит размера отправляемого видео (бюджет при выборе качества)
+# Варианты видео от лучшего к худшему (названия полей tikwm)
+QUALITY_ORDER = ["hdplay", "play", "wmplay"]
+
+# --- Загрузка по частям ---
+RANGE_PART_SIZE = 2 * 1024 * 1024  # Размер одной части; файлы не больше нее приходят одним запросом
+RANGE_CONCURRENCY = 4  # Сколько частей качаем одновременно
+RANGE_RETRIES = 3  # Сколько раз повторяем одну часть (с места обрыва)
+
+DOWNLOAD_STATS = {"ranged": 0, "single": 0, "retries": 0}
+
+HTTP_SESSION = None
+HTTP_SESSION_LOOP = None
+HTTP_STATS = {"requests": 0, "new_connections": 0, "reused_connections": 0, "dns_lookups": 0}
+
+# --- Провайдеры ---
+PROVIDER_STATS_FILE = "tiktok_providers.json"
+HEDGE_DELAY_MIN = 0.3  # Раньше запасной провайдер не запускаем (сек)
+HEDGE_DELAY_MAX = 4.0  # Дольше лидера не ждем (и столько ждем провайдера без статистики)
+HEDGE_DELAY_FACTOR = 1.5  # Запасной стартует, если лидер отвечает дольше своего обычного в столько раз
+BREAKER_FAILURES = 3  # Столько ошибок подряд выводят провайдера из ротации
+BREAKER_COOLDOWN = 300  # На сколько секунд
+
+# name -> {"requests", "errors", "wins", "latency", "success", "failures", "open_until"}
+PROVIDER_STATS = {}
+PROVIDER_STATS_LOADED = False
+RACE_STATS = {"races": 0, "hedged": 0, "cancelled": 0}
+
+# --- Ссылки и метаданные ---
+LINKS_FILE = "tiktok_links.json"  # Короткая ссылка -> ID видео (не меняется, храним между запусками)
+LINKS_LIMIT = 2000  # Сколько коротких ссылок помним
+METADATA_TTL = 600  # Сколько секунд живут метаданные и прямая ссылка на видео
+METADATA_LIMIT = 500  # Сколько видео держим в кэше метаданных
+MAX_REDIRECTS = 5
+
+LINK_CACHE = OrderedDict()
+LINK_CACHE_LOADED = False
+# ID видео -> {"expires_at": ..., "info": {...}}
+METADATA_CACHE = OrderedDict()
+METADATA_INFLIGHT = {}
+LINK_INFLIGHT = {}
+METADATA_STATS = {"hits": 0, "misses": 0, "links_cached": 0, "links_resolved": 0}
+
+# --- Пакетная загрузка ---
+BATCH_CONCURRENCY = 3  # Сколько видео пакета качаем одновременно
+BATCH_LIMIT = 20  # Больше видео за одну команду не берем
+FEED_PAGE_SIZE = 20  # Видео на страницу ленты tikwm
+FEED_DEFAULT_COUNT = 10
+
+# --- Кэш видео ---
+VIDEO_CACHE_DIR = "tiktok_cache"  # Скачанные видео по ID и качеству
+VIDEO_CACHE_FILE = "tiktok_cache.json"
+VIDEO_CACHE_LIMIT = 500 * 1024 * 1024  # Сколько байт на диске могут занимать видео
+
+# "ID:качество" -> {"file", "size", "used_at", "file_id"}; порядок - от давно использованных к недавним
+VIDEO_CACHE = OrderedDict()
+VIDEO_CACHE_LOADED = False
+VIDEO_DOWNLOADS = {}
+VIDEO_CACHE_PINS = Counter()  # Видео, которые сейчас отправляются - их не вытесняем
+VIDEO_CACHE_STATS = {"hits": 0, "reused": 0, "misses": 0, "evicted": 0}
+
+# --- Очередь загрузок ---
+JOB_GLOBAL_LIMIT = 3  # Сколько загрузок выполняется одновременно
+JOB_CHAT_LIMIT = 1  # Из них - из одного чата
+JOB_LIST_COMMAND = "tiktok_jobs"
+JOB_CANCEL_COMMAND = "tiktok_cancel"
+
+JOBS = {}  # номер -> задача
+JOB_QUEUES = OrderedDict()  # chat_id -> номера ждущих задач; порядок - очередь обхода чатов
+JOB_RUNNING = Counter()  # chat_id -> сколько задач выполняется
+JOB_COUNTER = 0
+JOB_STATS = {"started": 0, "finished": 0, "cancelled": 0}
+
+# --- Прогресс ---
+PROGRESS_INTERVAL = 2.0  # Не чаще одной правки сообщения за столько секунд
+
+PROGRESS_STATS = {"edits": 0, "saved": 0}
+
+# --- Временные файлы ---
+SCRATCH_DIR_NAME = "maxli_tiktok"  # Подпапка в /dev/shm или системной временной папке
+SCRATCH_QUOTA = 300 * 1024 * 1024  # Сколько байт могут занимать видео, ожидающие отправки
+
+SCRATCH_ROOT = None
+SCRATCH_STATS = {"reserved": 0, "rejected": 0}
+
+async def _on_request_start(session, ctx, params):
+    HTTP_STATS["requests"] += 1
+
+async def _on_connection_create_end(session, ctx, params):
+    HTTP_STATS["new_connections"] += 1
+
+async def _on_connection_reuseconn(session, ctx, params):
+    HTTP_STATS["reused_connections"] += 1
+
+async def _on_dns_resolvehost_end(session, ctx, params):
+    HTTP_STATS["dns_lookups"] += 1
+
+def get_http_session():
+    """Возвращает общую HTTP сессию с пулом соединений (создается лениво)."""
+    global HTTP_SESSION, HTTP_SESSION_LOOP
+    loop = asyncio.get_running_loop()
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed and HTTP_SESSION_LOOP is loop:
+        return HTTP_SESSION
+    
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+    trace_config.on_dns_resolvehost_end.append(_on_dns_resolvehost_end)
+    
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_LIMIT,
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=60
+    )
+    # Видео может качаться долго, поэтому ограничиваем не общее время, а паузы в потоке
+    HTTP_SESSION = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=60),
+        headers={"User-Agent": USER_AGENT},
+        trace_configs=[trace_config]
+    )
+    HTTP_SESSION_LOOP = loop
+    return HTTP_SESSION
+
+async def close_http_session():
+    """Закрывает общую HTTP сессию и все соединения пула.
+    
+    Хука выгрузки у загрузчика Maxli нет, поэтому сессия закрывается только
+    при повторной регистрации этого же модуля (см. register).
+    """
+    global HTTP_SESSION
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed:
+        await HTTP_SESSION.close()
+    HTTP_SESSION = None
+
+def provider_timeout():
+    """Таймаут для запросов к API провайдеров."""
+    return aiohttp.ClientTimeout(total=PROVIDER_TIMEOUT)
+
+def get_http_stats():
+    """Возвращает статистику пула соединений."""
+    stats = dict(HTTP_STATS)
+    connections = stats["new_connections"] + stats["reused_connections"]
+    stats["reuse_ratio"] = stats["reused_connections"] / connections if connections else 0.0
+    
+    open_connections = 0
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed:
+        connector = HTTP_SESSION.connector
+        # Простаивающие keep-alive соединения + занятые в данный момент
+        open_connections = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+        open_connections += len(getattr(connector, "_acquired", ()))
+    stats["open_connections"] = open_connections
+    return stats
+
+def get_scratch_root():
+    """Папка для временных файлов модуля (в tmpfs, если он доступен)."""
+    global SCRATCH_ROOT
+    if SCRATCH_ROOT is None:
+        base = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+        SCRATCH_ROOT = os.path.join(base, SCRATCH_DIR_NAME)
+        os.makedirs(SCRATCH_ROOT, exist_ok=True)
+    return SCRATCH_ROOT
+
+def sweep_scratch_dir():
+    """Удаляет временные файлы, оставшиеся после прошлого запуска."""
+    root = get_scratch_root()
+    removed = 0
+    for entry in os.scandir(root):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+@contextlib.asynccontextmanager
+async def scratch_file(filename, size_hint=0):
+    """Выдает уникальный путь для временного файла и гарантированно удаляет его.
+    
+    size_hint резервируется в квоте на время жизни файла; если квота
+    исчерпана, выбрасывается OSError(ENOSPC).
+    """
+    if SCRATCH_STATS["reserved"] + size_hint > SCRATCH_QUOTA:
+        SCRATCH_STATS["rejected"] += 1
+        raise OSError(errno.ENOSPC, "Недостаточно места для временных файлов, попробуйте позже")
+    
+    SCRATCH_STATS["reserved"] += size_hint
+    # Отдельная папка на каждый файл: имя сохраняется, а одновременные загрузки не пересекаются
+    directory = tempfile.mkdtemp(dir=get_scratch_root())
+    try:
+        yield os.path.join(directory, filename)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        SCRATCH_STATS["reserved"] -= size_hint
+
+def new_progress(api, message, interval=None):
+    """Состояние сообщения с прогрессом: правки чаще interval склеиваются."""
+    return {
+        "api": api,
+        "message": message,
+        "interval": PROGRESS_INTERVAL if interval is None else interval,
+        "last_at": 0.0,
+        "last_text": None,
+        "pending": None,
+        "timer": None,
+        "lock": asyncio.Lock(),
+    }
+
+async def _send_progress(progress, text):
+    async with progress["lock"]:
+        if text == progress["last_text"]:
+            PROGRESS_STATS["saved"] += 1
+            return
+        progress["last_at"] = time.monotonic()
+        progress["last_text"] = text
+        PROGRESS_STATS["edits"] += 1
+        await progress["api"].edit(progress["message"], text)
+
+async def _flush_progress(progress, delay):
+    await asyncio.sleep(delay)
+    progress["timer"] = None
+    text, progress["pending"] = progress["pending"], None
+    if text is not None:
+        await _send_progress(progress, text)
+
+async def report_progress(progress, text):
+    """Показывает промежуточное состояние.
+    
+    Если с прошлой правки не прошло interval секунд, текст откладывается до
+    конца интервала; более новое состояние заменяет отложенное, а не встает
+    за ним в очередь.
+    """
+    wait = progress["last_at"] + progress["interval"] - time.monotonic()
+    if wait <= 0 and progress["timer"] is None:
+        await _send_progress(progress, text)
+        return
+    if progress["pending"] is not None:
+        PROGRESS_STATS["saved"] += 1
+    progress["pending"] = text
+    if progress["timer"] is None:
+        progress["timer"] = asyncio.create_task(_flush_progress(progress, max(wait, 0)))
+
+async def finish_progress(progress, text=None):
+    """Отменяет отложенную правку и сразу показывает итог, если он передан."""
+    timer, progress["timer"] = progress["timer"], None
+    if timer is not None:
+        timer.cancel()
+    if progress["pending"] is not None:
+        PROGRESS_STATS["saved"] += 1
+        progress["pending"] = None
+    if text is not None:
+        await _send_progress(progress, text)
+
+def get_job_position(job):
+    """Место задачи в очереди (1 - следующая) при обходе чатов по кругу."""
+    position = 0
+    queues = [list(queue) for queue in JOB_QUEUES.values()]
+    for round_index in range(max((len(queue) for queue in queues), default=0)):
+        for queue in queues:
+            if round_index < len(queue):
+                position += 1
+                if queue[round_index] == job["id"]:
+                    return position
+    return position
+
+def pump_jobs():
+    """Запускает ждущие задачи, пока есть свободные места; чаты берутся по кругу."""
+    while sum(JOB_RUNNING.values()) < JOB_GLOBAL_LIMIT:
+        for chat_id in list(JOB_QUEUES):
+            if JOB_RUNNING[chat_id] >= JOB_CHAT_LIMIT:
+                continue
+            queue = JOB_QUEUES[chat_id]
+            job = JOBS.get(queue.popleft())
+            # Чат, из которого только что взяли задачу, уходит в конец круга
+            if queue:
+                JOB_QUEUES.move_to_end(chat_id)
+            else:
+                del JOB_QUEUES[chat_id]
+            if job is None or job["state"] != "queued" or job["ready"].done():
+                # Отмененная задача: место достается следующей
+                break
+            JOB_RUNNING[chat_id] += 1
+            job["state"] = "running"
+            job["started_at"] = time.time()
+            job["ready"].set_result(True)
+            break
+        else:
+            break
+    
+    for job in JOBS.values():
+        if job["state"] == "queued" and not job["ready"].done():
+            position = get_job_position(job)
+            if position != job["position"]:
+                job["position"] = position
+                asyncio.create_task(report_queue_position(job))
+
+async def report_queue_position(job):
+    # Задачу могли запустить или отменить, пока правка ждала своей очереди
+    if job["state"] == "queued" and not job["ready"].done():
+        await report_progress(job["progress"], format_queue_position(job))
+
+def format_queue_position(job):
+    return f"⏳ В очереди: {job['position']}-я, выполняется: {sum(JOB_RUNNING.values())}/{JOB_GLOBAL_LIMIT}\n❌ Отменить: `.{JOB_CANCEL_COMMAND} {job['id']}`"
+
+async def run_job(api, message, title, factory):
+    """Выполняет factory() как задачу очереди загрузок.
+    
+    Одновременно выполняется не больше JOB_GLOBAL_LIMIT задач и не больше
+    JOB_CHAT_LIMIT из одного чата; пока места нет, сообщение показывает
+    место в очереди. Отмененная задача прерывается, а ее временные файлы
+    удаляются их контекстными менеджерами.
+    """
+    global JOB_COUNTER
+    JOB_COUNTER += 1
+    chat_id = getattr(message, "chat_id", None) or await api.await_chat_id(message)
+    job = {
+        "id": JOB_COUNTER,
+        "chat_id": chat_id,
+        "title": title,
+        "state": "queued",
+        "position": 0,
+        "created_at": time.time(),
+        "started_at": None,
+        "cancelled": False,
+        "task": None,
+        "ready": asyncio.get_running_loop().create_future(),
+        "progress": new_progress(api, message),
+    }
+    JOBS[job["id"]] = job
+    JOB_QUEUES.setdefault(chat_id, deque()).append(job["id"])
+    pump_jobs()
+    
+    try:
+        await job["ready"]
+        await finish_progress(job["progress"])
+        if job["cancelled"]:
+            raise asyncio.CancelledError()
+        JOB_STATS["started"] += 1
+        # Отдельная задача: .cancel прерывает только эту загрузку, а не обработчик команд
+        job["task"] = asyncio.create_task(factory())
+        return await job["task"]
+    except asyncio.CancelledError:
+        if not job["cancelled"]:
+            raise
+        await finish_progress(job["progress"], "🛑 Загрузка отменена")
+    finally:
+        JOBS.pop(job["id"], None)
+        if job["state"] == "running":
+            JOB_RUNNING[chat_id] -= 1
+            if JOB_RUNNING[chat_id] <= 0:
+                del JOB_RUNNING[chat_id]
+        elif chat_id in JOB_QUEUES:
+            with contextlib.suppress(ValueError):
+                JOB_QUEUES[chat_id].remove(job["id"])
+            if not JOB_QUEUES[chat_id]:
+                del JOB_QUEUES[chat_id]
+        JOB_STATS["finished"] += 1
+        pump_jobs()
+
+def cancel_job(job):
+    job["cancelled"] = True
+    JOB_STATS["cancelled"] += 1
+    if job["state"] == "queued":
+        # Из очереди убираем сразу, а не в finally run_job: иначе pump_jobs
+        # успеет запустить отмененную задачу
+        job["state"] = "cancelled"
+        queue = JOB_QUEUES.get(job["chat_id"])
+        if queue is not None:
+            with contextlib.suppress(ValueError):
+                queue.remove(job["id"])
+            if not queue:
+                del JOB_QUEUES[job["chat_id"]]
+        job["ready"].cancel()
+        pump_jobs()
+    elif job["task"] is not None:
+        job["task"].cancel()
+
+async def tiktok_jobs_command(api, message, args):
+    """Показывает выполняющиеся и ждущие загрузки."""
+    jobs = [job for job in JOBS.values() if job["state"] != "cancelled"]
+    if not jobs:
+        await api.edit(message, "📭 Загрузок нет")
+        return
+    
+    now = time.time()
+    lines = [f"📋 Загрузки (выполняется {sum(JOB_RUNNING.values())}/{JOB_GLOBAL_LIMIT}):\n"]
+    for job in sorted(jobs, key=lambda j: (j["state"] != "running", j["position"], j["id"])):
+        if job["state"] == "running":
+            state = f"▶️ {now - job['started_at']:.0f} с"
+        else:
+            state = f"⏳ {job['position']}-я в очереди"
+        lines.append(f"#{job['id']} {state} • {job['title']}")
+    lines.append(f"\n❌ Отменить: `.{JOB_CANCEL_COMMAND} <номер>` или `.{JOB_CANCEL_COMMAND} all` - все в этом чате")
+    await api.edit(message, "\n".join(lines))
+
+async def tiktok_cancel_command(api, message, args):
+    """Отменяет загрузку по номеру (или все загрузки этого чата)."""
+    if not args:
+        await api.edit(message, f"❌ Укажите номер загрузки: .{JOB_CANCEL_COMMAND} 3\n📋 Список: .{JOB_LIST_COMMAND}")
+        return
+    
+    if args[0].lower() == "all":
+        chat_id = getattr(message, "chat_id", None) or await api.await_chat_id(message)
+        jobs = [job for job in JOBS.values() if job["chat_id"] == chat_id and not job["cancelled"]]
+    else:
+        job = JOBS.get(int(args[0])) if args[0].isdigit() else None
+        jobs = [job] if job and not job["cancelled"] else []
+    
+    if not jobs:
+        await api.edit(message, "❌ Нет такой загрузки")
+        return
+    for job in jobs:
+        cancel_job(job)
+    await api.edit(message, f"🛑 Отменено загрузок: {len(jobs)}")
+
 async def tiktok_command(api, message, args):
-    """Скачивает видео из TikTok без водяных знаков."""
+    """Скачивает видео из TikTok без водяных знаков (одно, несколько или ленту автора)."""
     if not args:
-        await api.edit(message, "❌ Укажите ссылку на TikTok видео:\n.tiktok https://vm.tiktok.com/xxx/")
+        await api.edit(message, "❌ Укажите ссылку на TikTok видео:\n.tiktok https://vm.tiktok.com/xxx/\n📦 Несколько: .tiktok <ссылка> <ссылка> ...\n👤 Лента: .tiktok feed <автор> [кол-во]")
         return
     
-    url = args[0]
+    if args[0].lower() == "feed":
+        await run_job(api, message, f"TikTok лента: {' '.join(args[1:])}", lambda: tiktok_feed(api, message, args[1:]))
+        return
     
-    if not is_valid_tiktok_url(url):
+    invalid = [url for url in args if not is_valid_tiktok_url(url)]
+    if invalid:
         await api.edit(message, "❌ Неверная ссылка TikTok. Поддерживаются:\n• vm.tiktok.com\n• vt.tiktok.com\n• www.tiktok.com")
         return
     
-    await api.edit(message, "⏳ Скачиваю видео...")
+    if len(args) > 1:
+        # Повторы одной ссылки не качаем дважды
+        urls = list(dict.fromkeys(args))[:BATCH_LIMIT]
+        await run_job(api, message, f"TikTok: {len(urls)} видео", lambda: download_batch(api, message, urls))
+        return
+    
+    await run_job(api, message, f"TikTok: {args[0]}", lambda: download_single(api, message, args[0]))
+
+async def download_single(api, message, url):
+    """Скачивает и отправляет одно видео."""
+    progress = new_progress(api, message)
+    await report_progress(progress, "⏳ Скачиваю видео...")
+    item = None
     
     try:
-        video_info = await get_tiktok_video_enhanced(url)
+        video_info = await get_video_info(url)
         
         if not video_info or 'video_url' not in video_info:
-            await api.edit(message, "❌ Не удалось получить видео. Попробуйте другую ссылку")
+            await finish_progress(progress, "❌ Не удалось получить видео. Попробуйте другую ссылку")
             return
         
         chat_id = await api.await_chat_id(message)
         
-        temp_file = f"temp_tiktok_{message.id}.mp4"
-        success = await download_video_file(video_info['video_url'], temp_file)
+        async def on_progress(received, total):
+            total_text = f" / {total / 1024 / 1024:.1f}" if total else ""
+            await report_progress(progress, f"⬇️ Скачиваю видео: {received / 1024 / 1024:.1f}{total_text} МБ")
         
-        if not success:
-            await api.edit(message, "❌ Ошибка скачивания видео")
+        item = await prepare_video(video_info, f"tiktok_{message.id}.mp4", on_progress)
+        if item["error"]:
+            await finish_progress(progress, item["error"])
             return
         
-        caption = f"📱 TikTok\n👤 Автор: {video_info.get('author', 'Неизвестно')}"
-        
-        if video_info.get('description'):
-            desc = video_info['description'][:100] + "..." if len(video_info['description']) > 100 else video_info['description']
-            caption += f"\n📝 {desc}"
-        
-        result = await api.send_file(
-            chat_id=chat_id,
-            file_path=temp_file,
-            text=caption
-        )
-        
-        try:
-            os.remove(temp_file)
-        except:
-            pass
+        await report_progress(progress, "📤 Отправляю видео...")
+        result = await send_prepared_video(api, chat_id, item)
         
         if result:
+            await finish_progress(progress)
             await api.delete(message)
         else:
-            await api.edit(message, "❌ Ошибка отправки видео")
+            await finish_progress(progress, "❌ Ошибка отправки видео")
             
     except Exception as e:
-        await api.edit(message, f"❌ Ошибка: {str(e)}")
+        await finish_progress(progress, f"❌ Ошибка: {str(e)}")
         print(f"TikTok Downloader Error: {e}")
+    finally:
+        # При отмене отложенная правка не должна перекрыть сообщение об отмене
+        await finish_progress(progress)
+        if item:
+            await release_prepared_video(item)
 
-async def download_video_file(video_url, file_path):
-    """Скачивает видео файл с обработкой ошибок."""
+async def tiktok_feed(api, message, args):
+    """Скачивает последние видео автора через ленту tikwm."""
+    if not args:
+        await api.edit(message, "❌ Укажите автора: .tiktok feed username 10")
+        return
+    
+    username = args[0].lstrip("@")
+    count = FEED_DEFAULT_COUNT
+    if len(args) > 1 and args[1].isdigit():
+        count = int(args[1])
+    count = max(1, min(count, BATCH_LIMIT))
+    
+    await api.edit(message, f"⏳ Получаю ленту @{username}...")
+    try:
+        videos = await get_tiktok_user_feed(username, count)
+    except Exception as e:
+        await api.edit(message, f"❌ Ошибка: {str(e)}")
+        return
+    if not videos:
+        await api.edit(message, f"❌ Не удалось получить видео @{username}")
+        return
+    await download_batch(api, message, videos)
+
+async def download_batch(api, message, sources):
+    """Качает несколько видео пулом воркеров и отправляет их по порядку.
+    
+    sources - ссылки или уже известные метаданные видео (из ленты). Видео
+    отправляется, как только скачаны оно и все видео перед ним; прогресс
+    всего пакета показывается одним сообщением.
+    """
+    total = len(sources)
+    progress = new_progress(api, message)
+    state = {"downloaded": 0, "sent": 0}
+    failures = []
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def show_state():
+        await report_progress(progress, f"📦 TikTok: скачано {state['downloaded']}/{total} • отправлено {state['sent']}/{total}")
+    
+    async def worker(index, source):
+        async with semaphore:
+            video_info = source if isinstance(source, dict) else await get_video_info(source)
+            if not video_info or 'video_url' not in video_info:
+                item = {"error": "❌ Не удалось получить видео"}
+            else:
+                item = await prepare_video(video_info, f"tiktok_{message.id}_{index}.mp4")
+        state["downloaded"] += 1
+        await show_state()
+        return item
+    
+    await show_state()
+    chat_id = await api.await_chat_id(message)
+    tasks = [asyncio.create_task(worker(index, source)) for index, source in enumerate(sources)]
+    consumed = 0
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(video_url) as response:
-                if response.status == 200:
-                    file_size = int(response.headers.get('content-length', 0))
-                    
-                    if file_size > 50 * 1024 * 1024:
-                        return False
-                    
-                    async with aiofiles.open(file_path, 'wb') as f:
-                        async for chunk in response.content.iter_chunked(1024*1024):
-                            await f.write(chunk)
-                    return True
+        for index, task in enumerate(tasks, 1):
+            try:
+                item = await task
+            except Exception as e:
+                item = {"error": f"❌ Ошибка: {str(e)}"}
+            consumed = index
+            try:
+                if item.get("error"):
+                    failures.append(f"{index}. {item['error'].lstrip('❌ ')}")
+                    continue
+                result = await send_prepared_video(api, chat_id, item)
+                if result:
+                    state["sent"] += 1
+                    await show_state()
                 else:
-                    print(f"HTTP Error: {response.status} for URL: {video_url}")
-                    return False
+                    failures.append(f"{index}. Ошибка отправки видео")
+            finally:
+                await release_prepared_video(item)
+    finally:
+        # Если команда прервалась, незапущенные загрузки уже не нужны
+        for task in tasks:
+            task.cancel()
+        # Уже скачанные, но не отправленные видео тоже освобождаем
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for item in results[consumed:]:
+            if isinstance(item, dict):
+                await release_prepared_video(item)
+        await finish_progress(progress)
+    
+    if not failures:
+        await finish_progress(progress)
+        await api.delete(message)
+        return
+    await finish_progress(progress, f"📦 TikTok: отправлено {state['sent']} из {total}\n\n❌ Не получилось:\n" + "\n".join(failures))
+
+def build_caption(video_info):
+    caption = f"📱 TikTok\n👤 Автор: {video_info.get('author', 'Неизвестно')}"
+    
+    if video_info.get('description'):
+        desc = video_info['description'][:100] + "..." if len(video_info['description']) > 100 else video_info['description']
+        caption += f"\n📝 {desc}"
+    return caption
+
+async def prepare_video(video_info, filename, on_progress=None):
+    """Выбирает качество и готовит файл видео к отправке (из кэша или скачивая).
+    
+    Возвращает item для send_prepared_video; после отправки его нужно
+    освободить через release_prepared_video. При ошибке item["error"] - текст.
+    """
+    item = {"info": video_info, "caption": build_caption(video_info), "error": None,
+            "cache_key": None, "path": None, "cached": False, "stack": None}
+    
+    # Выбираем лучшее качество, которое влезает в лимит, еще до скачивания
+    variant = await select_video_variant(video_info)
+    if variant is None:
+        item["error"] = f"❌ Видео больше лимита {MAX_VIDEO_SIZE / 1024 / 1024:.0f} МБ во всех доступных качествах"
+        return item
+    video_info['video_url'] = variant['url']
+    video_info['quality'] = variant['quality']
+    
+    cache_key = get_video_cache_key(video_info)
+    try:
+        if cache_key:
+            # Видео, которое уже отправляли, не качаем и по возможности не загружаем заново
+            load_video_cache()
+            VIDEO_CACHE_PINS[cache_key] += 1
+            item["cache_key"] = cache_key
+            if is_video_cached(cache_key):
+                item["cached"] = True
+                return item
+            item["path"] = await fetch_video_to_cache(cache_key, video_info['video_url'], on_progress)
+        else:
+            # Без ID кэшировать не по чему: резервируем место под максимальный размер видео,
+            # файл удалится в любом случае
+            item["stack"] = contextlib.AsyncExitStack()
+            temp_file = await item["stack"].enter_async_context(scratch_file(filename, MAX_VIDEO_SIZE))
+            if await download_video_file(video_info['video_url'], temp_file, on_progress):
+                item["path"] = temp_file
+    except BaseException:
+        await release_prepared_video(item)
+        raise
+    
+    if not item["path"]:
+        item["error"] = "❌ Ошибка скачивания видео"
+    return item
+
+async def send_prepared_video(api, chat_id, item):
+    """Отправляет подготовленное видео (по ID файла, из кэша или скачанное)."""
+    if item["cached"]:
+        return await send_cached_video(api, chat_id, item["cache_key"], item["caption"])
+    
+    result = await api.send_file(
+        chat_id=chat_id,
+        file_path=item["path"],
+        text=item["caption"]
+    )
+    if item["cache_key"]:
+        remember_file_id(item["cache_key"], result)
+    return result
+
+async def release_prepared_video(item):
+    """Снимает защиту кэша от вытеснения и удаляет временный файл."""
+    cache_key = item.get("cache_key")
+    if cache_key:
+        VIDEO_CACHE_PINS[cache_key] -= 1
+        if VIDEO_CACHE_PINS[cache_key] <= 0:
+            del VIDEO_CACHE_PINS[cache_key]
+    if item.get("stack"):
+        await item["stack"].aclose()
+
+async def probe_video_size(url):
+    """Размер файла по HEAD (Content-Length) или None, если сервер его не сообщил."""
+    try:
+        session = get_http_session()
+        async with session.head(url, allow_redirects=True, timeout=provider_timeout()) as response:
+            if response.status == 200 and response.headers.get('content-length'):
+                return int(response.headers['content-length'])
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        print(f"TikTok HEAD error: {e}")
+    return None
+
+async def select_video_variant(video_info, budget=None):
+    """Лучший вариант видео, размер которого не больше budget.
+    
+    Размер берется из ответа провайдера, а если его нет - из HEAD запроса.
+    Вариант с неизвестным размером берется, только если ни один известный
+    не подошел: при скачивании его все равно ограничит жесткий лимит.
+    Возвращает None, если все варианты точно больше лимита.
+    """
+    budget = budget or MAX_VIDEO_SIZE
+    variants = video_info.get('variants') or [{"quality": video_info.get('quality', 'play'), "url": video_info['video_url'], "size": None}]
+    variants = sorted(variants, key=lambda v: QUALITY_ORDER.index(v["quality"]) if v["quality"] in QUALITY_ORDER else len(QUALITY_ORDER))
+    
+    unknown = None
+    for variant in variants:
+        size = variant.get("size")
+        if size is None and len(variants) > 1:
+            size = variant["size"] = await probe_video_size(variant["url"])
+        if size is None:
+            unknown = unknown or variant
+        elif size <= budget:
+            return variant
+    return unknown
+
+def load_video_cache():
+    """Загружает индекс кэша видео (один раз за запуск), забывая пропавшие файлы."""
+    global VIDEO_CACHE_LOADED
+    if VIDEO_CACHE_LOADED:
+        return
+    VIDEO_CACHE_LOADED = True
+    os.makedirs(VIDEO_CACHE_DIR, exist_ok=True)
+    if os.path.exists(VIDEO_CACHE_FILE):
+        try:
+            with open(VIDEO_CACHE_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                for key, entry in sorted(data.items(), key=lambda item: item[1].get("used_at", 0)):
+                    if os.path.exists(os.path.join(VIDEO_CACHE_DIR, entry.get("file", ""))):
+                        VIDEO_CACHE[key] = entry
+        except (json.JSONDecodeError, IOError, AttributeError):
+            pass
+
+def save_video_cache():
+    try:
+        temp_path = f"{VIDEO_CACHE_FILE}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(VIDEO_CACHE, f)
+        os.replace(temp_path, VIDEO_CACHE_FILE)
+    except Exception:
+        pass
+
+def get_video_cache_key(video_info):
+    """Ключ кэша: ID видео и качество; без ID видео не кэшируется."""
+    video_id = video_info.get('id')
+    if not video_id:
+        return None
+    return f"{video_id}:{video_info.get('quality', 'play')}"
+
+def touch_cached_video(cache_key):
+    VIDEO_CACHE[cache_key]["used_at"] = time.time()
+    VIDEO_CACHE.move_to_end(cache_key)
+    save_video_cache()
+
+def is_video_cached(cache_key):
+    entry = VIDEO_CACHE.get(cache_key)
+    return bool(entry) and os.path.exists(os.path.join(VIDEO_CACHE_DIR, entry["file"]))
+
+def evict_video_cache():
+    """Удаляет давно не использованные видео, пока кэш больше лимита."""
+    total = sum(entry["size"] for entry in VIDEO_CACHE.values())
+    for cache_key in list(VIDEO_CACHE):
+        if total <= VIDEO_CACHE_LIMIT:
+            break
+        # Видео, которые сейчас готовятся к отправке, не трогаем
+        if VIDEO_CACHE_PINS[cache_key]:
+            continue
+        entry = VIDEO_CACHE.pop(cache_key)
+        total -= entry["size"]
+        VIDEO_CACHE_STATS["evicted"] += 1
+        with contextlib.suppress(OSError):
+            os.remove(os.path.join(VIDEO_CACHE_DIR, entry["file"]))
+
+def supports_file_id(api):
+    """Умеет ли api.send_file отправлять уже загруженный файл по его ID."""
+    try:
+        return "file_id" in inspect.signature(api.send_file).parameters
+    except (TypeError, ValueError):
+        return False
+
+def get_reusable_file_id(result):
+    """ID загруженного файла из ответа send_file, если Maxli его вернул."""
+    if isinstance(result, dict):
+        return result.get("file_id")
+    return getattr(result, "file_id", None)
+
+def remember_file_id(cache_key, result):
+    file_id = get_reusable_file_id(result)
+    if file_id and cache_key in VIDEO_CACHE:
+        VIDEO_CACHE[cache_key]["file_id"] = file_id
+        save_video_cache()
+
+async def send_cached_video(api, chat_id, cache_key, caption):
+    """Отправляет видео из кэша: по ID загруженного файла, иначе с диска.
+    
+    Возвращает None, если видео в кэше уже нет.
+    """
+    load_video_cache()
+    entry = VIDEO_CACHE.get(cache_key)
+    if entry is None:
+        return None
+    
+    if entry.get("file_id") and supports_file_id(api):
+        try:
+            result = await api.send_file(chat_id=chat_id, file_id=entry["file_id"], text=caption)
+        except Exception as e:
+            print(f"TikTok cached file_id error: {e}")
+            result = None
+        if result:
+            VIDEO_CACHE_STATS["reused"] += 1
+            touch_cached_video(cache_key)
+            return result
+        # ID устарел - дальше отправляем файл с диска и запоминаем новый
+        entry.pop("file_id", None)
+    
+    video_path = os.path.join(VIDEO_CACHE_DIR, entry["file"])
+    if not os.path.exists(video_path):
+        VIDEO_CACHE.pop(cache_key, None)
+        return None
+    
+    VIDEO_CACHE_STATS["hits"] += 1
+    touch_cached_video(cache_key)
+    result = await api.send_file(chat_id=chat_id, file_path=video_path, text=caption)
+    remember_file_id(cache_key, result)
+    return result
+
+async def fetch_video_to_cache(cache_key, video_url, on_progress=None):
+    """Скачивает видео в кэш; одно и то же видео из нескольких чатов качается один раз."""
+    download = VIDEO_DOWNLOADS.get(cache_key)
+    if download is None:
+        download = VIDEO_DOWNLOADS[cache_key] = {"task": None, "waiters": 0, "listeners": []}
+        
+        async def notify(received, total):
+            # Прогресс получают только те, кто еще ждет: ушедший не должен править свое сообщение
+            for listener in list(download["listeners"]):
+                try:
+                    await listener(received, total)
+                except Exception as e:
+                    print(f"TikTok progress error: {e}")
+        
+        task = download["task"] = asyncio.create_task(_fetch_video_to_cache(cache_key, video_url, notify))
+        task.add_done_callback(lambda _: VIDEO_DOWNLOADS.pop(cache_key, None))
+    
+    download["waiters"] += 1
+    if on_progress:
+        download["listeners"].append(on_progress)
+    try:
+        return await asyncio.shield(download["task"])
+    except asyncio.CancelledError:
+        # Ушел последний, кто ждал это видео, - загрузку (и ее .part файл) останавливаем
+        if download["waiters"] == 1:
+            download["task"].cancel()
+        raise
+    finally:
+        download["waiters"] -= 1
+        if on_progress:
+            download["listeners"].remove(on_progress)
+
+async def _fetch_video_to_cache(cache_key, video_url, on_progress):
+    load_video_cache()
+    VIDEO_CACHE_STATS["misses"] += 1
+    filename = f"tiktok_{cache_key.replace(':', '_')}.mp4"
+    video_path = os.path.join(VIDEO_CACHE_DIR, filename)
+    part_path = f"{video_path}.part"
+    try:
+        if not await download_video_file(video_url, part_path, on_progress):
+            return None
+        os.replace(part_path, video_path)
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(part_path)
+    
+    VIDEO_CACHE[cache_key] = {"file": filename, "size": os.path.getsize(video_path), "used_at": time.time()}
+    evict_video_cache()
+    save_video_cache()
+    return video_path
+
+async def download_video_file(video_url, file_path, on_progress=None, max_size=None):
+    """Скачивает видео файл с обработкой ошибок.
+    
+    Первый запрос сразу просит первую часть: маленький файл приходит в нем
+    целиком, а большой качается дальше частями в несколько соединений.
+    Если сервер не поддерживает Range - одним потоком. on_progress(received, total)
+    вызывается после каждого куска. Больше max_size байт не скачивается
+    даже без Content-Length.
+    """
+    max_size = max_size or MAX_VIDEO_SIZE
+    try:
+        session = get_http_session()
+        # Запрос первой части показывает и поддержку Range, и размер файла, а его тело не пропадает
+        async with session.get(video_url, headers={"Range": f"bytes=0-{RANGE_PART_SIZE - 1}"}) as response:
+            content_range = response.headers.get("Content-Range", "")
+            match = re.match(r"bytes 0-\d+/(\d+)", content_range)
+            if response.status == 200:
+                # Range не поддерживается - этот же ответ и есть весь файл
+                DOWNLOAD_STATS["single"] += 1
+                return await write_single_stream(response, file_path, on_progress, max_size)
+            if response.status != 206 or not match:
+                print(f"HTTP Error: {response.status} for URL: {video_url}")
+                return False
+            
+            total = int(match.group(1))
+            if total > max_size:
+                print(f"Video is too large: {total} bytes")
+                return False
+            if total <= RANGE_PART_SIZE:
+                # Файл целиком уместился в первую часть
+                DOWNLOAD_STATS["single"] += 1
+                return await write_single_stream(response, file_path, on_progress, max_size)
+            
+            DOWNLOAD_STATS["ranged"] += 1
+            return await download_ranges(video_url, file_path, total, on_progress, first_response=response)
     except Exception as e:
         print(f"Download error: {e}")
         return False
 
+async def write_single_stream(response, file_path, on_progress, max_size):
+    """Пишет тело ответа в файл одним потоком, обрываясь на max_size байт."""
+    file_size = int(response.headers.get('content-length', 0))
+    if file_size > max_size:
+        return False
+    
+    received = 0
+    async with aiofiles.open(file_path, 'wb') as f:
+        async for chunk in response.content.iter_chunked(1024*1024):
+            received += len(chunk)
+            if received > max_size:
+                # Content-Length не было или он соврал - дальше не качаем
+                print(f"Video stream exceeded {max_size} bytes, aborting")
+                return False
+            await f.write(chunk)
+            if on_progress:
+                await on_progress(received, file_size)
+    return True
+
+async def download_ranges(video_url, file_path, total, on_progress=None, first_response=None):
+    """Качает файл частями параллельно, каждая часть пишется на свое место.
+    
+    first_response - уже открытый ответ с первой частью (bytes=0-...), он
+    используется вместо нового запроса.
+    """
+    # Файл нужного размера создаем заранее, чтобы части писались по смещениям
+    with open(file_path, 'wb') as f:
+        f.truncate(total)
+    
+    parts = [(start, min(start + RANGE_PART_SIZE, total) - 1) for start in range(0, total, RANGE_PART_SIZE)]
+    semaphore = asyncio.Semaphore(RANGE_CONCURRENCY)
+    received = 0
+    
+    async def fetch_part(start, end):
+        nonlocal received
+        position = start
+        async with semaphore:
+            for attempt in range(RANGE_RETRIES + 1):
+                if attempt:
+                    DOWNLOAD_STATS["retries"] += 1
+                    await asyncio.sleep(0.5 * attempt)
+                try:
+                    if start == 0 and attempt == 0 and first_response is not None:
+                        # Первая часть уже идет в ответе на пробный запрос
+                        request = contextlib.nullcontext(first_response)
+                    else:
+                        # При повторе докачиваем часть с места обрыва
+                        request = get_http_session().get(video_url, headers={"Range": f"bytes={position}-{end}"})
+                    async with request as response:
+                        if response.status != 206:
+                            raise aiohttp.ClientResponseError(
+                                response.request_info, response.history,
+                                status=response.status, message="Сервер не отдал часть файла"
+                            )
+                        async with aiofiles.open(file_path, 'r+b') as f:
+                            await f.seek(position)
+                            async for chunk in response.content.iter_chunked(256 * 1024):
+                                chunk = chunk[:end + 1 - position]
+                                await f.write(chunk)
+                                position += len(chunk)
+                                received += len(chunk)
+                                if on_progress:
+                                    await on_progress(received, total)
+                    if position > end:
+                        return
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    print(f"Range {position}-{end} error: {e}")
+            raise Exception(f"Не удалось скачать часть {start}-{end}")
+    
+    tasks = [asyncio.create_task(fetch_part(start, end)) for start, end in parts]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # Если одна часть не скачалась, остальные уже не нужны
+        for task in tasks:
+            task.cancel()
+    return True
+
 async def tiktok_info_command(api, message, args):
     """Показывает информацию о TikTok видео без скачивания."""
     if not args:
@@ -105,7 +1005,7 @@ async def tiktok_info_command(api, message, args):
     await api.edit(message, "⏳ Получаю информацию...")
     
     try:
-        video_info = await get_tiktok_video_enhanced(url)
+        video_info = await get_video_info(url)
         
         if not video_info:
             await api.edit(message, "❌ Не удалось получить информацию о видео")
@@ -148,6 +1048,62 @@ async def tiktok_info_command(api, message, args):
     except Exception as e:
         await api.edit(message, f"❌ Ошибка: {str(e)}")
 
+async def tiktok_stats_command(api, message, args):
+    """Показывает статистику HTTP пула загрузчика."""
+    http_stats = get_http_stats()
+    load_provider_stats()
+    load_link_cache()
+    load_video_cache()
+    
+    now = time.time()
+    provider_lines = []
+    for name in PROVIDERS:
+        stats = PROVIDER_STATS.get(name)
+        if not stats:
+            provider_lines.append(f"• {name}: нет данных")
+            continue
+        latency = f"{stats['latency'] * 1000:.0f} мс" if stats["latency"] else "нет ответов"
+        line = f"• {name}: {latency}, успех {stats['success'] * 100:.0f}%, побед {stats['wins']}/{stats['requests']}"
+        if stats["open_until"] > now:
+            line += f" ⛔ выключен еще {stats['open_until'] - now:.0f} с"
+        provider_lines.append(line)
+    providers_text = "\n".join(provider_lines)
+    
+    stats_text = f"""📊 Статистика TikTok Downloader
+
+🔗 Кэш видео:
+• В кэше: {len(METADATA_CACHE)} видео, {len(LINK_CACHE)} коротких ссылок
+• Из кэша: {METADATA_STATS['hits']} • к провайдерам: {METADATA_STATS['misses']}
+• Ссылок из кэша: {METADATA_STATS['links_cached']} • раскрыто: {METADATA_STATS['links_resolved']}
+
+🏁 Провайдеры (запросов: {RACE_STATS['races']}, подстраховок: {RACE_STATS['hedged']}, отменено: {RACE_STATS['cancelled']}):
+{providers_text}
+
+💾 Кэш видео:
+• В кэше: {len(VIDEO_CACHE)} видео, {sum(entry['size'] for entry in VIDEO_CACHE.values()) / 1024 / 1024:.1f} / {VIDEO_CACHE_LIMIT / 1024 / 1024:.0f} МБ
+• С диска: {VIDEO_CACHE_STATS['hits']} • по ID файла: {VIDEO_CACHE_STATS['reused']} • скачано: {VIDEO_CACHE_STATS['misses']} • вытеснено: {VIDEO_CACHE_STATS['evicted']}
+
+⬇️ Загрузки: частями {DOWNLOAD_STATS['ranged']} • одним потоком {DOWNLOAD_STATS['single']} • повторов частей {DOWNLOAD_STATS['retries']}
+
+📋 Очередь: выполняется {sum(JOB_RUNNING.values())}/{JOB_GLOBAL_LIMIT} • ждут {sum(len(q) for q in JOB_QUEUES.values())} • отменено {JOB_STATS['cancelled']}
+
+🌐 HTTP пул:
+• Запросов: {http_stats['requests']}
+• Новых соединений: {http_stats['new_connections']}
+• Переиспользовано: {http_stats['reused_connections']} ({http_stats['reuse_ratio'] * 100:.1f}%)
+• Открыто сейчас: {http_stats['open_connections']}
+• DNS запросов: {http_stats['dns_lookups']}
+
+🗑 Временные файлы:
+• Зарезервировано: {SCRATCH_STATS['reserved'] / 1024 / 1024:.1f} / {SCRATCH_QUOTA / 1024 / 1024:.0f} МБ
+• Отказов по квоте: {SCRATCH_STATS['rejected']}
+
+✏️ Прогресс:
+• Правок сообщений: {PROGRESS_STATS['edits']}
+• Сэкономлено правок: {PROGRESS_STATS['saved']}"""
+    
+    await api.edit(message, stats_text)
+
 def format_number(num):
     """Форматирует числа в красивый вид (1K, 1M и т.д.)"""
     if isinstance(num, (int, float)):
@@ -158,52 +1114,298 @@ def format_number(num):
         return str(num)
     return str(num)
 
-async def get_tiktok_video_enhanced(url):
-    """Пробует несколько API для получения максимальной информации."""
-    apis_to_try = [
-        get_tiktok_video_tikdown,
-        get_tiktok_video_tikwm,
-        get_tiktok_video_savetiktok,
-    ]
-    
-    for api_func in apis_to_try:
+def extract_video_id(url):
+    """ID видео из полной ссылки (/video/123, /photo/123, ?item_id=123)."""
+    match = re.search(r"/(?:video|photo|v)/(\d{8,})", url) or re.search(r"[?&](?:item_id|share_item_id)=(\d{8,})", url)
+    return match.group(1) if match else None
+
+def normalize_link(url):
+    """Ключ короткой ссылки: хост и путь без схемы, параметров и слэша на конце."""
+    parsed = urlparse(url if "://" in url else f"https://{url}")
+    return f"{parsed.netloc.lower()}{parsed.path.rstrip('/')}"
+
+def load_link_cache():
+    """Загружает кэш коротких ссылок из JSON файла (один раз за запуск)."""
+    global LINK_CACHE_LOADED
+    if LINK_CACHE_LOADED:
+        return
+    LINK_CACHE_LOADED = True
+    if os.path.exists(LINKS_FILE):
         try:
-            result = await api_func(url)
-            if result and result.get('video_url'):
-                print(f"Успешно использовано API: {api_func.__name__}")
-                return result
-        except Exception as e:
-            print(f"Ошибка в {api_func.__name__}: {e}")
-            continue
+            with open(LINKS_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                LINK_CACHE.update(data)
+        except (json.JSONDecodeError, IOError):
+            pass
+
+def save_link_cache():
+    try:
+        temp_path = f"{LINKS_FILE}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(LINK_CACHE, f)
+        os.replace(temp_path, LINKS_FILE)
+    except Exception:
+        pass
+
+async def resolve_video_id(url):
+    """Приводит vm./vt./www. ссылку к ID видео; редиректы коротких ссылок кэшируются."""
+    video_id = extract_video_id(url)
+    if video_id:
+        return video_id
+    
+    load_link_cache()
+    key = normalize_link(url)
+    if key in LINK_CACHE:
+        LINK_CACHE.move_to_end(key)
+        METADATA_STATS["links_cached"] += 1
+        return LINK_CACHE[key]
+    
+    # Одну и ту же ссылку из нескольких чатов раскрываем одним запросом
+    task = LINK_INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.create_task(follow_short_link(url))
+        LINK_INFLIGHT[key] = task
+        task.add_done_callback(lambda _: LINK_INFLIGHT.pop(key, None))
+    video_id = await asyncio.shield(task)
+    
+    if video_id and key not in LINK_CACHE:
+        METADATA_STATS["links_resolved"] += 1
+        LINK_CACHE[key] = video_id
+        while len(LINK_CACHE) > LINKS_LIMIT:
+            LINK_CACHE.popitem(last=False)
+        save_link_cache()
+    return video_id
+
+async def follow_short_link(url):
+    """Идет по редиректам короткой ссылки до первого адреса с ID видео.
     
+    Редиректы обрабатываем сами, чтобы не скачивать саму страницу TikTok.
+    """
+    session = get_http_session()
+    current = url
+    try:
+        for _ in range(MAX_REDIRECTS):
+            async with session.head(current, allow_redirects=False, timeout=provider_timeout()) as response:
+                location = response.headers.get("Location")
+            if not location:
+                return None
+            current = urljoin(current, location)
+            video_id = extract_video_id(current)
+            if video_id:
+                return video_id
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"TikTok redirect error: {e}")
     return None
 
-async def get_tiktok_video_tikdown(url):
-    """Новое API - более надежное"""
+async def get_video_info(url):
+    """Метаданные и прямая ссылка на видео через кэш по ID видео.
+    
+    .tiktok_info и следующий за ним .tiktok, а также разные ссылки на одно
+    видео обращаются к провайдерам один раз за METADATA_TTL.
+    """
+    video_id = await resolve_video_id(url)
+    # Если ID узнать не удалось, кэшируем хотя бы по самой ссылке
+    key = video_id or normalize_link(url)
+    
+    entry = METADATA_CACHE.get(key)
+    if entry and entry["expires_at"] > time.time():
+        METADATA_CACHE.move_to_end(key)
+        METADATA_STATS["hits"] += 1
+        return dict(entry["info"])
+    
+    task = METADATA_INFLIGHT.get(key)
+    if task is None:
+        METADATA_STATS["misses"] += 1
+        task = asyncio.create_task(get_tiktok_video_enhanced(url))
+        METADATA_INFLIGHT[key] = task
+        task.add_done_callback(lambda _: METADATA_INFLIGHT.pop(key, None))
+    else:
+        METADATA_STATS["hits"] += 1
+    info = await asyncio.shield(task)
+    
+    if info and info.get('video_url'):
+        if video_id:
+            info.setdefault('id', video_id)
+        store_video_metadata(key, info)
+        return dict(info)
+    return info
+
+def store_video_metadata(key, info):
+    METADATA_CACHE[key] = {"expires_at": time.time() + METADATA_TTL, "info": info}
+    METADATA_CACHE.move_to_end(key)
+    while len(METADATA_CACHE) > METADATA_LIMIT:
+        METADATA_CACHE.popitem(last=False)
+
+async def get_tiktok_video_enhanced(url):
+    """Получает видео у самого быстрого из провайдеров.
+    
+    Первым запускается лучший по статистике провайдер; если он не ответил
+    за адаптивную задержку, параллельно запускается следующий. Побеждает
+    первый ответ со ссылкой на видео, остальные запросы отменяются.
+    """
+    load_provider_stats()
+    queue = rank_providers()
+    tasks = {}
+    last_started = None
+    launch_next = True
+    RACE_STATS["races"] += 1
+    
     try:
-        async with aiohttp.ClientSession() as session:
-            api_url = "https://tikdown.org/api"
-            
-            payload = {
-                "url": url
-            }
+        while True:
+            if launch_next and queue:
+                last_started = queue.pop(0)
+                tasks[asyncio.create_task(run_provider(last_started, url))] = (last_started, time.monotonic())
+            launch_next = False
+            if not tasks:
+                return None
             
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            }
+            delay = get_hedge_delay(last_started) if queue else None
+            done, _ = await asyncio.wait(tasks, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # Лидер думает дольше обычного - подстраховываемся следующим
+                RACE_STATS["hedged"] += 1
+                launch_next = True
+                continue
             
-            async with session.post(api_url, json=payload, headers=headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data.get('success'):
-                        return {
-                            'video_url': data.get('videoUrl', ''),
-                            'author': data.get('author', 'Неизвестно'),
-                            'description': data.get('description', 'Нет описания'),
-                            'music': data.get('music', 'Н/Д')
-                        }
+            for task in done:
+                name, _ = tasks.pop(task)
+                result, latency = task.result()
+                ok = bool(result and result.get('video_url'))
+                record_provider_result(name, ok, latency)
+                if ok:
+                    PROVIDER_STATS[name]["wins"] += 1
+                    print(f"Успешно использовано API: {name} ({latency:.2f} с)")
+                    return result
+            # Провайдер ответил ошибкой - сразу пробуем следующий
+            launch_next = True
+    finally:
+        for task, (name, started) in tasks.items():
+            task.cancel()
+            # Проигравший отвечал как минимум столько - иначе зависший провайдер навсегда остался бы "без статистики"
+            record_provider_slow(name, time.monotonic() - started)
+        RACE_STATS["cancelled"] += len(tasks)
+        save_provider_stats()
+
+async def run_provider(name, url):
+    """Запускает провайдера и замеряет время ответа."""
+    started = time.monotonic()
+    try:
+        result = await PROVIDERS[name](url)
+    except Exception as e:
+        print(f"Ошибка в {name}: {e}")
+        result = None
+    return result, time.monotonic() - started
+
+def rank_providers():
+    """Провайдеры от лучшего к худшему: ожидаемое время ответа с учетом неудач."""
+    now = time.time()
+    order = list(PROVIDERS)
+    
+    def score(name):
+        stats = PROVIDER_STATS.get(name)
+        if not stats:
+            # Без статистики - пробуем в порядке по умолчанию, чтобы ее набрать
+            return (0.0, order.index(name))
+        latency = stats["latency"] or HEDGE_DELAY_MAX
+        return (latency / max(stats["success"], 0.05), order.index(name))
+    
+    available = [name for name in order if PROVIDER_STATS.get(name, {}).get("open_until", 0) <= now]
+    if not available:
+        # Все выключены - лучше попробовать, чем сразу отказать
+        available = order
+    return sorted(available, key=score)
+
+def get_hedge_delay(name):
+    """Сколько ждать провайдера, прежде чем запустить следующего."""
+    stats = PROVIDER_STATS.get(name)
+    if not stats or not stats["latency"]:
+        return HEDGE_DELAY_MAX
+    return min(HEDGE_DELAY_MAX, max(HEDGE_DELAY_MIN, stats["latency"] * HEDGE_DELAY_FACTOR))
+
+def get_provider_stats(name):
+    return PROVIDER_STATS.setdefault(name, {
+        "requests": 0, "errors": 0, "wins": 0,
+        "latency": 0.0, "success": 1.0, "failures": 0, "open_until": 0,
+    })
+
+def record_provider_slow(name, elapsed):
+    """Учитывает отмененный запрос: задержка провайдера не меньше elapsed."""
+    stats = get_provider_stats(name)
+    if elapsed > stats["latency"]:
+        stats["latency"] = stats["latency"] * 0.8 + elapsed * 0.2 if stats["latency"] else elapsed
+
+def record_provider_result(name, ok, latency):
+    """Обновляет задержку и успешность (EWMA) провайдера и его предохранитель."""
+    stats = get_provider_stats(name)
+    stats["requests"] += 1
+    stats["success"] = stats["success"] * 0.8 + (0.2 if ok else 0.0)
+    if not ok:
+        stats["errors"] += 1
+        stats["failures"] += 1
+        # После паузы провайдер получает один шанс: новая ошибка снова выключает его
+        if stats["failures"] >= BREAKER_FAILURES:
+            stats["open_until"] = time.time() + BREAKER_COOLDOWN
+            print(f"⚠️ TikTok Downloader: {name} выключен на {BREAKER_COOLDOWN} с после {stats['failures']} ошибок подряд")
+        return
+    stats["failures"] = 0
+    stats["open_until"] = 0
+    if stats["latency"]:
+        stats["latency"] = stats["latency"] * 0.8 + latency * 0.2
+    else:
+        stats["latency"] = latency
+
+def load_provider_stats():
+    """Загружает статистику провайдеров из JSON файла (один раз за запуск)."""
+    global PROVIDER_STATS_LOADED
+    if PROVIDER_STATS_LOADED:
+        return
+    PROVIDER_STATS_LOADED = True
+    if os.path.exists(PROVIDER_STATS_FILE):
+        try:
+            with open(PROVIDER_STATS_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                PROVIDER_STATS.update(data)
+        except (json.JSONDecodeError, IOError):
+            pass
+
+def save_provider_stats():
+    """Сохраняет статистику провайдеров, чтобы порядок пережил перезапуск."""
+    try:
+        temp_path = f"{PROVIDER_STATS_FILE}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(PROVIDER_STATS, f)
+        os.replace(temp_path, PROVIDER_STATS_FILE)
+    except Exception:
+        pass
+
+async def get_tiktok_video_tikdown(url):
+    """Новое API - более надежное"""
+    try:
+        session = get_http_session()
+        api_url = "https://tikdown.org/api"
+        
+        payload = {
+            "url": url
+        }
+        
+        headers = {
+            "User-Agent": USER_AGENT,
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        
+        async with session.post(api_url, json=payload, headers=headers, timeout=provider_timeout()) as response:
+            if response.status == 200:
+                data = await response.json()
+                if data.get('success'):
+                    return {
+                        'video_url': data.get('videoUrl', ''),
+                        'author': data.get('author', 'Неизвестно'),
+                        'description': data.get('description', 'Нет описания'),
+                        'music': data.get('music', 'Н/Д')
+                    }
         return None
     except Exception as e:
         print(f"Tikdown API error: {e}")
@@ -212,79 +1414,141 @@ async def get_tiktok_video_tikdown(url):
 async def get_tiktok_video_tikwm(url):
     """TikWM API с исправлением ссылок"""
     try:
-        async with aiohttp.ClientSession() as session:
-            api_url = "https://www.tikwm.com/api/"
-            
-            payload = {
-                "url": url,
-                "count": 12,
-                "cursor": 0,
-                "web": 1,
-                "hd": 1
-            }
-            
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-                "Accept": "application/json",
-            }
-            
-            async with session.post(api_url, data=payload, headers=headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data.get('code') == 0:
-                        video_data = data.get('data', {})
-                        
-                        video_url = video_data.get('play', '')
-                        if video_url and not video_url.startswith('http'):
-                            video_url = f"https://www.tikwm.com{video_url}"
-                        
-                        stats = video_data.get('stats', {})
-                        
-                        return {
-                            'video_url': video_url,
-                            'author': video_data.get('author', {}).get('nickname', 'Неизвестно'),
-                            'description': video_data.get('title', 'Нет описания'),
-                            'music': video_data.get('music_info', {}).get('title', 'Н/Д'),
-                            'likes': stats.get('diggCount'),
-                            'comments': stats.get('commentCount'),
-                            'shares': stats.get('shareCount'),
-                            'views': stats.get('playCount'),
-                            'duration': video_data.get('duration')
-                        }
+        session = get_http_session()
+        api_url = "https://www.tikwm.com/api/"
+        
+        payload = {
+            "url": url,
+            "count": 12,
+            "cursor": 0,
+            "web": 1,
+            "hd": 1
+        }
+        
+        headers = {
+            "User-Agent": USER_AGENT,
+            "Accept": "application/json",
+        }
+        
+        async with session.post(api_url, data=payload, headers=headers, timeout=provider_timeout()) as response:
+            if response.status == 200:
+                data = await response.json()
+                if data.get('code') == 0:
+                    return parse_tikwm_video(data.get('data', {}))
         return None
     except Exception as e:
         print(f"TikWM API error: {e}")
         return None
 
+def parse_tikwm_video(video_data):
+    """Приводит видео из ответа tikwm (одиночного или ленты) к общему виду."""
+    # tikwm отдает несколько вариантов сразу с размерами
+    variants = []
+    for quality, size_field in (("hdplay", "hd_size"), ("play", "size"), ("wmplay", "wm_size")):
+        variant_url = video_data.get(quality, '')
+        if not variant_url:
+            continue
+        if not variant_url.startswith('http'):
+            variant_url = f"https://www.tikwm.com{variant_url}"
+        variants.append({"quality": quality, "url": variant_url, "size": video_data.get(size_field) or None})
+    
+    video_url = next((v["url"] for v in variants if v["quality"] == "play"), variants[0]["url"] if variants else '')
+    stats = video_data.get('stats', {})
+    author = video_data.get('author') or {}
+    
+    info = {
+        'video_url': video_url,
+        'variants': variants,
+        'author': author.get('nickname', 'Неизвестно'),
+        'description': video_data.get('title', 'Нет описания'),
+        'music': video_data.get('music_info', {}).get('title', 'Н/Д'),
+        # В ленте статистика лежит прямо в видео, в одиночном ответе - в stats
+        'likes': stats.get('diggCount', video_data.get('digg_count')),
+        'comments': stats.get('commentCount', video_data.get('comment_count')),
+        'shares': stats.get('shareCount', video_data.get('share_count')),
+        'views': stats.get('playCount', video_data.get('play_count')),
+        'duration': video_data.get('duration')
+    }
+    video_id = str(video_data.get('video_id') or video_data.get('id') or '')
+    if video_id.isdigit():
+        info['id'] = video_id
+    return info
+
+async def get_tiktok_user_feed(username, count):
+    """Последние count видео автора через ленту tikwm (страницы по cursor)."""
+    session = get_http_session()
+    api_url = "https://www.tikwm.com/api/user/posts"
+    headers = {
+        "User-Agent": USER_AGENT,
+        "Accept": "application/json",
+    }
+    
+    videos = []
+    cursor = 0
+    while len(videos) < count:
+        payload = {
+            "unique_id": username,
+            "count": min(FEED_PAGE_SIZE, count - len(videos)),
+            "cursor": cursor,
+        }
+        async with session.post(api_url, data=payload, headers=headers, timeout=provider_timeout()) as response:
+            if response.status != 200:
+                raise Exception(f"tikwm вернул HTTP {response.status}")
+            data = await response.json(content_type=None)
+        if data.get('code') != 0:
+            if videos:
+                break
+            raise Exception(data.get('msg') or "tikwm не отдал ленту")
+        
+        page = data.get('data') or {}
+        for video_data in page.get('videos', []):
+            info = parse_tikwm_video(video_data)
+            if info['video_url']:
+                # Следующий .tiktok на любое из этих видео не пойдет к провайдерам
+                if info.get('id'):
+                    store_video_metadata(info['id'], info)
+                videos.append(dict(info))
+        if not page.get('hasMore') or not page.get('videos'):
+            break
+        cursor = page.get('cursor', 0)
+    return videos[:count]
+
 async def get_tiktok_video_savetiktok(url):
     """SaveTikTok API - резервный вариант"""
     try:
-        async with aiohttp.ClientSession() as session:
-            api_url = "https://api.savetiktok.org/video"
-            
-            payload = {
-                "url": url
-            }
-            
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-                "Content-Type": "application/json",
-            }
-            
-            async with session.post(api_url, json=payload, headers=headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data.get('success'):
-                        return {
-                            'video_url': data.get('download_url', ''),
-                            'author': data.get('author', {}).get('nickname', 'Неизвестно'),
-                            'description': data.get('description', 'Нет описания'),
-                        }
+        session = get_http_session()
+        api_url = "https://api.savetiktok.org/video"
+        
+        payload = {
+            "url": url
+        }
+        
+        headers = {
+            "User-Agent": USER_AGENT,
+            "Content-Type": "application/json",
+        }
+        
+        async with session.post(api_url, json=payload, headers=headers, timeout=provider_timeout()) as response:
+            if response.status == 200:
+                data = await response.json()
+                if data.get('success'):
+                    return {
+                        'video_url': data.get('download_url', ''),
+                        'author': data.get('author', {}).get('nickname', 'Неизвестно'),
+                        'description': data.get('description', 'Нет описания'),
+                    }
         return None
     except Exception as e:
         print(f"SaveTikTok API error: {e}")
         return None
 
+# Порядок по умолчанию, пока нет статистики
+PROVIDERS = {
+    "tikdown": get_tiktok_video_tikdown,
+    "tikwm": get_tiktok_video_tikwm,
+    "savetiktok": get_tiktok_video_savetiktok,
+}
+
 def is_valid_tiktok_url(url):
     """Проверяет валидность ссылки TikTok."""
     tiktok_domains = [
@@ -301,6 +1565,12 @@ def is_valid_tiktok_url(url):
         return False
 
 async def register(api):
-    """Регистрирует команды модуля."""
+    """Регистрирует команды модуля и чистит временные файлы прошлого запуска."""
+    # Если модуль регистрируется повторно, соединения прошлой регистрации не нужны
+    await close_http_session()
+    sweep_scratch_dir()
     api.register_command("tiktok", tiktok_command)
     api.register_command("tiktok_info", tiktok_info_command)
+    api.register_command("tiktok_stats", tiktok_stats_command)
+    api.register_command(JOB_LIST_COMMAND, tiktok_jobs_command)
+    api.register_command(JOB_CANCEL_COMMAND, tiktok_cancel_command)
@@ -0,0 +1,234 @@
+"""Бенчмарк Maxli Store на локальном сервере вместо GitHub.
+
+Поднимает aiohttp сервер с ответами git/ref, git/trees и raw для каталога
+нужного размера (с задержкой на каждый ответ), подключает к нему свежую копию
+MaxliStore.py и гоняет команды списка, поиска и скачивания через фейковый api.
+Для каждого размера каталога выводит p50/p99 времени команды, число HTTP
+запросов на команду и память, которую занимают каталог, заголовки и индекс.
+
+Запуск из корня репозитория:
+    python benchmarks/store_bench.py --sizes 10,100,1000,10000 --latency 50 --runs 30
+"""
+
+import argparse
+import asyncio
+import hashlib
+import importlib.util
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+from aiohttp import web
+
+STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "MaxliStore.py")
+
+WORDS = [
+    "weather", "music", "translate", "notes", "reminder", "crypto", "quotes",
+    "anime", "voice", "sticker", "ping", "backup", "calc", "currency", "todo",
+    "admin", "spam", "filter", "games", "dice", "wiki", "search", "image",
+    "video", "timer", "stats", "profile", "afk", "news", "shazam",
+]
+QUERIES = ["weather", "mus", "transl", "wether", "afk", "crypto_ping", "stiker", "zzz"]
+
+# --- Фейковый GitHub ---
+
+def make_catalog(size, seed=1):
+    """Генерирует {путь: содержимое} для каталога из size модулей."""
+    rnd = random.Random(seed)
+    files = {}
+    for i in range(size):
+        name = f"{rnd.choice(WORDS)}_{rnd.choice(WORDS)}_{i}"
+        folder = f"{rnd.choice(WORDS)}/" if i % 5 == 0 else ""
+        header = (
+            f"# name: {name.replace('_', ' ').title()}\n"
+            f"# version: 1.{i % 10}.0\n"
+            f"# developer: dev{i % 37}\n"
+            f"# id: {name}\n"
+            f"# dependencies: aiohttp\n"
+            f"# min-maxli: 26\n\n"
+        )
+        body = f"async def {name}_command(api, message, args):\n    await api.edit(message, 'ok')\n" * rnd.randint(5, 40)
+        files[f"{folder}{name}.py"] = (header + body).encode()
+    return files
+
+def git_blob_sha(content):
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+def make_app(files, latency, hits):
+    """Сервер с git/ref, git/trees и raw; каждый ответ ждет latency секунд."""
+    head_sha = git_blob_sha(b"".join(files.values()))
+    tree = {
+        "tree": [
+            {"path": path, "type": "blob", "sha": git_blob_sha(content), "size": len(content)}
+            for path, content in files.items()
+        ],
+        "truncated": False,
+    }
+
+    @web.middleware
+    async def delay(request, handler):
+        hits[request.match_info.route.name] += 1
+        if latency:
+            await asyncio.sleep(latency)
+        return await handler(request)
+
+    async def ref(request):
+        etag = f'"{head_sha}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304)
+        return web.json_response({"object": {"sha": head_sha}}, headers={"ETag": etag})
+
+    async def trees(request):
+        return web.json_response(tree)
+
+    async def raw(request):
+        content = files.get(request.match_info["path"])
+        if content is None:
+            return web.Response(status=404)
+        byte_range = request.headers.get("Range")
+        if byte_range:
+            first, last = byte_range.split("=", 1)[1].split("-")
+            return web.Response(body=content[int(first):int(last) + 1], status=206)
+        return web.Response(body=content)
+
+    app = web.Application(middlewares=[delay])
+    app.router.add_get("/repos/{owner}/{repo}/git/ref/heads/{branch}", ref, name="ref")
+    app.router.add_get("/repos/{owner}/{repo}/git/trees/{sha}", trees, name="trees")
+    app.router.add_get("/raw/{owner}/{repo}/{ref}/{path:.*}", raw, name="raw")
+    return app
+
+# --- Фейковый Maxli ---
+
+class FakeMessage:
+    def __init__(self, message_id, chat_id=1):
+        self.id = message_id
+        self.chat_id = chat_id
+
+class FakeApi:
+    """Записывает все правки и отправки вместо Maxli."""
+
+    def __init__(self):
+        self.edits = []
+        self.sends = []
+
+    async def edit(self, message, text):
+        self.edits.append(text)
+
+    async def delete(self, message):
+        return True
+
+    async def await_chat_id(self, message):
+        return message.chat_id
+
+    async def send_file(self, chat_id, file_path, text=""):
+        self.sends.append((file_path, os.path.getsize(file_path), text))
+        return True
+
+    def register_command(self, name, handler):
+        pass
+
+def load_store():
+    """Загружает отдельную копию MaxliStore.py с пустыми кэшами."""
+    spec = importlib.util.spec_from_file_location("maxli_store_bench", STORE_PATH)
+    store = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(store)
+    return store
+
+# --- Замеры ---
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+async def wait_background(store):
+    """Дожидается фонового сбора заголовков."""
+    tasks = [task for _, task in store.HEADER_TASKS.values() if not task.done()]
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def measure(store, api, hits, command, args_list):
+    """Прогоняет команду по списку аргументов, возвращает (времена, запросы)."""
+    timings = []
+    requests = []
+    for i, args in enumerate(args_list):
+        before = sum(hits.values())
+        started = time.perf_counter()
+        await command(api, FakeMessage(i), args)
+        timings.append(time.perf_counter() - started)
+        requests.append(sum(hits.values()) - before)
+    return timings, requests
+
+def report(name, timings, requests):
+    print(
+        f"  {name:<18} p50 {percentile(timings, 0.5) * 1000:8.2f} ms"
+        f"  p99 {percentile(timings, 0.99) * 1000:8.2f} ms"
+        f"  http/cmd {sum(requests) / len(requests):6.2f}"
+    )
+
+async def bench_size(size, latency, runs, port):
+    files = make_catalog(size)
+    hits = Counter()
+    runner = web.AppRunner(make_app(files, latency, hits))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    # Кэши модуль пишет в текущую папку - даем ему отдельную
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="maxli_bench_")
+    os.chdir(workdir)
+    store = load_store()
+    store.GITHUB_API_URL = f"http://127.0.0.1:{port}"
+    store.GITHUB_RAW_URL = f"http://127.0.0.1:{port}/raw"
+    store.BLOB_DIR = os.path.join(workdir, "blobs")
+    api = FakeApi()
+
+    print(f"\n📦 Каталог: {size} модулей, задержка {latency * 1000:.0f} ms, прогонов {runs}")
+    try:
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+
+        report("list (холодный)", *await measure(store, api, hits, store.maxlistore_list_command, [[]]))
+
+        before = sum(hits.values())
+        started = time.perf_counter()
+        await wait_background(store)
+        print(f"  {'сбор заголовков':<18} {(time.perf_counter() - started) * 1000:8.2f} ms  http {sum(hits.values()) - before}")
+
+        report("list", *await measure(store, api, hits, store.maxlistore_list_command, [[]] * runs))
+
+        queries = [[QUERIES[i % len(QUERIES)]] for i in range(runs)]
+        report("search", *await measure(store, api, hits, store.maxlistore_s_command, queries))
+        memory = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+
+        # Номера берутся из последнего списка чата, поэтому сначала показываем весь каталог
+        await store.maxlistore_list_command(api, FakeMessage(0), [])
+        numbers = [[str(i % size + 1)] for i in range(runs)]
+        report("download", *await measure(store, api, hits, store.maxlistore_download_command, numbers))
+        report("download (кэш)", *await measure(store, api, hits, store.maxlistore_download_command, numbers))
+
+        print(f"  {'память':<18} {memory / 1024 / 1024:8.2f} MB  ({memory / size / 1024:.2f} KB на модуль)")
+        print(f"  {'http всего':<18} " + ", ".join(f"{kind}: {count}" for kind, count in sorted(hits.items())))
+    finally:
+        await store.close_http_session()
+        await runner.cleanup()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+async def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк Maxli Store на локальном фейковом GitHub")
+    parser.add_argument("--sizes", default="10,100,1000,10000", help="размеры каталога через запятую")
+    parser.add_argument("--latency", type=float, default=50, help="задержка ответа сервера, ms")
+    parser.add_argument("--runs", type=int, default=30, help="прогонов каждой команды")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    for size in (int(s) for s in args.sizes.split(",")):
+        await bench_size(size, args.latency / 1000, args.runs, args.port)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,5 +1,5 @@
 # name: Генератор изображений
-# version: 1.0.0
+# version: 1.6.0
 # developer: @YouRooni - Maxli Dev
 # min-maxli: 26
 
@@ -7,6 +7,15 @@ import aiohttp
 import aiofiles
 import os
 import asyncio
+import contextlib
+import errno
+import hashlib
+import json
+import random
+import shutil
+import tempfile
+import time
+from collections import Counter, OrderedDict, deque
 from core.config import get_module_setting, register_module_settings, save_config, config as core_config
 
 # Доступные модели
@@ -19,6 +28,18 @@ AVAILABLE_MODELS = {
 
 MODULE_NAME = "genimg"
 
+# --- Общий HTTP клиент ---
+GENERATION_TIMEOUT = 60  # Генерация может занимать до минуты
+HTTP_LIMIT = 10  # Всего соединений в пуле
+HTTP_LIMIT_PER_HOST = 4  # Соединений на один хост
+DNS_CACHE_TTL = 300  # Сколько секунд помнить DNS ответы
+
+MAX_IMAGE_SIZE = 20 * 1024 * 1024  # Больше этого изображение не ждем
+
+HTTP_SESSION = None
+HTTP_SESSION_LOOP = None
+HTTP_STATS = {"requests": 0, "new_connections": 0, "reused_connections": 0, "dns_lookups": 0}
+
 # Регистрируем схему настроек при импорте
 register_module_settings(MODULE_NAME, {
     "model": {"default": "flux", "description": "Модель генерации (flux/turbo)"},
@@ -39,13 +60,524 @@ def set_setting(key, value):
     conf["external_modules"][MODULE_NAME]["settings"][key] = value
     save_config(conf)
 
+# --- Кэш изображений ---
+IMAGE_CACHE_DIR = "genimg_cache"  # Готовые изображения по хэшу промпта и параметров
+IMAGE_CACHE_FILE = "genimg_cache.json"
+IMAGE_CACHE_LIMIT = 200 * 1024 * 1024  # Сколько байт на диске могут занимать изображения
+
+# хэш -> {"file", "size", "used_at", "prompt"}; порядок - от давно использованных к недавним
+IMAGE_CACHE = OrderedDict()
+IMAGE_CACHE_LOADED = False
+IMAGE_GENERATIONS = {}
+IMAGE_CACHE_PINS = Counter()  # Изображения, которые сейчас отправляются - их не вытесняем
+IMAGE_CACHE_STATS = {"hits": 0, "misses": 0, "coalesced": 0, "evicted": 0}
+
+# --- Несколько вариантов ---
+VARIANT_LIMIT = 6  # Больше вариантов за одну команду не генерируем
+VARIANT_CONCURRENCY = 3  # Сколько вариантов генерируется одновременно (не больше HTTP_LIMIT_PER_HOST)
+
+# --- Очередь загрузок ---
+JOB_GLOBAL_LIMIT = 2  # Сколько загрузок выполняется одновременно
+JOB_CHAT_LIMIT = 1  # Из них - из одного чата
+JOB_LIST_COMMAND = "genimgjobs"
+JOB_CANCEL_COMMAND = "genimgcancel"
+
+JOBS = {}  # номер -> задача
+JOB_QUEUES = OrderedDict()  # chat_id -> номера ждущих задач; порядок - очередь обхода чатов
+JOB_RUNNING = Counter()  # chat_id -> сколько задач выполняется
+JOB_COUNTER = 0
+JOB_STATS = {"started": 0, "finished": 0, "cancelled": 0}
+
+# --- Прогресс ---
+PROGRESS_INTERVAL = 2.0  # Не чаще одной правки сообщения за столько секунд
+
+PROGRESS_STATS = {"edits": 0, "saved": 0}
+
+# --- Временные файлы ---
+SCRATCH_DIR_NAME = "maxli_genimg"  # Подпапка в /dev/shm или системной временной папке
+SCRATCH_QUOTA = 100 * 1024 * 1024  # Сколько байт могут занимать изображения, ожидающие отправки
+
+SCRATCH_ROOT = None
+SCRATCH_STATS = {"reserved": 0, "rejected": 0}
+
+async def _on_request_start(session, ctx, params):
+    HTTP_STATS["requests"] += 1
+
+async def _on_connection_create_end(session, ctx, params):
+    HTTP_STATS["new_connections"] += 1
+
+async def _on_connection_reuseconn(session, ctx, params):
+    HTTP_STATS["reused_connections"] += 1
+
+async def _on_dns_resolvehost_end(session, ctx, params):
+    HTTP_STATS["dns_lookups"] += 1
+
+def get_http_session():
+    """Возвращает общую HTTP сессию с пулом соединений (создается лениво)."""
+    global HTTP_SESSION, HTTP_SESSION_LOOP
+    loop = asyncio.get_running_loop()
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed and HTTP_SESSION_LOOP is loop:
+        return HTTP_SESSION
+    
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+    trace_config.on_dns_resolvehost_end.append(_on_dns_resolvehost_end)
+    
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_LIMIT,
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=60
+    )
+    HTTP_SESSION = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=GENERATION_TIMEOUT),
+        trace_configs=[trace_config]
+    )
+    HTTP_SESSION_LOOP = loop
+    return HTTP_SESSION
+
+async def close_http_session():
+    """Закрывает общую HTTP сессию и все соединения пула.
+    
+    Хука выгрузки у загрузчика Maxli нет, поэтому сессия закрывается только
+    при повторной регистрации этого же модуля (см. register).
+    """
+    global HTTP_SESSION
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed:
+        await HTTP_SESSION.close()
+    HTTP_SESSION = None
+
+def get_http_stats():
+    """Возвращает статистику пула соединений."""
+    stats = dict(HTTP_STATS)
+    connections = stats["new_connections"] + stats["reused_connections"]
+    stats["reuse_ratio"] = stats["reused_connections"] / connections if connections else 0.0
+    
+    open_connections = 0
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed:
+        connector = HTTP_SESSION.connector
+        # Простаивающие keep-alive соединения + занятые в данный момент
+        open_connections = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+        open_connections += len(getattr(connector, "_acquired", ()))
+    stats["open_connections"] = open_connections
+    return stats
+
+def get_scratch_root():
+    """Папка для временных файлов модуля (в tmpfs, если он доступен)."""
+    global SCRATCH_ROOT
+    if SCRATCH_ROOT is None:
+        base = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+        SCRATCH_ROOT = os.path.join(base, SCRATCH_DIR_NAME)
+        os.makedirs(SCRATCH_ROOT, exist_ok=True)
+    return SCRATCH_ROOT
+
+def sweep_scratch_dir():
+    """Удаляет временные файлы, оставшиеся после прошлого запуска."""
+    root = get_scratch_root()
+    removed = 0
+    for entry in os.scandir(root):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+@contextlib.asynccontextmanager
+async def scratch_file(filename, size_hint=0):
+    """Выдает уникальный путь для временного файла и гарантированно удаляет его.
+    
+    size_hint резервируется в квоте на время жизни файла; если квота
+    исчерпана, выбрасывается OSError(ENOSPC).
+    """
+    if SCRATCH_STATS["reserved"] + size_hint > SCRATCH_QUOTA:
+        SCRATCH_STATS["rejected"] += 1
+        raise OSError(errno.ENOSPC, "Недостаточно места для временных файлов, попробуйте позже")
+    
+    SCRATCH_STATS["reserved"] += size_hint
+    # Отдельная папка на каждый файл: имя сохраняется, а одновременные загрузки не пересекаются
+    directory = tempfile.mkdtemp(dir=get_scratch_root())
+    try:
+        yield os.path.join(directory, filename)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        SCRATCH_STATS["reserved"] -= size_hint
+
+def load_image_cache():
+    """Загружает индекс кэша изображений (один раз за запуск), забывая пропавшие файлы."""
+    global IMAGE_CACHE_LOADED
+    if IMAGE_CACHE_LOADED:
+        return
+    IMAGE_CACHE_LOADED = True
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+    if os.path.exists(IMAGE_CACHE_FILE):
+        try:
+            with open(IMAGE_CACHE_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                for key, entry in sorted(data.items(), key=lambda item: item[1].get("used_at", 0)):
+                    if os.path.exists(os.path.join(IMAGE_CACHE_DIR, entry.get("file", ""))):
+                        IMAGE_CACHE[key] = entry
+        except (json.JSONDecodeError, IOError, AttributeError):
+            pass
+
+def save_image_cache():
+    try:
+        temp_path = f"{IMAGE_CACHE_FILE}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(IMAGE_CACHE, f, ensure_ascii=False)
+        os.replace(temp_path, IMAGE_CACHE_FILE)
+    except Exception:
+        pass
+
+def get_image_cache_key(prompt, model, width, height, enchant, seed=None):
+    """Ключ кэша: хэш нормализованного промпта и всех параметров генерации."""
+    normalized = " ".join(prompt.split()).casefold()
+    params = json.dumps([normalized, str(model), str(width), str(height), bool(enchant), seed])
+    return hashlib.sha256(params.encode('utf-8')).hexdigest()
+
+def get_cached_image_path(cache_key):
+    """Путь к изображению из кэша (и отметка об использовании) или None."""
+    load_image_cache()
+    entry = IMAGE_CACHE.get(cache_key)
+    if entry is None:
+        return None
+    image_path = os.path.join(IMAGE_CACHE_DIR, entry["file"])
+    if not os.path.exists(image_path):
+        IMAGE_CACHE.pop(cache_key, None)
+        return None
+    entry["used_at"] = time.time()
+    IMAGE_CACHE.move_to_end(cache_key)
+    save_image_cache()
+    return image_path
+
+def evict_image_cache():
+    """Удаляет давно не использованные изображения, пока кэш больше лимита."""
+    total = sum(entry["size"] for entry in IMAGE_CACHE.values())
+    for cache_key in list(IMAGE_CACHE):
+        if total <= IMAGE_CACHE_LIMIT:
+            break
+        # Изображения, которые сейчас отправляются, не трогаем
+        if IMAGE_CACHE_PINS[cache_key]:
+            continue
+        entry = IMAGE_CACHE.pop(cache_key)
+        total -= entry["size"]
+        IMAGE_CACHE_STATS["evicted"] += 1
+        with contextlib.suppress(OSError):
+            os.remove(os.path.join(IMAGE_CACHE_DIR, entry["file"]))
+
+def get_image_cache_stats():
+    """Возвращает статистику кэша изображений."""
+    stats = dict(IMAGE_CACHE_STATS)
+    requests = stats["hits"] + stats["misses"] + stats["coalesced"]
+    stats["hit_ratio"] = (stats["hits"] + stats["coalesced"]) / requests if requests else 0.0
+    stats["count"] = len(IMAGE_CACHE)
+    stats["size"] = sum(entry["size"] for entry in IMAGE_CACHE.values())
+    return stats
+
+async def fetch_image_to_cache(cache_key, image_url, prompt, on_progress=None):
+    """Генерирует изображение в кэш; одинаковые запросы из разных чатов ждут одну генерацию."""
+    generation = IMAGE_GENERATIONS.get(cache_key)
+    if generation is None:
+        generation = IMAGE_GENERATIONS[cache_key] = {"task": None, "waiters": 0, "listeners": []}
+        
+        async def notify(image_size):
+            # Прогресс получают только те, кто еще ждет: ушедший не должен править свое сообщение
+            for listener in list(generation["listeners"]):
+                try:
+                    await listener(image_size)
+                except Exception as e:
+                    print(f"❌ Ошибка прогресса genimg: {e}")
+        
+        task = generation["task"] = asyncio.create_task(_fetch_image_to_cache(cache_key, image_url, prompt, notify))
+        task.add_done_callback(lambda _: IMAGE_GENERATIONS.pop(cache_key, None))
+    else:
+        IMAGE_CACHE_STATS["coalesced"] += 1
+    
+    generation["waiters"] += 1
+    if on_progress:
+        generation["listeners"].append(on_progress)
+    try:
+        return await asyncio.shield(generation["task"])
+    except asyncio.CancelledError:
+        # Ушел последний, кто ждал это изображение, - генерацию останавливаем
+        if generation["waiters"] == 1:
+            generation["task"].cancel()
+        raise
+    finally:
+        generation["waiters"] -= 1
+        if on_progress:
+            generation["listeners"].remove(on_progress)
+
+async def _fetch_image_to_cache(cache_key, image_url, prompt, on_progress):
+    load_image_cache()
+    IMAGE_CACHE_STATS["misses"] += 1
+    filename = f"{cache_key}.jpg"
+    image_path = os.path.join(IMAGE_CACHE_DIR, filename)
+    
+    print(f"🔍 DEBUG: Генерируем изображение по URL: {image_url}")
+    session = get_http_session()
+    async with session.get(image_url) as response:
+        if response.status != 200:
+            raise Exception(f"сервис генерации ответил HTTP {response.status}, возможно, он недоступен")
+        # Пишем изображение во временный файл по мере получения, в кэш попадает только целое
+        async with scratch_file(filename, MAX_IMAGE_SIZE) as temp_path:
+            image_size = 0
+            async with aiofiles.open(temp_path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    image_size += len(chunk)
+                    if image_size > MAX_IMAGE_SIZE:
+                        raise Exception("Изображение слишком большое")
+                    await f.write(chunk)
+                    if on_progress:
+                        await on_progress(image_size)
+            shutil.move(temp_path, image_path)
+    print(f"✅ Изображение скачано, размер: {image_size} байт")
+    
+    IMAGE_CACHE[cache_key] = {"file": filename, "size": image_size, "used_at": time.time(), "prompt": prompt[:200]}
+    evict_image_cache()
+    save_image_cache()
+    return image_path
+
+def new_progress(api, message, interval=None):
+    """Состояние сообщения с прогрессом: правки чаще interval склеиваются."""
+    return {
+        "api": api,
+        "message": message,
+        "interval": PROGRESS_INTERVAL if interval is None else interval,
+        "last_at": 0.0,
+        "last_text": None,
+        "pending": None,
+        "timer": None,
+        "lock": asyncio.Lock(),
+    }
+
+async def _send_progress(progress, text):
+    async with progress["lock"]:
+        if text == progress["last_text"]:
+            PROGRESS_STATS["saved"] += 1
+            return
+        progress["last_at"] = time.monotonic()
+        progress["last_text"] = text
+        PROGRESS_STATS["edits"] += 1
+        await progress["api"].edit(progress["message"], text)
+
+async def _flush_progress(progress, delay):
+    await asyncio.sleep(delay)
+    progress["timer"] = None
+    text, progress["pending"] = progress["pending"], None
+    if text is not None:
+        await _send_progress(progress, text)
+
+async def report_progress(progress, text):
+    """Показывает промежуточное состояние.
+    
+    Если с прошлой правки не прошло interval секунд, текст откладывается до
+    конца интервала; более новое состояние заменяет отложенное, а не встает
+    за ним в очередь.
+    """
+    wait = progress["last_at"] + progress["interval"] - time.monotonic()
+    if wait <= 0 and progress["timer"] is None:
+        await _send_progress(progress, text)
+        return
+    if progress["pending"] is not None:
+        PROGRESS_STATS["saved"] += 1
+    progress["pending"] = text
+    if progress["timer"] is None:
+        progress["timer"] = asyncio.create_task(_flush_progress(progress, max(wait, 0)))
+
+async def finish_progress(progress, text=None):
+    """Отменяет отложенную правку и сразу показывает итог, если он передан."""
+    timer, progress["timer"] = progress["timer"], None
+    if timer is not None:
+        timer.cancel()
+    if progress["pending"] is not None:
+        PROGRESS_STATS["saved"] += 1
+        progress["pending"] = None
+    if text is not None:
+        await _send_progress(progress, text)
+
+def get_job_position(job):
+    """Место задачи в очереди (1 - следующая) при обходе чатов по кругу."""
+    position = 0
+    queues = [list(queue) for queue in JOB_QUEUES.values()]
+    for round_index in range(max((len(queue) for queue in queues), default=0)):
+        for queue in queues:
+            if round_index < len(queue):
+                position += 1
+                if queue[round_index] == job["id"]:
+                    return position
+    return position
+
+def pump_jobs():
+    """Запускает ждущие задачи, пока есть свободные места; чаты берутся по кругу."""
+    while sum(JOB_RUNNING.values()) < JOB_GLOBAL_LIMIT:
+        for chat_id in list(JOB_QUEUES):
+            if JOB_RUNNING[chat_id] >= JOB_CHAT_LIMIT:
+                continue
+            queue = JOB_QUEUES[chat_id]
+            job = JOBS.get(queue.popleft())
+            # Чат, из которого только что взяли задачу, уходит в конец круга
+            if queue:
+                JOB_QUEUES.move_to_end(chat_id)
+            else:
+                del JOB_QUEUES[chat_id]
+            if job is None or job["state"] != "queued" or job["ready"].done():
+                # Отмененная задача: место достается следующей
+                break
+            JOB_RUNNING[chat_id] += 1
+            job["state"] = "running"
+            job["started_at"] = time.time()
+            job["ready"].set_result(True)
+            break
+        else:
+            break
+    
+    for job in JOBS.values():
+        if job["state"] == "queued" and not job["ready"].done():
+            position = get_job_position(job)
+            if position != job["position"]:
+                job["position"] = position
+                asyncio.create_task(report_queue_position(job))
+
+async def report_queue_position(job):
+    # Задачу могли запустить или отменить, пока правка ждала своей очереди
+    if job["state"] == "queued" and not job["ready"].done():
+        await report_progress(job["progress"], format_queue_position(job))
+
+def format_queue_position(job):
+    return f"⏳ В очереди: {job['position']}-я, выполняется: {sum(JOB_RUNNING.values())}/{JOB_GLOBAL_LIMIT}\n❌ Отменить: `.{JOB_CANCEL_COMMAND} {job['id']}`"
+
+async def run_job(api, message, title, factory):
+    """Выполняет factory() как задачу очереди загрузок.
+    
+    Одновременно выполняется не больше JOB_GLOBAL_LIMIT задач и не больше
+    JOB_CHAT_LIMIT из одного чата; пока места нет, сообщение показывает
+    место в очереди. Отмененная задача прерывается, а ее временные файлы
+    удаляются их контекстными менеджерами.
+    """
+    global JOB_COUNTER
+    JOB_COUNTER += 1
+    chat_id = getattr(message, "chat_id", None) or await api.await_chat_id(message)
+    job = {
+        "id": JOB_COUNTER,
+        "chat_id": chat_id,
+        "title": title,
+        "state": "queued",
+        "position": 0,
+        "created_at": time.time(),
+        "started_at": None,
+        "cancelled": False,
+        "task": None,
+        "ready": asyncio.get_running_loop().create_future(),
+        "progress": new_progress(api, message),
+    }
+    JOBS[job["id"]] = job
+    JOB_QUEUES.setdefault(chat_id, deque()).append(job["id"])
+    pump_jobs()
+    
+    try:
+        await job["ready"]
+        await finish_progress(job["progress"])
+        if job["cancelled"]:
+            raise asyncio.CancelledError()
+        JOB_STATS["started"] += 1
+        # Отдельная задача: .cancel прерывает только эту загрузку, а не обработчик команд
+        job["task"] = asyncio.create_task(factory())
+        return await job["task"]
+    except asyncio.CancelledError:
+        if not job["cancelled"]:
+            raise
+        await finish_progress(job["progress"], "🛑 Загрузка отменена")
+    finally:
+        JOBS.pop(job["id"], None)
+        if job["state"] == "running":
+            JOB_RUNNING[chat_id] -= 1
+            if JOB_RUNNING[chat_id] <= 0:
+                del JOB_RUNNING[chat_id]
+        elif chat_id in JOB_QUEUES:
+            with contextlib.suppress(ValueError):
+                JOB_QUEUES[chat_id].remove(job["id"])
+            if not JOB_QUEUES[chat_id]:
+                del JOB_QUEUES[chat_id]
+        JOB_STATS["finished"] += 1
+        pump_jobs()
+
+def cancel_job(job):
+    job["cancelled"] = True
+    JOB_STATS["cancelled"] += 1
+    if job["state"] == "queued":
+        # Из очереди убираем сразу, а не в finally run_job: иначе pump_jobs
+        # успеет запустить отмененную задачу
+        job["state"] = "cancelled"
+        queue = JOB_QUEUES.get(job["chat_id"])
+        if queue is not None:
+            with contextlib.suppress(ValueError):
+                queue.remove(job["id"])
+            if not queue:
+                del JOB_QUEUES[job["chat_id"]]
+        job["ready"].cancel()
+        pump_jobs()
+    elif job["task"] is not None:
+        job["task"].cancel()
+
+async def genimgjobs_command(api, message, args):
+    """Показывает выполняющиеся и ждущие загрузки."""
+    jobs = [job for job in JOBS.values() if job["state"] != "cancelled"]
+    if not jobs:
+        await api.edit(message, "📭 Загрузок нет")
+        return
+    
+    now = time.time()
+    lines = [f"📋 Загрузки (выполняется {sum(JOB_RUNNING.values())}/{JOB_GLOBAL_LIMIT}):\n"]
+    for job in sorted(jobs, key=lambda j: (j["state"] != "running", j["position"], j["id"])):
+        if job["state"] == "running":
+            state = f"▶️ {now - job['started_at']:.0f} с"
+        else:
+            state = f"⏳ {job['position']}-я в очереди"
+        lines.append(f"#{job['id']} {state} • {job['title']}")
+    lines.append(f"\n❌ Отменить: `.{JOB_CANCEL_COMMAND} <номер>` или `.{JOB_CANCEL_COMMAND} all` - все в этом чате")
+    await api.edit(message, "\n".join(lines))
+
+async def genimgcancel_command(api, message, args):
+    """Отменяет загрузку по номеру (или все загрузки этого чата)."""
+    if not args:
+        await api.edit(message, f"❌ Укажите номер загрузки: .{JOB_CANCEL_COMMAND} 3\n📋 Список: .{JOB_LIST_COMMAND}")
+        return
+    
+    if args[0].lower() == "all":
+        chat_id = getattr(message, "chat_id", None) or await api.await_chat_id(message)
+        jobs = [job for job in JOBS.values() if job["chat_id"] == chat_id and not job["cancelled"]]
+    else:
+        job = JOBS.get(int(args[0])) if args[0].isdigit() else None
+        jobs = [job] if job and not job["cancelled"] else []
+    
+    if not jobs:
+        await api.edit(message, "❌ Нет такой загрузки")
+        return
+    for job in jobs:
+        cancel_job(job)
+    await api.edit(message, f"🛑 Отменено загрузок: {len(jobs)}")
+
 async def genimg_command(api, message, args):
-    """Генерирует изображение по промпту."""
+    """Генерирует изображение (или несколько вариантов) по промпту."""
     if not args:
-        await api.edit(message, f"🎨 Генератор изображений\n\nИспользование: .genimg [промпт]\nПример: .genimg красивая природа\n\nТекущая модель: {get_setting('model', 'flux')}\nШирина: {get_setting('width', 1024)}\nВысота: {get_setting('height', 1024)}\nEnchant: {get_setting('enchant', True)}")
+        await api.edit(message, f"🎨 Генератор изображений\n\nИспользование: .genimg [-n количество] [-s сид] [промпт]\nПример: .genimg красивая природа\nНесколько вариантов: .genimg -n 4 красивая природа\nОдинаковый промпт с теми же настройками и сидом отдается из кэша\n\nТекущая модель: {get_setting('model', 'flux')}\nШирина: {get_setting('width', 1024)}\nВысота: {get_setting('height', 1024)}\nEnchant: {get_setting('enchant', True)}")
         return
 
-    prompt = " ".join(args)
+    prompt, options = parse_generation_args(args)
+    if not prompt:
+        await api.edit(message, "❌ Укажите промпт")
+        return
+    if not 1 <= options["count"] <= VARIANT_LIMIT:
+        await api.edit(message, f"❌ Количество вариантов - от 1 до {VARIANT_LIMIT}")
+        return
     chat_id = getattr(message, 'chat_id', None)
     if not chat_id:
         chat_id = await api.await_chat_id(message)
@@ -53,49 +585,181 @@ async def genimg_command(api, message, args):
         await api.edit(message, "❌ Не удалось определить chat_id")
         return
 
+    if options["count"] > 1:
+        await run_job(api, message, f"Варианты ({options['count']}): {prompt[:40]}", lambda: generate_variants(api, message, prompt, chat_id, options["count"], options["seed"]))
+    else:
+        await run_job(api, message, f"Изображение: {prompt[:40]}", lambda: generate_image(api, message, prompt, chat_id, options["seed"]))
+
+def parse_generation_args(args):
+    """Отделяет опции от промпта: -s/--seed <число> задает сид, -n <число> - количество вариантов."""
+    options = {"seed": None, "count": 1}
+    words = []
+    index = 0
+    while index < len(args):
+        if args[index] in ("-s", "--seed") and index + 1 < len(args) and args[index + 1].isdigit():
+            options["seed"] = int(args[index + 1])
+            index += 2
+            continue
+        if args[index] == "-n" and index + 1 < len(args) and args[index + 1].isdigit():
+            options["count"] = int(args[index + 1])
+            index += 2
+            continue
+        words.append(args[index])
+        index += 1
+    return " ".join(words), options
+
+def build_image_url(prompt, model, width, height, enchant, seed=None):
+    """URL для генерации изображения."""
+    image_url = f"https://pollinations.ai/p/{prompt}?width={width}&height={height}&model={model}&nologo=true&enchant={'true' if enchant else 'false'}"
+    if seed is not None:
+        image_url += f"&seed={seed}"
+    return image_url
+
+async def get_or_generate_image(prompt, model, width, height, enchant, seed=None, on_progress=None):
+    """Возвращает (ключ кэша, путь к изображению): из кэша или после генерации."""
+    cache_key = get_image_cache_key(prompt, model, width, height, enchant, seed)
+    image_path = get_cached_image_path(cache_key)
+    if image_path:
+        IMAGE_CACHE_STATS["hits"] += 1
+        return cache_key, image_path
+    
+    image_url = build_image_url(prompt, model, width, height, enchant, seed)
+    await fetch_image_to_cache(cache_key, image_url, prompt, on_progress)
+    image_path = get_cached_image_path(cache_key)
+    if not image_path:
+        raise Exception("Изображение не сохранилось в кэше, попробуйте еще раз")
+    return cache_key, image_path
+
+async def send_cached_image(api, chat_id, cache_key, image_path, caption):
+    """Отправляет изображение из кэша; пока оно отправляется, вытеснение его не тронет."""
+    IMAGE_CACHE_PINS[cache_key] += 1
+    try:
+        return await api.send_photo(chat_id=chat_id, file_path=image_path, text=caption)
+    finally:
+        IMAGE_CACHE_PINS[cache_key] -= 1
+        if IMAGE_CACHE_PINS[cache_key] <= 0:
+            del IMAGE_CACHE_PINS[cache_key]
+
+async def generate_image(api, message, prompt, chat_id, seed=None):
+    """Генерирует изображение (или берет из кэша) и отправляет его в чат."""
     # Получаем настройки
     model = get_setting('model', 'flux')
     width = get_setting('width', 1024)
     height = get_setting('height', 1024)
     enchant = get_setting('enchant', True)
 
-    await api.edit(message, f"🎨 Генерирую изображение...\nПромпт: {prompt}\nМодель: {model}\nРазмер: {width}x{height}\nEnchant: {enchant}")
+    status = f"🎨 Генерирую изображение...\nПромпт: {prompt}\nМодель: {model}\nРазмер: {width}x{height}\nEnchant: {enchant}"
+    if seed is not None:
+        status += f"\nСид: {seed}"
+    progress = new_progress(api, message)
+    await report_progress(progress, status)
+
+    async def on_progress(image_size):
+        await report_progress(progress, f"{status}\n📥 Получено: {image_size / 1024:.0f} КБ")
 
     try:
-        # URL для генерации изображения
-        image_url = f"https://pollinations.ai/p/{prompt}?width={width}&height={height}&model={model}&nologo=true&enchant={'true' if enchant else 'false'}"
-        print(f"🔍 DEBUG: Генерируем изображение по URL: {image_url}")
-        timeout = aiohttp.ClientTimeout(total=60)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(image_url) as response:
-                if response.status == 200:
-                    image_data = await response.read()
-                    print(f"✅ Изображение скачано, размер: {len(image_data)} байт")
-                    temp_path = f"temp_gen_{message.id}.jpg"
-                    async with aiofiles.open(temp_path, 'wb') as f:
-                        await f.write(image_data)
-                    result = await api.send_photo(
-                        chat_id=chat_id,
-                        file_path=temp_path,
-                        text=f"🎨 Изображение: {prompt}\n🤖 Модель: {model}"
-                    )
-                    try:
-                        os.remove(temp_path)
-                        print(f"🧹 Удален временный файл: {temp_path}")
-                    except:
-                        pass
-                    if result:
-                        await api.delete(message)
-                    else:
-                        await api.edit(message, "❌ Ошибка отправки изображения")
-                else:
-                    await api.edit(message, f"❌ Ошибка генерации: HTTP {response.status}\nВозможно, сервис недоступен")
+        cache_key, image_path = await get_or_generate_image(prompt, model, width, height, enchant, seed, on_progress)
+        await report_progress(progress, f"{status}\n📤 Отправляю изображение...")
+        caption = f"🎨 Изображение: {prompt}\n🤖 Модель: {model}" + (f"\n🎲 Сид: {seed}" if seed is not None else "")
+        result = await send_cached_image(api, chat_id, cache_key, image_path, caption)
+        if result:
+            await finish_progress(progress)
+            await api.delete(message)
+        else:
+            await finish_progress(progress, "❌ Ошибка отправки изображения")
+    except asyncio.CancelledError:
+        # Отмена через очередь: отложенная правка не должна перекрыть сообщение об отмене
+        await finish_progress(progress)
+        raise
     except asyncio.TimeoutError:
-        await api.edit(message, "⏰ Таймаут генерации изображения\nПопробуйте еще раз или измените промпт")
+        await finish_progress(progress, "⏰ Таймаут генерации изображения\nПопробуйте еще раз или измените промпт")
     except Exception as e:
-        await api.edit(message, f"❌ Ошибка: {str(e)}")
+        await finish_progress(progress, f"❌ Ошибка: {str(e)}")
         print(f"❌ Ошибка в genimg_command: {e}")
 
+async def generate_variants(api, message, prompt, chat_id, count, seed=None):
+    """Генерирует count вариантов с разными сидами параллельно.
+    
+    Одновременно генерируется не больше VARIANT_CONCURRENCY вариантов;
+    каждый отправляется в чат сразу, как только готов, а одно сообщение
+    показывает общий прогресс. С заданным сидом варианты получают сиды
+    seed, seed+1, ..., поэтому повтор команды берет их из кэша.
+    """
+    model = get_setting('model', 'flux')
+    width = get_setting('width', 1024)
+    height = get_setting('height', 1024)
+    enchant = get_setting('enchant', True)
+    seeds = [seed + i for i in range(count)] if seed is not None else [random.randint(0, 2**31 - 1) for _ in range(count)]
+
+    status = f"🎨 Генерирую варианты: {count}\nПромпт: {prompt}\nМодель: {model}\nРазмер: {width}x{height}\nEnchant: {enchant}"
+    progress = new_progress(api, message)
+    await report_progress(progress, status)
+    semaphore = asyncio.Semaphore(VARIANT_CONCURRENCY)
+    state = {"sent": 0, "failed": 0}
+
+    async def generate_variant(index, variant_seed):
+        try:
+            async with semaphore:
+                cache_key, image_path = await get_or_generate_image(prompt, model, width, height, enchant, variant_seed)
+            # Отправляем вне семафора: слот сразу достается следующему варианту
+            caption = f"🎨 Вариант {index}/{count}: {prompt}\n🤖 Модель: {model}\n🎲 Сид: {variant_seed}"
+            if not await send_cached_image(api, chat_id, cache_key, image_path, caption):
+                raise Exception("не удалось отправить изображение")
+            state["sent"] += 1
+        except Exception as e:
+            state["failed"] += 1
+            print(f"❌ Ошибка варианта {index} (сид {variant_seed}): {e!r}")
+        failed = f" • ошибок: {state['failed']}" if state["failed"] else ""
+        await report_progress(progress, f"{status}\n✅ Готово: {state['sent']}/{count}{failed}")
+
+    tasks = [asyncio.create_task(generate_variant(index, variant_seed)) for index, variant_seed in enumerate(seeds, 1)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # При отмене останавливаем и еще не готовые варианты
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await finish_progress(progress)
+
+    if not state["sent"]:
+        await finish_progress(progress, f"❌ Не удалось сгенерировать ни одного варианта из {count}\nПопробуйте еще раз или измените промпт")
+    elif state["failed"]:
+        await finish_progress(progress, f"⚠️ Отправлено вариантов: {state['sent']}/{count}, ошибок: {state['failed']}")
+    else:
+        await api.delete(message)
+
+async def genimgstats_command(api, message, args):
+    """Показывает статистику HTTP пула и кэша генератора."""
+    http_stats = get_http_stats()
+    cache_stats = get_image_cache_stats()
+    
+    stats_text = f"""📊 Статистика генератора изображений
+
+🌐 HTTP пул:
+• Запросов: {http_stats['requests']}
+• Новых соединений: {http_stats['new_connections']}
+• Переиспользовано: {http_stats['reused_connections']} ({http_stats['reuse_ratio'] * 100:.1f}%)
+• Открыто сейчас: {http_stats['open_connections']}
+• DNS запросов: {http_stats['dns_lookups']}
+
+🗂 Кэш изображений:
+• В кэше: {cache_stats['count']} изображений, {cache_stats['size'] / 1024 / 1024:.1f} / {IMAGE_CACHE_LIMIT / 1024 / 1024:.0f} МБ
+• Из кэша: {cache_stats['hits']} • объединено: {cache_stats['coalesced']} • сгенерировано: {cache_stats['misses']} • вытеснено: {cache_stats['evicted']}
+• Доля попаданий: {cache_stats['hit_ratio'] * 100:.1f}%
+
+📋 Очередь: выполняется {sum(JOB_RUNNING.values())}/{JOB_GLOBAL_LIMIT} • ждут {sum(len(q) for q in JOB_QUEUES.values())} • отменено {JOB_STATS['cancelled']}
+
+🗑 Временные файлы:
+• Зарезервировано: {SCRATCH_STATS['reserved'] / 1024 / 1024:.1f} / {SCRATCH_QUOTA / 1024 / 1024:.0f} МБ
+• Отказов по квоте: {SCRATCH_STATS['rejected']}
+
+✏️ Прогресс:
+• Правок сообщений: {PROGRESS_STATS['edits']}
+• Сэкономлено правок: {PROGRESS_STATS['saved']}"""
+    
+    await api.edit(message, stats_text)
+
 async def genimgmodel_command(api, message, args):
     """Устанавливает модель для генерации изображений."""
     if not args:
@@ -122,6 +786,12 @@ async def genimgmodel_command(api, message, args):
         await api.edit(message, f"❌ Неизвестная модель: {model_input}\nИспользуйте .genimgmodel для просмотра списка")
 
 async def register(api):
-    """Регистрирует команды модуля."""
+    """Регистрирует команды модуля и чистит временные файлы прошлого запуска."""
+    # Если модуль регистрируется повторно, соединения прошлой регистрации не нужны
+    await close_http_session()
+    sweep_scratch_dir()
     api.register_command("genimg", genimg_command)
     api.register_command("genimgmodel", genimgmodel_command)
+    api.register_command("genimgstats", genimgstats_command)
+    api.register_command(JOB_LIST_COMMAND, genimgjobs_command)
+    api.register_command(JOB_CANCEL_COMMAND, genimgcancel_command)